@@ -0,0 +1,176 @@
+"""Persistent manifest of converted files.
+
+Records for each converted input file its size, modification time and
+content hash, as well as the path of the output file it was converted to.
+Used to only convert again the input files that changed since the last run,
+and to remove the outputs of the input files that were deleted.
+"""
+import os
+import os.path
+import hashlib
+import json
+
+def file_digest( path, chunk_size = 1024 * 1024 ):
+    """Returns the SHA-1 hexadecimal digest of the file content."""
+    digest = hashlib.sha1()
+    with open( path, 'rb' ) as input_file:
+        while True:
+            data = input_file.read( chunk_size )
+            if not data:
+                break
+            digest.update( data )
+    return digest.hexdigest()
+
+class FileManifest( object ):
+    """Manifest stored in the JSON file path.
+       Entries are keyed by the normalized absolute input path.
+    """
+    def __init__( self, path ):
+        self.path = path
+        self._entries = {} # dict(input_path: dict(size, mtime, hash, output))
+        self.skipped = 0
+        self.converted = 0
+        self.removed = 0
+        if os.path.isfile( path ):
+            try:
+                with open( path, 'rb' ) as manifest_file:
+                    self._entries = json.load( manifest_file )
+            except ( IOError, ValueError ):
+                print 'Warning: ignoring invalid manifest "%s"' % path
+                self._entries = {}
+
+    @staticmethod
+    def _key( input_path ):
+        return os.path.normcase( os.path.abspath( input_path ) )
+
+    def is_up_to_date( self, input_path, output_path ):
+        """Returns True if output_path was converted from the current content
+           of input_path, in which case the file is counted as skipped.
+        """
+        if not os.path.isfile( output_path ):
+            return False
+        key = self._key( input_path )
+        input_stat = os.stat( input_path )
+        entry = self._entries.get( key )
+        if entry is None:
+            # outputs converted before the manifest existed are assumed
+            # up to date if they are newer than their input
+            if os.path.getmtime( output_path ) < input_stat.st_mtime:
+                return False
+            self._record( key, input_path, input_stat, output_path, file_digest( input_path ) )
+        elif entry['output'] != self._key( output_path ):
+            return False
+        elif entry['size'] != input_stat.st_size or entry['mtime'] != input_stat.st_mtime:
+            # only modification time changed (file touched or copied)?
+            digest = file_digest( input_path )
+            if digest != entry['hash']:
+                return False
+            self._record( key, input_path, input_stat, output_path, digest )
+        self.skipped += 1
+        return True
+
+    def update( self, input_path, output_path, digest = None ):
+        """Records that output_path has been converted from input_path.
+           digest: content hash of input_path if already known.
+        """
+        if digest is None:
+            digest = file_digest( input_path )
+        self._record( self._key( input_path ), input_path, os.stat( input_path ), output_path, digest )
+        self.converted += 1
+
+    def _record( self, key, input_path, input_stat, output_path, digest ):
+        self._entries[key] = { 'size': input_stat.st_size, 'mtime': input_stat.st_mtime,
+                               'hash': digest, 'output': self._key( output_path ) }
+
+    def remove_stale( self, input_paths, input_dir = None ):
+        """Removes the outputs of the recorded input files that are not in
+           input_paths, and forgets them. If input_dir is specified, only the
+           recorded input files in that directory are considered.
+           Returns the number of removed outputs.
+        """
+        current_keys = set( [ self._key( input_path ) for input_path in input_paths ] )
+        if input_dir is not None:
+            input_dir = os.path.join( self._key( input_dir ), '' )
+        removed = 0
+        for key, entry in self._entries.items():
+            if key in current_keys or ( input_dir is not None and not key.startswith( input_dir ) ):
+                continue
+            del self._entries[key]
+            if os.path.isfile( entry['output'] ):
+                os.remove( entry['output'] )
+                removed += 1
+        self.removed += removed
+        return removed
+
+    def save( self ):
+        """Writes the manifest file."""
+        temp_path = self.path + '.tmp'
+        with open( temp_path, 'wb' ) as manifest_file:
+            json.dump( self._entries, manifest_file, indent = 0, sort_keys = True )
+        if os.path.exists( self.path ): # rename does not overwrite on Windows
+            os.remove( self.path )
+        os.rename( temp_path, self.path )
+
+if __name__ == '__main__':
+    import unittest #@UnresolvedImport
+    import tempfile #@UnresolvedImport
+    import shutil #@UnresolvedImport
+    import time #@UnresolvedImport
+
+    class FileManifestTest( unittest.TestCase ):
+        def setUp( self ):
+            self.temp_dir = tempfile.mkdtemp()
+            self.input_path = os.path.join( self.temp_dir, 'input.bin' )
+            self.output_path = os.path.join( self.temp_dir, 'input.xml' )
+            self.manifest_path = os.path.join( self.temp_dir, 'manifest.json' )
+            self.write( self.input_path, 'input' )
+
+        def tearDown( self ):
+            shutil.rmtree( self.temp_dir )
+
+        def write( self, path, data, mtime = None ):
+            with open( path, 'wb' ) as output_file:
+                output_file.write( data )
+            if mtime is not None:
+                os.utime( path, ( mtime, mtime ) )
+
+        def convert( self, manifest ):
+            self.write( self.output_path, 'output' )
+            manifest.update( self.input_path, self.output_path )
+
+        def test_incremental( self ):
+            manifest = FileManifest( self.manifest_path )
+            self.assertFalse( manifest.is_up_to_date( self.input_path, self.output_path ) )
+            self.convert( manifest )
+            manifest.save()
+            manifest = FileManifest( self.manifest_path )
+            self.assert_( manifest.is_up_to_date( self.input_path, self.output_path ) )
+            # touched but same content
+            os.utime( self.input_path, ( time.time() + 10, time.time() + 10 ) )
+            self.assert_( manifest.is_up_to_date( self.input_path, self.output_path ) )
+            # modified content
+            self.write( self.input_path, 'modified', time.time() + 20 )
+            self.assertFalse( manifest.is_up_to_date( self.input_path, self.output_path ) )
+            # deleted output
+            self.convert( manifest )
+            os.remove( self.output_path )
+            self.assertFalse( manifest.is_up_to_date( self.input_path, self.output_path ) )
+            self.assertEqual( ( 2, 1 ), ( manifest.skipped, manifest.converted ) )
+
+        def test_existing_output( self ):
+            manifest = FileManifest( self.manifest_path )
+            self.write( self.output_path, 'output', time.time() - 10 )
+            self.assertFalse( manifest.is_up_to_date( self.input_path, self.output_path ) )
+            self.write( self.output_path, 'output', time.time() + 10 )
+            self.assert_( manifest.is_up_to_date( self.input_path, self.output_path ) )
+
+        def test_remove_stale( self ):
+            manifest = FileManifest( self.manifest_path )
+            self.convert( manifest )
+            self.assertEqual( 0, manifest.remove_stale( [ self.input_path ] ) )
+            os.remove( self.input_path )
+            self.assertEqual( 0, manifest.remove_stale( [], os.path.join( self.temp_dir, 'other' ) ) )
+            self.assertEqual( 1, manifest.remove_stale( [], self.temp_dir ) )
+            self.assertFalse( os.path.exists( self.output_path ) )
+
+    unittest.main()
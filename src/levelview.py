@@ -11,12 +11,12 @@ import louie
 import metaworld
 import metaworldui
 import qthelper
-import struct
 
 ROUND_DIGITS = 2 #Rounds Sizes, Positions, Radii and Angles to 2 Decimal Places
 Z_TOOL_ITEMS = 1000000 # makes sure always on top
 Z_LEVEL_ITEMS = 10000.0
 Z_PHYSIC_ITEMS = 9000.0
+MAX_IMAGE_LOD = 3 # image mip levels are 1/2, 1/4 and 1/8 of the image size
 
 TOOL_PAN = 'pan'
 TOOL_MOVE = 'move'
@@ -1651,6 +1651,16 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         self._tools_handle_items = []
         self._current_inner_tool = None
         self._items_by_element = {}
+        # When True, element changes only rebuild the items of the modified
+        # top-level element instead of the whole scene.
+        self.incremental_refresh = True
+        # When True, images are decoded in the background and placeholders
+        # are displayed until they are available.
+        self.background_image_loading = True
+        self._elements_by_loading_image = {}
+        # When True, image items display the mip level matching the view scale.
+        self.image_lod = True
+        self._lod_items_by_element = {}
         self._selection_tool_degates_cache = ( None, [] )
         self.setScene( self.__scene )
         # Notes: we disable interactive mode. It is very easily to make the application
@@ -1675,6 +1685,10 @@ class LevelGraphicView( QtGui.QGraphicsView ):
             tree.connect_to_element_events( self.__on_element_added,
                                             self.__on_element_updated,
                                             self.__on_element_about_to_be_removed )
+        louie.connect( self.__on_elements_changed, metaworld.ElementsChanged,
+                       self.__world )
+        louie.connect( self.__on_images_loaded, metaworldui.ImagesLoaded,
+                       self.__world )
         louie.connect( self._on_active_world_change, metaworldui.ActiveWorldChanged,
                        self.__world.universe )
         louie.connect( self._on_selection_change, metaworldui.WorldSelectionChanged,
@@ -1778,8 +1792,12 @@ class LevelGraphicView( QtGui.QGraphicsView ):
             self.killTimer( self._delayed_timer_id )
             self._delayed_timer_id = None
             pending, self._delayed_property_updates = self._delayed_property_updates, []
-            for element, attribute_meta, new_value in pending:
-                attribute_meta.set_native( element, new_value )
+            self.__world.begin_changes()
+            try:
+                for element, attribute_meta, new_value in pending:
+                    attribute_meta.set_native( element, new_value )
+            finally:
+                self.__world.end_changes()
             event.accept()
         else:
             QtGui.QGraphicsView.timerEvent( self, event )
@@ -1944,6 +1962,7 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         if factor < 0.07 or factor > 100:
             return
         self.scale( scaleFactor, scaleFactor )
+        self._updateImageLods()
 
         dx = ( orX - self.width()*0.5 )
         if scaleFactor > 1:
@@ -1981,6 +2000,7 @@ class LevelGraphicView( QtGui.QGraphicsView ):
             return
 
         self.scale( scaleFactor, scaleFactor )
+        self._updateImageLods()
         self._update_tools_handle()
 
     def _on_selection_change( self, selection, #IGNORE:W0613
@@ -1989,11 +2009,16 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         """Ensures that the selected element is seleted in the graphic view.
            Called whenever an element is selected in the tree view or the graphic view.
         """
+        self._applySelection( self.__scene.items(), selection )
+        self._update_tools_handle()
+
+    def _applySelection( self, items, selection ):
+        """Selects or unselects the given items according to the selected elements."""
         # Notes: we do not change selection if the item belong to an item group.
         # All selection events send to an item belonging to a group are forwarded
         # to the item group, which caused infinite recursion (unselect child,
         # then unselect parent, selection parent...)
-        for item in self.__scene.items():
+        for item in items:
             data = item.data( KEY_ELEMENT )
             if not data.isValid():
                 itemtype = item.data( KEY_TYPE ).toString()
@@ -2010,19 +2035,63 @@ class LevelGraphicView( QtGui.QGraphicsView ):
 #                    print 'Unselecting', item, 'isSelected =', item.isSelected()
 #                    print '    Group is', item.group()
                     item.setSelected( False )
-        self._update_tools_handle()
 
     def getModel( self ):
         return self.__world
 
     def __on_element_added( self, element, index_in_parent ): #IGNORE:W0613
-        self.refreshFromModel()
+        if self.__world.is_batching_changes:
+            return
+        if not self.refreshElementFromModel( element ):
+            self.refreshFromModel()
 
     def __on_element_updated( self, element, name, new_value, old_value ): #IGNORE:W0613
-        self.refreshFromModel()
+        if self.__world.is_batching_changes:
+            return
+        if not self.refreshElementFromModel( element ):
+            self.refreshFromModel()
 
     def __on_element_about_to_be_removed( self, element, index_in_parent ): #IGNORE:W0613
-        self.refreshFromModel( set( [element] ) )
+        if self.__world.is_batching_changes:
+            return
+        if not self.refreshElementFromModel( element, set( [element] ) ):
+            self.refreshFromModel( set( [element] ) )
+
+    def __on_elements_changed( self, changes ):
+        """Refreshes once all the top-level elements modified by a batch of changes."""
+        if not self.incremental_refresh:
+            self.refreshFromModel()
+            return
+        element_sets = { self.__world.level_root: self.__level_elements,
+                         self.__world.scene_root: self.__scene_elements }
+        top_elements = {}
+        removed_elements = {}
+        for change in changes:
+            element = change[1]
+            if change[0] == metaworld.ELEMENT_ABOUT_TO_BE_REMOVED:
+                parent = change[2]
+                if parent in element_sets:  # top-level element removed
+                    removed_elements[element] = element_sets[parent]
+                    continue
+                if parent is None:
+                    top_element, element_set = None, None
+                else:
+                    top_element, element_set = self._findTopLevelElement( parent )
+            elif element.tree is None: # removed later in the batch
+                continue
+            else:
+                top_element, element_set = self._findTopLevelElement( element )
+            if top_element is None:
+                self.refreshFromModel()
+                return
+            top_elements[top_element] = element_set
+        scene = self.__scene
+        for element, element_set in removed_elements.iteritems():
+            self._removeElementItems( scene, element, element_set )
+        for element, element_set in top_elements.iteritems():
+            if element.tree is not None:
+                self._rebuildElementItems( element, element_set )
+        self._update_tools_handle()
 
     def _on_active_world_change( self, active_world ):
         """Called when a new world becomes active (may be another one).
@@ -2037,6 +2106,8 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         self._tools_handle_items = []
         self._current_inner_tool = None
         self._items_by_element = {}
+        self._elements_by_loading_image = {}
+        self._lod_items_by_element = {}
         self.__lines = []
         level_element = self.__world.level_root
         self._addElements( scene, level_element, self.__level_elements, self._elements_to_skip )
@@ -2044,14 +2115,99 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         scene_element = self.__world.scene_root
         self._addElements( scene, scene_element, self.__scene_elements, self._elements_to_skip )
 
+        self._addLines( scene )
+
+        # Select currently selected item if any
+        self._on_selection_change( self.__world.selected_elements, set(), set() )
+
+    def refreshElementFromModel( self, element, elements_to_skip = None ):
+        """Rebuilds only the items of the top-level element containing 'element'
+           (a direct child of the level or scene root), and its children.
+           Returns False if the change can not be handled incrementally (root
+           element, resource tree...), in which case refreshFromModel() must be used.
+        """
+        if not self.incremental_refresh:
+            return False
+        top_element, element_set = self._findTopLevelElement( element )
+        if top_element is None:
+            return False
+        self._rebuildElementItems( top_element, element_set, elements_to_skip )
+        self._update_tools_handle()
+        return True
+
+    def _rebuildElementItems( self, top_element, element_set, elements_to_skip = None ):
+        """Replaces the items of top_element and its children by new ones."""
+        scene = self.__scene
+        self._removeElementItems( scene, top_element, element_set )
+        self._elements_to_skip = elements_to_skip or set()
+        self.__lines = []
+        self._addElements( scene, top_element, element_set, self._elements_to_skip )
+        self._addLines( scene )
+
+        # Select the new items if their element is selected
+        items = []
+        for child_element in top_element.getiterator():
+            item = self._items_by_element.get( child_element )
+            if item is not None:
+                items.append( item )
+                items.extend( qthelper.graphicsItemDescendants( item ) )
+        self._applySelection( items, self.__world.selected_elements )
+
+    def __on_images_loaded( self, image_ids ):
+        """Replaces the placeholders of the images decoded in the background."""
+        elements = set()
+        for image_id in image_ids:
+            elements.update( self._elements_by_loading_image.pop( image_id, () ) )
+        top_elements = {}
+        for element in elements:
+            if element.tree is None: # removed while loading
+                continue
+            top_element, element_set = self._findTopLevelElement( element )
+            if top_element is None or not self.incremental_refresh:
+                self.refreshFromModel( self._elements_to_skip )
+                return
+            top_elements[top_element] = element_set
+        for top_element, element_set in top_elements.iteritems():
+            self._rebuildElementItems( top_element, element_set, self._elements_to_skip )
+        if top_elements:
+            self._update_tools_handle()
+
+    def _findTopLevelElement( self, element ):
+        """Returns a tuple (top_element, element_set) where top_element is the
+           child of the level or scene root that contains 'element'.
+           Returns (None, None) if 'element' is a root or does not belong to the
+           level or scene tree.
+        """
+        parent = element.parent
+        if parent is None:
+            return None, None
+        while parent.parent is not None:
+            element, parent = parent, parent.parent
+        if parent is self.__world.level_root:
+            return element, self.__level_elements
+        if parent is self.__world.scene_root:
+            return element, self.__scene_elements
+        return None, None
+
+    def _removeElementItems( self, scene, element, element_set ):
+        """Removes the items of element and its children from the scene."""
+        # Notes: items parented to another item (composite geometry children...)
+        # are removed along with their parent.
+        for child_element in element.getiterator():
+            element_set.discard( child_element )
+            self._lod_items_by_element.pop( child_element, None )
+            item = self._items_by_element.pop( child_element, None )
+            if item is not None and item.parentItem() is None:
+                scene.removeItem( item )
+
+    def _addLines( self, scene ):
+        """Builds the items of the lines delayed by _addSceneLine()."""
         for element in self.__lines:
             item = self._sceneLineBuilder( scene, element )
             item.setData( KEY_ELEMENT, QtCore.QVariant( element ) )
             item.setFlag( QtGui.QGraphicsItem.ItemIsSelectable, True )
             self._items_by_element[element] = item
-
-        # Select currently selected item if any
-        self._on_selection_change( self.__world.selected_elements, set(), set() )
+        self.__lines = []
 
     def get_element_state( self, elementtype ):
         try:
@@ -2145,12 +2301,39 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         item.setZValue( Z_PHYSIC_ITEMS )
         item.setPos( x, y )
 
-    def getImagePixmap( self, image_id ):
-        """Returns the image pixmap for the specified image id."""
+    def getImagePixmap( self, image_id, colorize = None, lod = 0 ):
+        """Returns the image pixmap for the specified image id.
+           colorize: optional (red,green,blue) factors applied to the pixmap.
+           lod: mip level of the pixmap, see _imageLod().
+           None is returned if the image is being decoded in the background
+           (see isImageLoading()).
+        """
         if image_id is not None:
-            return self.__world.getImagePixmap( image_id )
+            return self.__world.getImagePixmap( image_id, colorize,
+                                                self.background_image_loading, lod )
         return None
 
+    def isImageLoading( self, image_id ):
+        return image_id is not None and self.__world.isImageLoading( image_id )
+
+    def _addImagePlaceholder( self, scene, element, image_id, x, y, rotation, scalex, scaley, depth ):
+        """Adds a rectangle the size of the image displayed until the image
+           decoded in the background is available.
+        """
+        self._elements_by_loading_image.setdefault( image_id, set() ).add( element )
+        size = self.__world.getImageSize( image_id )
+        if size is not None:
+            width, height = size.width(), size.height()
+        else:
+            width, height = 100, 100
+        pen = QtGui.QPen( QtGui.QColor( 128, 128, 128 ) )
+        pen.setStyle( Qt.DashLine )
+        item = scene.addRect( 0, 0, width, height, pen, QtGui.QBrush( QtGui.QColor( 128, 128, 128, 64 ) ) )
+        item.setData( KEY_AREA , QtCore.QVariant( width * height * scalex * scaley ) )
+        item.setData( KEY_TYPE , QtCore.QVariant( element.tag ) )
+        self._applyTransform( item, width / 2.0, height / 2.0, x, y, rotation, scalex, scaley, depth )
+        return item
+
     def _levelCameraBuilder( self, scene, element ):
         x, y = self._elementV2Pos( element, 'endpos' )
         rotation = 0
@@ -2235,43 +2418,37 @@ class LevelGraphicView( QtGui.QGraphicsView ):
     def _sceneSceneLayerBuilder( self, scene, element ):
         depth = element.get_native( 'depth', 0.0 )
         image = element.get( 'image' )
+        x, y = self._elementV2Pos( element, 'center' )
+        rotation = element.get_native( 'rotation', 0.0 )
+        scalex, scaley = element.get_native( 'scale', ( 1.0, 1.0 ) )
+        alpha = element.get_native( 'alpha', 1.0 )
+        lod = self._imageLod( scalex, scaley )
         if image != '':
-            img = self.getImagePixmap( image )
+            colorize = element.get_native( 'colorize', ( 255, 255, 255 ) )
+            img = self.getImagePixmap( image, colorize, lod )
         else:
             img = None
 
         if img is not None:
-            colorize = element.get_native( 'colorize', ( 255, 255, 255 ) )
-            if colorize[0] != 255 or colorize[1] != 255 or colorize[2] != 255:
-                img = img.copy()
-                w = img.width()
-                for y in xrange( img.height() ):
-                    pixels = img.scanLine( y )
-                    pixels.setsize( 4 * w )
-                    colors = list( struct.unpack( 'I' * w, pixels ) )
-                    for x, c in enumerate( colors ):
-                        colors[ x ] = QtGui.qRgba( 
-                                        QtGui.qRed( c ) * colorize[0] / 255,
-                                        QtGui.qGreen( c ) * colorize[1] / 255,
-                                        QtGui.qBlue( c ) * colorize[2] / 255,
-                                        QtGui.qAlpha( c )
-                                        )
-                    pixels[:] = struct.pack( 'I' * w, *colors )
             pixmap = QtGui.QPixmap.fromImage( img )
         else:
             pixmap = None
 
-        x, y = self._elementV2Pos( element, 'center' )
-        rotation = element.get_native( 'rotation', 0.0 )
-        scalex, scaley = element.get_native( 'scale', ( 1.0, 1.0 ) )
-        alpha = element.get_native( 'alpha', 1.0 )
-        if pixmap is not None:
+        if pixmap is None and self.isImageLoading( image ):
+            item = self._addImagePlaceholder( scene, element, image, x, y, rotation,
+                                              scalex, scaley, depth )
+        elif pixmap is not None:
+            size = pixmap.size()
+            if lod > 0:
+                size = self.__world.getImageSize( image ) or size
             item = scene.addPixmap( pixmap )
-            item.setData( KEY_AREA , QtCore.QVariant( pixmap.height()*pixmap.width()*scalex * scaley ) )
+            item.setData( KEY_AREA , QtCore.QVariant( size.height()*size.width()*scalex * scaley ) )
             item.setData( KEY_TYPE , QtCore.QVariant( element.tag ) )
             item.setTransformationMode( Qt.SmoothTransformation )
-            self._applyPixmapTransform( item, pixmap, x, y, rotation, scalex, scaley, depth )
+            transform = ( x, y, rotation, scalex, scaley, depth )
+            self._applyLodPixmapTransform( item, pixmap, size, *transform )
             item.setOpacity( alpha )
+            self._lod_items_by_element[element] = ( item, image, colorize, lod, size, transform )
         else:
             pen = QtGui.QPen( QtGui.QColor( 255, 0, 0 ) )
             pen.setWidth( 4 )
@@ -2281,6 +2458,48 @@ class LevelGraphicView( QtGui.QGraphicsView ):
             self._applyTransform( item, 50, 50, x, y, rotation, 1.0, 1.0, Z_PHYSIC_ITEMS )
         return item
 
+    def _viewScale( self ):
+        return self.matrix().mapRect( QtCore.QRectF( 0, 0, 1, 1 ) ).width()
+
+    def _imageLod( self, scalex, scaley ):
+        """Returns the mip level matching the display size of an image scaled
+           by scalex, scaley at the current view scale. Level 0 is the full
+           resolution image, level n is downscaled by 2^n.
+        """
+        if not self.image_lod:
+            return 0
+        scale = self._viewScale() * max( abs( scalex ), abs( scaley ) )
+        lod = 0
+        while lod < MAX_IMAGE_LOD and scale * 2 ** ( lod + 1 ) <= 1.0:
+            lod += 1
+        return lod
+
+    def _updateImageLods( self ):
+        """Swaps the pixmap of the image items whose mip level no longer
+           matches the view scale.
+        """
+        for element, lod_item in self._lod_items_by_element.items():
+            item, image, colorize, lod, size, transform = lod_item
+            new_lod = self._imageLod( transform[3], transform[4] )
+            if new_lod == lod:
+                continue
+            img = self.getImagePixmap( image, colorize, new_lod )
+            if img is None: # not available yet, keep the current mip level
+                continue
+            pixmap = QtGui.QPixmap.fromImage( img )
+            item.setPixmap( pixmap )
+            self._applyLodPixmapTransform( item, pixmap, size, *transform )
+            self._lod_items_by_element[element] = ( item, image, colorize, new_lod, size, transform )
+
+    @staticmethod
+    def _applyLodPixmapTransform( item, pixmap, size, x, y, rotation, scalex, scaley, depth ):
+        """Applies the transform of a full resolution image of the specified size
+           to a pixmap item displaying one of its mip levels.
+        """
+        scalex *= size.width() / float( pixmap.width() )
+        scaley *= size.height() / float( pixmap.height() )
+        LevelGraphicView._applyPixmapTransform( item, pixmap, x, y, rotation, scalex, scaley, depth )
+
     @staticmethod
     def _applyPixmapTransform( item, pixmap, x, y, rotation, scalex, scaley, depth ):
         LevelGraphicView._applyTransform( item, pixmap.width() / 2.0, pixmap.height() / 2.0,
@@ -2311,6 +2530,9 @@ class LevelGraphicView( QtGui.QGraphicsView ):
         rotation = element.get_native( 'rotation', 0.0 )
         scalex, scaley = element.get_native( 'scale', ( 1.0, 1.0 ) )
         pixmap = self.getImagePixmap( element.get( 'up' ) )
+        if pixmap is None and self.isImageLoading( element.get( 'up' ) ):
+            return self._addImagePlaceholder( scene, element, element.get( 'up' ), x, y, rotation,
+                                              scalex, scaley, depth )
         if pixmap:
             item = scene.addPixmap( pixmap )
             item.setData( KEY_AREA , QtCore.QVariant( pixmap.height()*pixmap.width()*scalex * scaley ) )
@@ -2575,9 +2797,54 @@ class LevelGraphicView( QtGui.QGraphicsView ):
                               1.0, 1.0, Z_LEVEL_ITEMS + 10 )
         return item
 
+def benchmark_refresh( element_count = 2000, iterations = 20 ):
+    """Measures the time taken by the view to reflect an attribute change on a
+       synthetic level made of element_count rectangles, using a full rebuild
+       and an incremental refresh.
+    """
+    import sys
+    import time
+    import metawog
+    import wogeditor
+    app = QtGui.QApplication( sys.argv ) #@UnusedVariable
+    universe = metaworld.Universe()
+    game_world = universe.make_world( metawog.WORLD_GLOBAL, 'game' )
+    world = game_world.make_world( metawog.WORLD_LEVEL, 'benchmark', wogeditor.LevelWorld, None )
+    rectangles = ['<rectangle id="r%d" center="%d,%d" size="20,10" rotation="0" />' %
+                  ( index, ( index % 50 ) * 40, ( index / 50 ) * 40 )
+                  for index in xrange( element_count )]
+    world.make_tree_from_xml( metawog.TREE_LEVEL_GAME, metawog.LEVEL_GAME_TEMPLATE )
+    world.make_tree_from_xml( metawog.TREE_LEVEL_SCENE,
+        '<scene minx="-500" miny="-500" maxx="2500" maxy="2500">%s</scene>' % ''.join( rectangles ) )
+    world.make_tree_from_xml( metawog.TREE_LEVEL_RESOURCE, metawog.LEVEL_RESOURCE_TEMPLATE )
+    view = LevelGraphicView( world, {}, {} )
+    element = world.scene_root[element_count / 2]
+    previous_cache_native_values = metaworld.CACHE_NATIVE_VALUES
+    try:
+        # without cache first: the elements keep their cache once created
+        for cache_native_values in ( False, True ):
+            metaworld.CACHE_NATIVE_VALUES = cache_native_values
+            for incremental in ( False, True ):
+                view.incremental_refresh = incremental
+                start_time = time.clock()
+                for index in xrange( iterations ):
+                    element.set( 'center', '%d,0' % index )
+                elapsed = time.clock() - start_time
+                print '%s refresh%s: %.2fms per update (%d elements)' % (
+                    incremental and 'Incremental' or 'Full',
+                    cache_native_values and ' with native values cache' or '',
+                    elapsed * 1000.0 / iterations, element_count )
+    finally:
+        metaworld.CACHE_NATIVE_VALUES = previous_cache_native_values
+
 if __name__ == "__main__":
+    import sys
     import unittest #@UnresolvedImport
 
+    if sys.argv[1:] == ['benchmark']:
+        benchmark_refresh()
+        sys.exit( 0 )
+
     class VectorTest( unittest.TestCase ):
 
         def test_angle( self ):
@@ -10,6 +10,7 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
         QtGui.QStandardItemModel.__init__( self, 0, 2, *args ) # nb rows, nb columns
         self._metaworld_tree = None
         self._meta_tree = meta_tree
+        self._items_by_element = {} # dict(element: row item at column 0)
         self._setHeaders()
         self._issue_tracker = None
         self._icons_by_group = icons_by_group
@@ -50,6 +51,9 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
             louie.disconnect( self._on_element_issues_updated,
                               metaworldui.ElementIssuesUpdated,
                               self._metaworld_tree.world )
+            louie.disconnect( self._onElementsChanged,
+                              metaworld.ElementsChanged,
+                              self._metaworld_tree.world )
         self._metaworld_tree = tree
         self._issue_tracker = tree is not None and tree.world or None
         if tree is not None:
@@ -59,13 +63,18 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
             louie.connect( self._on_element_issues_updated,
                            metaworldui.ElementIssuesUpdated,
                            self._metaworld_tree.world )
+            louie.connect( self._onElementsChanged,
+                           metaworld.ElementsChanged,
+                           self._metaworld_tree.world )
             self._refreshTreeRoot()
         else:
             self.clear()
+            self._items_by_element = {}
 
     def _refreshTreeRoot( self ):
         # refresh items
         self.clear()
+        self._items_by_element = {}
         self._setHeaders()
         #if self._metaworld_tree.root:
         self._insertElementTreeInTree( self, self._metaworld_tree.root )
@@ -75,6 +84,8 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
                                          self.tr( 'Id or Name' )] )
 
     def _onElementAdded( self, element, index_in_parent ):
+        if self._metaworld_tree.world.is_batching_changes:
+            return
         if element.parent is None:
             self._refreshTreeRoot()
         else:
@@ -89,6 +100,8 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
 
     def _onElementUpdated( self, element, attribute_name, new_value, old_value ): #IGNORE:W0613
         """Updates id/name column if one of those attributes changed."""
+        if self._metaworld_tree.world.is_batching_changes:
+            return
         if element.tree == self.metaworld_tree:
             attribute_meta = element.meta.attribute_by_name( attribute_name )
             assert attribute_meta is not None
@@ -99,14 +112,71 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
                     name_item.setText( new_value or '' )
 
     def _onElementAboutToBeRemoved( self, element, index_in_parent ): #IGNORE:W0613
+        if self._metaworld_tree.world.is_batching_changes:
+            return
         item = self._findItemByElement( element )
         if item is not None:
             item_row = item.row()
             if item.parent() is not None:
+                self._forgetItems( item )
                 item.parent().removeRow( item_row )
 
         # Notes: selection will be automatically switched to the previous row in the tree view.
 
+    def _onElementsChanged( self, changes ):
+        """Updates the rows of all the elements modified by a batch of changes.
+           The children rows of each modified parent are synchronized only once.
+        """
+        modified_parents = set()
+        updated_elements = set()
+        for change in changes:
+            element = change[1]
+            if change[0] == metaworld.ELEMENT_ATTRIBUTE_UPDATED:
+                updated_elements.add( element )
+            else:
+                if change[0] == metaworld.ELEMENT_ADDED:
+                    parent = element.parent
+                else:
+                    parent = change[2]
+                if parent is None:  # root changed
+                    self._refreshTreeRoot()
+                    return
+                modified_parents.add( parent )
+        for parent in modified_parents:
+            if parent.tree == self.metaworld_tree:
+                parent_item = self._findItemByElement( parent )
+                if parent_item is not None:
+                    self._synchronizeChildRows( parent_item, parent )
+                    self._issue_tracker._check_element( parent, set() )
+                    self._refresh_item( parent_item, parent )
+        for element in updated_elements:
+            if element.tree == self.metaworld_tree:
+                item = self._findItemByElement( element )
+                if item is not None:
+                    name_item = qthelper.get_row_item_sibling( item, 1 )
+                    if name_item is not None:
+                        name_item.setText( element.get_display_id() )
+
+    def _synchronizeChildRows( self, parent_item, parent ):
+        """Makes the children rows of parent_item match the children of parent.
+           Existing rows are kept (moved if required) so that their expanded state is preserved.
+        """
+        children = set( parent )
+        for row in xrange( parent_item.rowCount() - 1, -1, -1 ):
+            if self.get_item_element( parent_item.child( row ) ) not in children:
+                self._forgetItems( parent_item.child( row ) )
+                parent_item.removeRow( row )
+        for index, child_element in enumerate( parent ):
+            item = parent_item.child( index )
+            if item is not None and self.get_item_element( item ) is child_element:
+                continue
+            for row in xrange( index + 1, parent_item.rowCount() ):
+                if self.get_item_element( parent_item.child( row ) ) is child_element:
+                    parent_item.insertRow( index, parent_item.takeRow( row ) )
+                    break
+            else:
+                self._insertElementTreeInTree( parent_item, child_element, index )
+
     def get_item_element( self, item ):
         data = item.data( Qt.UserRole )
         if data.isValid():
@@ -121,12 +191,16 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
         """Returns the tree view item corresponding to the specified element.
            None if the element is not in the tree.
         """
-        for item in qthelper.standardModelTreeItems( self ):
-            telement = self.get_item_element( item )
-            if telement is not None:
-                if telement is element:
-                    return item
-        return None
+        return self._items_by_element.get( element )
+
+    def _forgetItems( self, item ):
+        """Removes item and all its children rows from the element index.
+           Must be called before the item row is removed from the model.
+        """
+        for row_item in qthelper.standardModelTreeItems( self, item.index() ):
+            element = self.get_item_element( row_item )
+            if self._items_by_element.get( element ) is row_item:
+                del self._items_by_element[element]
 
     def _insertElementTreeInTree( self, item_parent, element, index = None ):
         """Inserts a sub-tree of item in item_parent at the specified index corresponding to the tree of the specified element.
@@ -158,6 +232,7 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
                 self._refresh_item( item, element )
             items.append( item )
         item_parent.insertRow( index, items )
+        self._items_by_element[element] = items[0]
         return items[0]
 
     def _refresh_item( self, item, element ):
@@ -174,10 +249,9 @@ class MetaWorldTreeModel( QtGui.QStandardItemModel ):
             item.setToolTip( '' )
 
     def _on_element_issues_updated( self, elements ):
-        for item in qthelper.standardModelTreeItems( self ):
-            element = self.get_item_element( item )
-            if element is not None:
-              if element in elements:
+        for element in elements:
+            item = self._items_by_element.get( element )
+            if item is not None:
                 self._refresh_item( item, element )
 
 class MetaWorldTreeView( QtGui.QTreeView ):
@@ -20,6 +20,15 @@ Object description can define constraint such as the minimum or maximum number o
 Attribute description can indicate if the attribute is mandatory, its value domain, typical initial value, type...
 """
 import xml.etree.ElementTree
+import xml.etree.ElementPath
+import xml.parsers.expat
+try:
+    import xml.etree.cElementTree as _fast_element_tree
+except ImportError:
+    _fast_element_tree = xml.etree.ElementTree
+import contextlib
+import itertools
+import cStringIO
 # Publish/subscribe framework
 # See http://louie.berlios.de/ and http://pydispatcher.sf.net/
 import louie
@@ -28,8 +37,20 @@ import yaml
 
 # get rid of !!python/unicode tags if string is ASCII-convertible
 yaml.add_representer( unicode, lambda dumper, value: dumper.represent_scalar( u'tag:yaml.org,2002:str', value ) )
+# Use the libyaml based parser and emitter if PyYAML was built with them
+try:
+    from yaml import CSafeLoader as YamlLoader, CSafeDumper as YamlDumper
+except ImportError:
+    from yaml import SafeLoader as YamlLoader, SafeDumper as YamlDumper
 
 AMY_PATH = ''
+# Build trees in a single iterparse pass using the precompiled attribute
+# mapping of each ElementMeta. If False, the whole document is parsed first
+# then converted element by element.
+FAST_XML_LOADING = True
+# Cache the attribute values converted by Element.get_native() until the
+# attribute is set or unset. If False, they are converted on each call.
+CACHE_NATIVE_VALUES = True
 # Different type of attributes
 
 BOOLEAN_TYPE = 'boolean'
@@ -52,7 +73,17 @@ REFERENCE_TYPE = 'reference'
 IDENTIFIER_TYPE = 'identifier'
 PATH_TYPE = 'path'
 
+# Maximum number of raw values whose validation status is cached per attribute
+VALIDATION_CACHE_SIZE = 1024
+
+_NOT_VALIDATED = object() # marks raw values missing from the validation cache
+_NOT_CONVERTED = object() # marks attributes missing from the native values cache
+
 class AttributeMeta( object ):
+    # True if the validation status only depends on the raw value, and
+    # can be cached (not the case of references and paths)
+    cache_validation = True
+
     def __init__( self, name, attribute_type, init = None, default = None,
                   allow_empty = False, mandatory = False, display_id = False,
                   map_to = None, remove_empty = False, read_only = False, tooltip = None, min_length = None, category = None ):
@@ -75,7 +106,8 @@ class AttributeMeta( object ):
         self.map_to = map_to or self.name
         self.tooltip = tooltip
         self.category = category
-
+        self._validator = None # compiled on first validation
+        self._validated_values = {} # dict(raw value: validation status)
 
     def attach_to_element_meta( self, element_meta ):
         self.element_meta = element_meta
@@ -129,9 +161,13 @@ class AttributeMeta( object ):
            Returns default if the value is not convertible in the native type or not
            set.
         """
-        raw = self.get( element )
-        if raw is None:
-            return default
+        return element.get_native( self.name, default )
+
+    def native_from_raw( self, raw ):
+        """Returns the raw value converted to its python native type, or None
+           if it is not set or not convertible. Lists of components are
+           returned as tuple.
+        """
         return raw
 
     def set_native( self, element, value ):
@@ -139,22 +175,57 @@ class AttributeMeta( object ):
         assert value is not None
         self.set( element, str( value ) )
 
-    def is_valid_value( self, value, world ): #IGNORE:W0613
+    def is_valid_value( self, value, world ):
         """Checks if the specified attribute is valid on this element.
            Returns tuple (message, args) if the value is not valid. 
            The message should be formatted as follow: message % args.
            Returns None if the value is valid.
         """
-        if value is None:
-            if self.mandatory:
-                return ( 'mandatory attribute is missing', () )
+        status = self._validated_values.get( value, _NOT_VALIDATED )
+        if status is _NOT_VALIDATED:
+            status = self.get_validator()( value, world )
+            if self.cache_validation:
+                if len( self._validated_values ) >= VALIDATION_CACHE_SIZE:
+                    self._validated_values.clear()
+                self._validated_values[value] = status
+        return status
+
+    def get_validator( self ):
+        """Returns the function( value, world ) implementing is_valid_value()
+           without caching, compiled on first call.
+        """
+        if self._validator is None:
+            self._validator = self._compile_validator()
+        return self._validator
+
+    def _compile_validator( self ):
+        """Returns a function( value, world ) checking the mandatory, empty
+           and minimum length constraints, then non empty values with the
+           function returned by _compile_value_validator().
+        """
+        missing_status = self.mandatory and ( 'mandatory attribute is missing', () ) or None
+        empty_status = not self.allow_empty and ( 'empty value not allowed', () ) or None
+        min_length = self.min_length or 0
+        min_length_status = ( 'minimum length = ' + `self.min_length`, () )
+        if empty_status is None and min_length > 0:
+            empty_status = min_length_status
+        validate_value = self._compile_value_validator()
+        def validate( value, world ):
+            if value is None:
+                return missing_status
+            if not value:
+                return empty_status
+            if len( value ) < min_length:
+                return min_length_status
+            if validate_value is not None:
+                return validate_value( value, world )
             return None
-        if not value and not self.allow_empty:
-            return ( 'empty value not allowed', () )
-        if not self.min_length is None:
-            if len( value ) < self.min_length:
-                return ( 'minimum length = ' + `self.min_length`, () )
+        return validate
 
+    def _compile_value_validator( self ):
+        """Returns a function( value, world ) checking a non empty value,
+           or None if any value is valid.
+        """
         return None
 
     def __repr__( self ):
@@ -184,19 +255,17 @@ class ComponentsAttributeMeta( AttributeMeta ):
         else:
             self.error_messages = error_messages
 
-    def get_native( self, element, default = None ):
-        raw = self.get( element )
+    def native_from_raw( self, raw ):
         if raw is None:
-            return default
-        components = raw.split( ',' )
+            return None
         try:
-            native_values = [ self._get_native_component( component )
-                              for component in components ]
-            if len( native_values ) < self.min_components:
-                return default
-            return native_values
+            native_values = tuple( [ self._get_native_component( component )
+                                     for component in raw.split( ',' ) ] )
         except ValueError:
-            return default
+            return None
+        if len( native_values ) < self.min_components:
+            return None
+        return native_values
 
     def _get_native_component( self, component ):
         """Returns a component converted to its python native type.
@@ -284,37 +353,53 @@ class ComponentsAttributeMeta( AttributeMeta ):
                         break
                     attributes_by_name[name] = values[index]
 
-    def  is_valid_value( self, text, world ): #IGNORE:W0613
-        status = AttributeMeta.is_valid_value( self, text, world )
-        if status is None and text:
-            values = text.split( ',' )
-            nb_components = len( values )
-            if nb_components < self.min_components:
-                message = self.error_messages.get( 'missing' )
-                if not message:
-                    message = 'Value must have at least %(nb)d components. ' \
-                              'Components are separated by a comma: ",".'
-                return message, {'nb':self.min_components}
-            if self.max_components is not None and nb_components > self.max_components:
-                if self.error_messages:
-                    message = self.error_messages.get( 'extra' )
-                else:
-                    message = None
-                if not message:
-                    if self.max_components == 1:
-                        message = 'Value must be a single item, it cannot be a list.'
-                    else:
-                        message = 'Value must have no more than %(nb)d components. ' \
-                              'Components are separated by a comma: ",".'
-                return message, {'nb':self.min_components}
-            for index, component in enumerate( values ):
-                status = self._is_component_valid( index, component, world )
-                if status is not None:
-                    break
-        return status
+    def _compile_value_validator( self ):
+        min_components = self.min_components or 0
+        max_components = self.max_components
+        error_messages = self.error_messages or {}
+        message = error_messages.get( 'missing' )
+        if not message:
+            message = 'Value must have at least %(nb)d components. ' \
+                      'Components are separated by a comma: ",".'
+        missing_status = ( message, {'nb':self.min_components} )
+        message = error_messages.get( 'extra' )
+        if not message:
+            if max_components == 1:
+                message = 'Value must be a single item, it cannot be a list.'
+            else:
+                message = 'Value must have no more than %(nb)d components. ' \
+                          'Components are separated by a comma: ",".'
+        extra_status = ( message, {'nb':self.min_components} )
+        validate_component = self._compile_component_validator()
+        if max_components == 1:
+            # single component: avoid splitting the value
+            def validate( text, world ):
+                if ',' in text:
+                    return extra_status
+                if validate_component is not None:
+                    return validate_component( 0, text, world )
+                return None
+            return validate
+        def validate( text, world ):
+            components = text.split( ',' )
+            nb_components = len( components )
+            if nb_components < min_components:
+                return missing_status
+            if max_components is not None and nb_components > max_components:
+                return extra_status
+            if validate_component is not None:
+                for index, component in enumerate( components ):
+                    status = validate_component( index, component, world )
+                    if status is not None:
+                        return status
+            return None
+        return validate
 
-    def _is_component_valid( self, index, component, world ):
-        raise NotImplemented()
+    def _compile_component_validator( self ):
+        """Returns a function( index, component, world ) checking a
+           component of the value, or None if any component is valid.
+        """
+        return None
 
 
 class NumericAttributeMeta( AttributeMeta ):
@@ -327,27 +412,31 @@ class NumericAttributeMeta( AttributeMeta ):
         self.value_type = value_type # python type of the value
         self.value_type_error = value_type_error # error message on bad value type
 
-    def get_native( self, element, default = None ):
+    def native_from_raw( self, raw ):
+        if raw is None:
+            return None
         try:
-            raw = self.get( element )
-            if raw is not None:
-                return self.value_type( raw )
-            return default
+            return self.value_type( raw )
         except ValueError:
-            return default
+            return None
 
-    def  is_valid_value( self, value, world ): #IGNORE:W0613
-        status = AttributeMeta.is_valid_value( self, value, world )
-        if status is None and value:
+    def _compile_value_validator( self ):
+        value_type = self.value_type
+        min_value, max_value = self.min_value, self.max_value
+        type_status = ( self.value_type_error, () )
+        min_status = ( 'Value must be >= %(v)s', {'v':str( min_value )} )
+        max_status = ( 'Value must be <= %(v)s', {'v':str( max_value )} )
+        def validate( text, world ): #IGNORE:W0613
             try:
-                value = self.value_type( str( value ) )
-                if self.min_value is not None and value < self.min_value:
-                    return 'Value must be >= %(v)s', {'v':str( self.min_value )}
-                if self.max_value is not None and value > self.max_value:
-                    return 'Value must be <= %(v)s', {'v':str( self.max_value )}
+                value = value_type( text )
             except ValueError:
-                return self.value_type_error, ()
-        return status
+                return type_status
+            if min_value is not None and value < min_value:
+                return min_status
+            if max_value is not None and value > max_value:
+                return max_status
+            return None
+        return validate
 
 class ColorAttributeMeta( ComponentsAttributeMeta ):
     def __init__( self, name, attribute_type, components, **kwargs ):
@@ -363,16 +452,21 @@ class ColorAttributeMeta( ComponentsAttributeMeta ):
         """
         return int( component )
 
-    def  _is_component_valid( self, index, component, world ): #IGNORE:W0613
+    def _compile_component_validator( self ):
         components = self.min_components == 3 and 'RGB' or 'ARGB'
-        try:
-            value = float( component )
+        range_statuses = [ ( '%(type)s color component "%(c)s" must be in range [0-255].', {
+                             'c':component, 'type':components} )
+                           for component in components ]
+        type_status = ( self.error_messages['missing'], {} )
+        def validate( index, component, world ): #IGNORE:W0613
+            try:
+                value = float( component )
+            except ValueError:
+                return type_status
             if value < 0 or value > 255:
-                return '%(type)s color component "%(c)s" must be in range [0-255].', {
-                    'c':components[index], 'type':components}
-        except ValueError:
-            return self.error_messages['missing'], {}
-        return None
+                return range_statuses[index]
+            return None
+        return validate
 
 class Vector2DAttributeMeta( ComponentsAttributeMeta ):
     def __init__( self, name, attribute_type, min_value = None, position = False, **kwargs ):
@@ -388,14 +482,19 @@ class Vector2DAttributeMeta( ComponentsAttributeMeta ):
         """
         return float( component )
 
-    def  _is_component_valid( self, index, component, world ): #IGNORE:W0613
-        try:
-            value = float( component )
-            if self.min_value and value < self.min_value:
-                return 'Component must be >= %(min_value)g', {'min_value':self.min_value}
+    def _compile_component_validator( self ):
+        min_value = self.min_value
+        min_status = ( 'Component must be >= %(min_value)g', {'min_value':min_value} )
+        type_status = ( self.error_messages['missing'], {} )
+        def validate( index, component, world ): #IGNORE:W0613
+            try:
+                value = float( component )
+            except ValueError:
+                return type_status
+            if min_value and value < min_value:
+                return min_status
             return None
-        except ValueError:
-            return self.error_messages['missing'], {}
+        return validate
 
 class RealListAttributeMeta( ComponentsAttributeMeta ):
     def __init__( self, name, attribute_type, min_value = None, position = False, error_message = '', **kwargs ):
@@ -409,14 +508,19 @@ class RealListAttributeMeta( ComponentsAttributeMeta ):
         """
         return float( component )
 
-    def  _is_component_valid( self, index, component, world ): #IGNORE:W0613
-        try:
-            value = float( component )
-            if self.min_value and value < self.min_value:
-                return 'Component must be >= %(min_value)g', {'min_value':self.min_value}
+    def _compile_component_validator( self ):
+        min_value = self.min_value
+        min_status = ( 'Component must be >= %(min_value)g', {'min_value':min_value} )
+        type_status = ( self.error_messages['missing'], {} )
+        def validate( index, component, world ): #IGNORE:W0613
+            try:
+                value = float( component )
+            except ValueError:
+                return type_status
+            if min_value and value < min_value:
+                return min_status
             return None
-        except ValueError:
-            return self.error_messages['missing'], {}
+        return validate
 
 class EnumeratedAttributeMeta( ComponentsAttributeMeta ):
     def __init__( self, name, values, attribute_type = ENUMERATED_TYPE, allow_any = False,
@@ -432,30 +536,34 @@ class EnumeratedAttributeMeta( ComponentsAttributeMeta ):
         self.is_list = is_list
         self.allow_any = allow_any
 
-    def get_native( self, element, default = None ):
-        res = ComponentsAttributeMeta.get_native( self, element, default )
+    def native_from_raw( self, raw ):
+        res = ComponentsAttributeMeta.native_from_raw( self, raw )
         return res if res is None or len( res ) != 1 else res[0]
 
-    def  _is_component_valid( self, index, component, world ): #IGNORE:W0613
+    def _compile_component_validator( self ):
         if self.allow_any:
             return None
-        if component not in self.values:
-            return 'Invalid %(enum)s value: "%(values)s"', {
-                'enum':self.name,
-                'values':','.join( self.values ) }
+        values = frozenset( self.values )
+        invalid_status = ( 'Invalid %(enum)s value: "%(values)s"', {
+                           'enum':self.name,
+                           'values':','.join( self.values ) } )
+        def validate( index, component, world ): #IGNORE:W0613
+            if component not in values:
+                return invalid_status
+            return None
+        return validate
 
 class BooleanAttributeMeta( EnumeratedAttributeMeta ):
     def __init__( self, name, **kwargs ):
         EnumeratedAttributeMeta.__init__( self, name, ( 'true', 'false' ),
                                           attribute_type = BOOLEAN_TYPE, **kwargs )
 
-    def get_native( self, element, default = None ):
-        raw = self.get( element )
+    def native_from_raw( self, raw ):
         if raw == 'true':
             return True
         elif raw == 'false':
             return False
-        return default
+        return None
 
     def from_yaml( self, element, attributes_by_name ):
         """Set attributes values in attributes_by_name using xml_element attributes
@@ -468,6 +576,8 @@ class BooleanAttributeMeta( EnumeratedAttributeMeta ):
             attributes_by_name[self.name] = 'true' if value else 'false'
 
 class ReferenceAttributeMeta( ComponentsAttributeMeta ):
+    cache_validation = False # depends on the identifiers defined in the world
+
     def __init__( self, name, reference_family, reference_world, is_list = False,
                   **kwargs ):
         if is_list and 'allow_empty' not in kwargs:
@@ -484,12 +594,15 @@ class ReferenceAttributeMeta( ComponentsAttributeMeta ):
         AttributeMeta.attach_to_element_meta( self, element_meta )
         element_meta._add_reference_attribute( self )
 
-    def  _is_component_valid( self, index, component, world ): #IGNORE:W0613
-        if not world.is_valid_attribute_reference( self, component ):
-            return ( '"%(v)s" is not a valid reference to an element of type %(family)s',
-                     { 'v':component,
-                       'family':self.reference_family } )
-        return None
+    def _compile_component_validator( self ):
+        reference_world, reference_family = self.reference_world, self.reference_family
+        def validate( index, component, world ): #IGNORE:W0613
+            if world.universe.resolve_reference( world, reference_world, reference_family, component ) is None:
+                return ( '"%(v)s" is not a valid reference to an element of type %(family)s',
+                         { 'v':component,
+                           'family':reference_family } )
+            return None
+        return validate
 
 class IdentifierAttributeMeta( AttributeMeta ):
     def __init__( self, name, reference_family, reference_world, **kwargs ):
@@ -503,6 +616,8 @@ class IdentifierAttributeMeta( AttributeMeta ):
 
 
 class PathAttributeMeta( AttributeMeta ):
+    cache_validation = False # depends on the files on disk
+
     def __init__( self, name, strip_extension = None, **kwargs ):
         AttributeMeta.__init__( self, name, PATH_TYPE, **kwargs )
         self.strip_extension = strip_extension
@@ -531,14 +646,14 @@ class PathAttributeMeta( AttributeMeta ):
         else:
             return path
 
-    def is_valid_value( self, text, world ): #IGNORE:W0613
-        status = AttributeMeta.is_valid_value( self, text, world )
-        if status is None and text:
+    def _compile_value_validator( self ):
+        def validate( text, world ): #IGNORE:W0613
             filename = os.path.normpath( os.path.join( AMY_PATH, self._clean_path( text ) + self.strip_extension ) )
             if not os.path.isfile( filename ):
                 message = 'File not found : ' + filename
                 return message, {}
-        return status
+            return None
+        return validate
 
 def bool_attribute( name, **kwargs ):
     return BooleanAttributeMeta( name, **kwargs )
@@ -682,6 +797,8 @@ class ElementMeta( ObjectsMetaOwner ):
     def __init__( self, tag, elements_meta = None, attributes = None,
                   min_occurrence = None, max_occurrence = None,
                   read_only = False, groups = None ):
+        self._xml_plan = None
+        self._yaml_plan = None
         ObjectsMetaOwner.__init__( self, elements_meta = elements_meta or [] )
         self.tag = tag
         attributes = attributes or []
@@ -709,6 +826,8 @@ class ElementMeta( ObjectsMetaOwner ):
             self.attributes_by_name[attribute.name] = attribute
             attribute.attach_to_element_meta( self )
         self.attributes_order.extend( attributes )
+        self._xml_plan = None
+        self._yaml_plan = None
 
     def _add_reference_attribute( self, attribute_meta ):
         assert attribute_meta not in self.reference_attributes
@@ -726,6 +845,8 @@ class ElementMeta( ObjectsMetaOwner ):
 
     def _element_added( self, element_meta ):
         element_meta.parent_elements.add( self )
+        self._xml_plan = None
+        self._yaml_plan = None
 
     def attribute_by_name( self, attribute_name ):
         """Retrieves the attribute description for the specified attribute_name.
@@ -738,21 +859,86 @@ class ElementMeta( ObjectsMetaOwner ):
         """Returns the elements attribute ordered from most important to least one."""
         return self.attributes_order[:]
 
+    def _xml_loading_plan( self ):
+        """Returns the tuple (attribute_steps, child_metas_by_tag) used to build
+           elements from XML, compiled once from the attribute descriptions.
+           attribute_steps is a list of tuple (xml_names, name, setter):
+           - xml_names: the XML attribute name, or a tuple of names whose values
+             are joined as the components of the attribute (see
+             ComponentsAttributeMeta.from_xml()).
+           - setter: None if the value can be stored as is, otherwise the
+             AttributeMeta.set bound method that coerces the value.
+        """
+        if self._xml_plan is None:
+            attribute_steps = []
+            for attribute_meta in self.attributes_by_name.itervalues():
+                xml_names = attribute_meta.map_to
+                if xml_names == 'value': # element text, never read from the attributes
+                    continue
+                if not isinstance( xml_names, ( str, unicode ) ):
+                    xml_names = tuple( xml_names )
+                if type( attribute_meta ).set == AttributeMeta.set:
+                    setter = None
+                else:
+                    setter = attribute_meta.set
+                attribute_steps.append( ( xml_names, attribute_meta.name, setter ) )
+            self._xml_plan = ( attribute_steps, self.elements_by_tag.copy() )
+        return self._xml_plan
+
+    def _make_element_from_xml_attributes( self, xml_attributes, text, children, shared_values = None ):
+        """Creates an Element from the attributes dict of a XML element, using the
+           precompiled attribute mapping. Same as creating the Element with the
+           attributes mapped by AttributeMeta.from_xml(), but values that need
+           no coercion are stored directly.
+           children: list of unattached elements to parent to the new element.
+           shared_values: optional dict(value: value) used to store a single
+                          string object for values repeated in the document.
+        """
+        element = self.make_element_from_stored_values( {}, text, children )
+        attrib = element.attrib
+        for xml_names, name, setter in self._xml_loading_plan()[0]:
+            if isinstance( xml_names, tuple ):
+                values = [ xml_attributes.get( xml_name ) for xml_name in xml_names ]
+                if values.count( None ) == len( values ):
+                    continue
+                value = ','.join( [ component or '' for component in values ] )
+            else:
+                value = xml_attributes.get( xml_names )
+                if value is None:
+                    continue
+            if setter is None:
+                if shared_values is not None:
+                    value = shared_values.setdefault( value, value )
+                attrib[name] = value
+            else:
+                setter( element, value )
+        return element
+
+    def make_element_from_stored_values( self, attributes, text = None, children = None ):
+        """Creates an Element with attribute values as stored by an existing
+           Element (already coerced), so they are not set again one by one.
+           attributes: dict of (name, value), used as the element attributes dict.
+           children: list of unattached elements to parent to the new element.
+        """
+        element = Element( self, {}, None, text )
+        element.attrib = attributes
+        if children:
+            element._children = children
+            for child in children:
+                child._parent = element
+        return element
+
     def make_element_from_xml_element( self, xml_element, warning = None ):
         """Create an Element from a xml.tree.ElementTree.Element.
            Returns the created element. The element tag must match this meta element tag.
            warning: callable(message,arguments) => formatted using message % arguments
         """
         assert self.tag == xml_element.tag
-        # Map element attributes
-        known_attributes = {}
-        for attribute_meta in self.attributes_by_name.itervalues():
-            attribute_meta.from_xml( xml_element, known_attributes )
-
         # Map element children
+        child_metas_by_tag = self._xml_loading_plan()[1]
         children = []
         for xml_element_child in xml_element:
-            child_meta = self.find_immediate_child_by_tag( xml_element_child.tag )
+            child_meta = child_metas_by_tag.get( xml_element_child.tag )
             if child_meta:
                 element = child_meta.make_element_from_xml_element( xml_element_child,
                                                                     warning )
@@ -761,34 +947,81 @@ class ElementMeta( ObjectsMetaOwner ):
                 warning( u'Element %(tag)s, the following child tag missing in the element description: %(child)s.',
                          tag = xml_element.tag,
                          child = xml_element_child.tag )
-        return Element( self, attributes = known_attributes, children = children, text = xml_element.text )
+        return self._make_element_from_xml_attributes( xml_element.attrib, xml_element.text, children )
 
     def make_element_from_yaml_element( self, element, warning = None ):
         """Create an Element from a parsed YAML structure.
            Returns the created element. The element tag must match this meta element tag.
            warning: callable(message,arguments) => formatted using message % arguments
         """
-        # Map element attributes
-        known_attributes = {}
-        processed_keys = []
-        for attribute_meta in self.attributes_by_name.itervalues():
-            attribute_meta.from_yaml( element, known_attributes )
-            if isinstance( attribute_meta.map_to, ( tuple, list ) ):
-                processed_keys.extend( attribute_meta.map_to )
-            else:
-                processed_keys.append( attribute_meta.map_to )
-
+        attribute_steps, attribute_keys, child_metas_by_tag = self._yaml_loading_plan()
         # Map element children
         children = []
         for tag, el_list in element.iteritems():
-            child_meta = self.find_immediate_child_by_tag( tag )
+            child_meta = child_metas_by_tag.get( tag )
             if child_meta:
                 for element_child in el_list:
                     children.append( child_meta.make_element_from_yaml_element( element_child, warning ) )
-            elif tag not in processed_keys and warning is not None:
+            elif tag not in attribute_keys and warning is not None:
                 warning( u'Tag %(tag)s have no corresponding child Element in %(element)s',
                          tag = tag, element = self )
-        return Element( self, attributes = known_attributes, children = children, text = '' )
+
+        # Map element attributes
+        new_element = self.make_element_from_stored_values( {}, '', children )
+        attrib = new_element.attrib
+        for yaml_names, name, setter, from_yaml in attribute_steps:
+            if from_yaml is not None:
+                values = {}
+                from_yaml( element, values )
+                value = values.get( name )
+                if value is None:
+                    continue
+            elif isinstance( yaml_names, tuple ):
+                values = [ element.get( yaml_name ) for yaml_name in yaml_names ]
+                if values.count( None ) == len( values ):
+                    continue
+                value = ','.join( [ unicode( component ) if component is not None else ''
+                                    for component in values ] )
+            else:
+                value = element.get( yaml_names )
+                if value is None:
+                    continue
+                value = ','.join( map( unicode, value ) ) if isinstance( value, list ) else unicode( value )
+            if setter is None:
+                attrib[name] = value
+            else:
+                setter( new_element, value )
+        return new_element
+
+    def _yaml_loading_plan( self ):
+        """Returns the precompiled mapping of YAML keys to the element attributes
+           used by make_element_from_yaml_element(), as a tuple
+           (attribute_steps, attribute_keys, child_metas_by_tag) where:
+           - attribute_steps is a list of tuple (yaml_names, name, setter, from_yaml),
+             like the steps of _xml_loading_plan(). from_yaml is None if the
+             value is converted as by AttributeMeta.from_yaml() or
+             ComponentsAttributeMeta.from_yaml(), otherwise the overriding
+             from_yaml bound method.
+           - attribute_keys is the set of YAML keys mapped to attributes.
+        """
+        if self._yaml_plan is None:
+            attribute_steps = []
+            for xml_names, name, setter in self._xml_loading_plan()[0]:
+                attribute_meta = self.attributes_by_name[name]
+                from_yaml = type( attribute_meta ).from_yaml
+                if from_yaml in ( AttributeMeta.from_yaml, ComponentsAttributeMeta.from_yaml ):
+                    from_yaml = None
+                else:
+                    from_yaml = attribute_meta.from_yaml
+                attribute_steps.append( ( xml_names, name, setter, from_yaml ) )
+            attribute_keys = set()
+            for attribute_meta in self.attributes_by_name.itervalues():
+                if isinstance( attribute_meta.map_to, ( tuple, list ) ):
+                    attribute_keys.update( attribute_meta.map_to )
+                else:
+                    attribute_keys.add( attribute_meta.map_to )
+            self._yaml_plan = ( attribute_steps, attribute_keys, self._xml_loading_plan()[1] )
+        return self._yaml_plan
 
     def __repr__( self ):
         return '%s(tag=%s, attributes=[%s], elements=[%s])' % ( 
@@ -912,6 +1145,227 @@ def print_element_meta_tree( element, indent ):
         if child_element is not element:
             print_element_meta_tree( child_element, indent + '    ' )
 
+# XML
+
+class XmlWriter( object ):
+    """Writes Elements as XML into a file object, exactly as serialized by
+       xml.etree.ElementTree.tostring(), without building an intermediate
+       xml.etree tree or string: the XML is written by chunks of about
+       chunk_size pieces as the elements are visited.
+       pretty: if True, a new line is inserted between consecutive tags.
+       flush() must be called once the elements are written.
+    """
+    def __init__( self, output_file, encoding = 'utf-8', pretty = False, chunk_size = 8192 ):
+        self._output_file = output_file
+        self.encoding = encoding
+        self._separator = pretty and '\n' or ''
+        self.chunk_size = chunk_size
+        self._pending = []
+        self._escaped_values = {} # attribute value: escaped and encoded value
+        if encoding not in ( 'utf-8', 'us-ascii' ):
+            self._pending.append( "<?xml version='1.0' encoding='%s'?>\n" % encoding )
+
+    def write_element( self, element ):
+        """Writes the element and its children."""
+        attributes_by_name = {}
+        for attribute in element.meta.attributes_order:
+            attribute.to_xml( element, attributes_by_name )
+        tag = self._encode( element.meta.tag )
+        self._write_start_tag( tag, attributes_by_name )
+        pending = self._pending
+        text = element.text
+        if text or len( element ):
+            pending.append( '>' )
+            if text:
+                pending.append( self._escape_text( text ) )
+            for index, child in enumerate( element ):
+                if index or not text:
+                    pending.append( self._separator )
+                self.write_element( child )
+            if len( element ):
+                pending.append( self._separator )
+            pending.append( '</' + tag + '>' )
+        else:
+            pending.append( ' />' )
+        if len( pending ) >= self.chunk_size:
+            self.flush()
+
+    def write_wrapped_element( self, tag, attributes_by_name, element ):
+        """Writes a tag with the specified attributes containing only element."""
+        tag = self._encode( tag )
+        self._write_start_tag( tag, attributes_by_name )
+        self._pending.append( '>' + self._separator )
+        self.write_element( element )
+        self._pending.append( self._separator + '</' + tag + '>' )
+
+    def flush( self ):
+        """Writes the pending XML into the file object."""
+        self._output_file.write( ''.join( self._pending ) )
+        del self._pending[:] # write_element() holds a reference on the list
+
+    def _write_start_tag( self, tag, attributes_by_name ):
+        pending = self._pending
+        pending.append( '<' + tag )
+        escaped_values = self._escaped_values
+        for name in sorted( attributes_by_name ):
+            value = attributes_by_name[name]
+            escaped_value = escaped_values.get( value )
+            if escaped_value is None:
+                escaped_value = self._escape_attribute( value )
+                escaped_values[value] = escaped_value
+            pending.append( ' %s="%s"' % ( self._encode( name ), escaped_value ) )
+
+    def _encode( self, name ):
+        if isinstance( name, unicode ):
+            return name.encode( self.encoding )
+        return name
+
+    def _escape_text( self, text ):
+        if '&' in text:
+            text = text.replace( '&', '&amp;' )
+        if '<' in text:
+            text = text.replace( '<', '&lt;' )
+        if '>' in text:
+            text = text.replace( '>', '&gt;' )
+        return text.encode( self.encoding, 'xmlcharrefreplace' )
+
+    def _escape_attribute( self, value ):
+        if '&' in value:
+            value = value.replace( '&', '&amp;' )
+        if '<' in value:
+            value = value.replace( '<', '&lt;' )
+        if '>' in value:
+            value = value.replace( '>', '&gt;' )
+        if '"' in value:
+            value = value.replace( '"', '&quot;' )
+        if '\n' in value:
+            value = value.replace( '\n', '&#10;' )
+        return value.encode( self.encoding, 'xmlcharrefreplace' )
+
+# YAML
+
+_yaml_resolver = yaml.resolver.Resolver()
+_yaml_constructor = yaml.constructor.SafeConstructor()
+_yaml_representer = yaml.representer.SafeRepresenter()
+_YAML_STR_TAG = u'tag:yaml.org,2002:str'
+_YAML_SEQ_TAG = u'tag:yaml.org,2002:seq'
+_YAML_MAP_TAG = u'tag:yaml.org,2002:map'
+
+class _YamlChildren( list ):
+    """Children of an element sharing the same tag, dumped as a YAML list."""
+
+class _YamlFallback( Exception ):
+    """Raised when the YAML document uses features not handled by
+       load_yaml_data() (aliases, merge keys, custom tags...)."""
+
+def load_yaml_data( data ):
+    """Returns the python objects of the single document of the YAML data,
+       as yaml.load() with the safe loader would.
+       The mappings, sequences and scalars are built directly from the parser
+       events: the node graph is not composed, and each distinct scalar is only
+       resolved and constructed once. Documents using aliases or unusual tags
+       are loaded with yaml.load().
+       Raises yaml.YAMLError if the data is not valid YAML.
+    """
+    loader = YamlLoader( data )
+    try:
+        return _load_yaml_events( loader.get_event )
+    except _YamlFallback:
+        return yaml.load( data, Loader = YamlLoader )
+    finally:
+        loader.dispose()
+
+def _load_yaml_events( next_event ):
+    next_event() # StreamStartEvent
+    event = next_event()
+    if event.__class__ is yaml.StreamEndEvent:
+        return None
+    value = _load_yaml_node( next_event, next_event(), {} )
+    next_event() # DocumentEndEvent
+    event = next_event()
+    if event.__class__ is not yaml.StreamEndEvent:
+        raise yaml.composer.ComposerError( 'expected a single document in the stream', None,
+                                           'but found another document', event.start_mark )
+    return value
+
+def _load_yaml_node( next_event, event, scalars ):
+    """Returns the value of the node starting with event.
+       scalars: dict of (tag, implicit, text): value of the scalars constructed so far.
+    """
+    event_class = event.__class__
+    if event_class is yaml.ScalarEvent:
+        key = ( event.tag, event.implicit, event.value )
+        try:
+            return scalars[key]
+        except KeyError:
+            tag = event.tag
+            if tag is None or tag == u'!':
+                tag = _yaml_resolver.resolve( yaml.ScalarNode, event.value, event.implicit )
+            constructor = _yaml_constructor.yaml_constructors.get( tag )
+            if constructor is None:
+                raise _YamlFallback()
+            value = constructor( _yaml_constructor, yaml.ScalarNode( tag, event.value ) )
+            scalars[key] = value
+            return value
+    elif event_class is yaml.MappingStartEvent:
+        if event.tag not in ( None, u'!', _YAML_MAP_TAG ):
+            raise _YamlFallback()
+        mapping = {}
+        event = next_event()
+        while event.__class__ is not yaml.MappingEndEvent:
+            if event.__class__ is not yaml.ScalarEvent:
+                raise _YamlFallback() # complex key
+            key = _load_yaml_node( next_event, event, scalars )
+            if key.__class__ not in ( str, unicode ):
+                raise _YamlFallback() # merge key or unhashable key
+            mapping[key] = _load_yaml_node( next_event, next_event(), scalars )
+            event = next_event()
+        return mapping
+    elif event_class is yaml.SequenceStartEvent:
+        if event.tag not in ( None, u'!', _YAML_SEQ_TAG ):
+            raise _YamlFallback()
+        sequence = []
+        event = next_event()
+        while event.__class__ is not yaml.SequenceEndEvent:
+            sequence.append( _load_yaml_node( next_event, event, scalars ) )
+            event = next_event()
+        return sequence
+    raise _YamlFallback() # alias
+
+def dump_yaml_events( tag, value, stream = None, encoding = 'utf-8' ):
+    """Writes the YAML document of the mapping {tag: value} into stream, or
+       returns it as a string if stream is None. Same output as
+       yaml.dump( {tag: value}, allow_unicode = True ) in block style.
+       value: iterator of the YAML events of the mapping value.
+    """
+    events = itertools.chain( [ yaml.StreamStartEvent( encoding = encoding ),
+                                yaml.DocumentStartEvent( explicit = False ),
+                                yaml.MappingStartEvent( None, None, True, flow_style = False ),
+                                yaml_scalar_event( tag, {} ) ],
+                              value,
+                              [ yaml.MappingEndEvent(),
+                                yaml.DocumentEndEvent( explicit = False ),
+                                yaml.StreamEndEvent() ] )
+    return yaml.emit( events, stream, Dumper = YamlDumper, allow_unicode = True )
+
+def yaml_scalar_event( value, scalar_events ):
+    """Returns the YAML ScalarEvent representing a native value as the safe
+       dumper would: quoted only if the text would be read back as another type.
+       scalar_events: dict used to cache the event of each distinct value.
+    """
+    if value.__class__ is float:
+        key = ( float, repr( value ) ) # 0.0 == -0.0
+    else:
+        key = ( value.__class__, value )
+    event = scalar_events.get( key )
+    if event is None:
+        node = _yaml_representer.represent_data( value )
+        implicit = ( node.tag == _yaml_resolver.resolve( yaml.ScalarNode, node.value, ( True, False ) ),
+                     node.tag == _yaml_resolver.resolve( yaml.ScalarNode, node.value, ( False, True ) ) )
+        event = yaml.ScalarEvent( None, node.tag, implicit, node.value, style = node.style )
+        scalar_events[key] = event
+    return event
+
 
 
 
@@ -955,6 +1409,17 @@ class AttributeUpdated( louie.Signal ):
        sender: tree that owns the element
     """
 
+class ElementsChanged( louie.Signal ):
+    """Signal emitted when a batch of changes made to the trees of a world is committed.
+       See World.begin_changes() and World.end_changes().
+       Signature: (changes)
+       changes: list of changes, in the order they were made. Each change is a tuple:
+         (ELEMENT_ADDED, element, index_in_parent)
+         (ELEMENT_ABOUT_TO_BE_REMOVED, element, parent_element, index_in_parent)
+         (ELEMENT_ATTRIBUTE_UPDATED, element, attribute_name, new_value, old_value)
+       sender: world that owns the modified trees
+    """
+
 class TreeAdded( louie.Signal ):
     """Signal emitted when a tree has been added to a world connected to the universe.
        Signature: (tree)
@@ -1302,9 +1767,12 @@ class Universe( WorldsOwner ):
            tree_meta: description of the kind of tree to load. Used to associated xml tag to element description.
            xml_data: raw XML data.
         """
+        if FAST_XML_LOADING:
+            root_element = self._make_element_from_xml_events( tree_meta.root_element_meta, xml_data )
+            return Tree( self, tree_meta, root_element = root_element )
         try:
             xml_element = xml.etree.ElementTree.fromstring( xml_data )
-        except xml.parsers.expat.ExpatError, e: #@UndefinedVariable
+        except ( xml.parsers.expat.ExpatError, SyntaxError ), e: #@UndefinedVariable
             raise IOError( u'XML Parse Error:' + unicode( e ) )
 
         if tree_meta.root_element_meta.tag != xml_element.tag:
@@ -1315,6 +1783,56 @@ class Universe( WorldsOwner ):
                                                                 self._warning )
         return Tree( self, tree_meta, root_element = root_element )
 
+    def _make_element_from_xml_events( self, root_meta, xml_data ):
+        """Builds the root element and its children from the xml data in a single
+           iterparse pass. Each element is built when its end tag is parsed, then
+           the parsed XML element is cleared and detached from its parent, so the
+           intermediate XML tree is never held in memory.
+           Child elements with no description in their parent are skipped with
+           a warning, like ElementMeta.make_element_from_xml_element() does.
+        """
+        stack = [] # list of (element_meta, child_metas_by_tag, children, xml_element) of the open tags
+        skipped_depth = 0 # > 0 while inside a skipped element
+        shared_values = {} # dict(attribute value: value) of the values already stored
+        root_element = None
+        try:
+            for event, xml_element in _fast_element_tree.iterparse( cStringIO.StringIO( xml_data ),
+                                                                    ( 'start', 'end' ) ):
+                if event == 'start':
+                    if skipped_depth:
+                        skipped_depth += 1
+                        continue
+                    if stack:
+                        element_meta = stack[-1][1].get( xml_element.tag )
+                        if element_meta is None:
+                            self._warning( u'Element %(tag)s, the following child tag missing in the element description: %(child)s.',
+                                           tag = stack[-1][0].tag, child = xml_element.tag )
+                            skipped_depth = 1
+                            continue
+                    elif root_meta.tag != xml_element.tag:
+                        raise WorldException( u'Expected root tag "%(root)s", but got "%(actual)s" instead.' % {
+                            'root': root_meta.tag, 'actual': xml_element.tag } )
+                    else:
+                        element_meta = root_meta
+                    stack.append( ( element_meta, element_meta._xml_loading_plan()[1], [], xml_element ) )
+                elif skipped_depth:
+                    skipped_depth -= 1
+                else:
+                    element_meta, child_metas_by_tag, children, xml_element = stack.pop() #@UnusedVariable
+                    element = element_meta._make_element_from_xml_attributes( xml_element.attrib,
+                                                                              xml_element.text, children,
+                                                                              shared_values )
+                    xml_element.clear()
+                    if stack:
+                        # the previous children, including the skipped ones, are already handled
+                        del stack[-1][3][:]
+                        stack[-1][2].append( element )
+                    else:
+                        root_element = element
+        except ( xml.parsers.expat.ExpatError, SyntaxError ), e: #@UndefinedVariable
+            raise IOError( u'XML Parse Error:' + unicode( e ) )
+        return root_element
+
     def make_unattached_tree_from_yaml( self, tree_meta, data ):
         """Makes a tree from the provided yaml data for the specified kind of tree.
            The tree is NOT attached to any world. Use World.add_tree to do so.
@@ -1325,7 +1843,7 @@ class Universe( WorldsOwner ):
            data: raw YAML data.
         """
         try:
-            element = yaml.load( data )
+            element = load_yaml_data( data )
         except yaml.YAMLError, e:
             raise IOError( u'YAML Parse Error:' + unicode( e ) )
 
@@ -1353,6 +1871,8 @@ class World( WorldsOwner ):
         self._trees = {}
         self._key = key
         self._parent_world = None
+        self._batch_depth = 0
+        self._batch_changes = []
 
     def __repr__( self ):
         trees = ', '.join( tree.meta.name for tree in self._trees.values() )
@@ -1491,6 +2011,9 @@ class World( WorldsOwner ):
             tree._world = self
             assert tree._tree_meta not in self._trees
             self._trees[ tree._tree_meta ] = tree
+            tree.connect_to_element_events( self._on_batched_element_added,
+                                            self._on_batched_element_updated,
+                                            self._on_batched_element_about_to_be_removed )
             louie.send( TreeAdded, self, tree )
 
     def remove_tree( self, *trees ):
@@ -1498,9 +2021,62 @@ class World( WorldsOwner ):
             assert isinstance( tree, Tree )
             assert self._trees.get( tree._tree_meta ) == tree
             louie.send( TreeAboutToBeRemoved, self, tree )
+            tree.disconnect_from_element_events( self._on_batched_element_added,
+                                                 self._on_batched_element_updated,
+                                                 self._on_batched_element_about_to_be_removed )
             del self._trees[ tree._tree_meta ]
             tree._world = None
 
+    @property
+    def is_batching_changes( self ):
+        """True if element changes are being collected for a single ElementsChanged signal.
+           Element events are still emitted while batching, but subscribers that
+           handle ElementsChanged may ignore them.
+        """
+        return self._batch_depth > 0
+
+    def begin_changes( self ):
+        """Starts collecting the changes made to the world trees.
+           Calls may be nested, each one must be matched by a call to end_changes().
+        """
+        self._batch_depth += 1
+
+    def end_changes( self ):
+        """Ends a batch started by begin_changes().
+           When the outermost batch ends, the collected changes are broadcasted
+           using the signal ElementsChanged, unless no change was made.
+        """
+        assert self._batch_depth > 0
+        self._batch_depth -= 1
+        if self._batch_depth == 0 and self._batch_changes:
+            changes, self._batch_changes = self._batch_changes, []
+            louie.send( ElementsChanged, self, changes )
+
+    @contextlib.contextmanager
+    def changes( self ):
+        """Context manager calling begin_changes() and end_changes().
+           Usage: with world.changes(): ...
+        """
+        self.begin_changes()
+        try:
+            yield self
+        finally:
+            self.end_changes()
+
+    def _on_batched_element_added( self, element, index_in_parent ):
+        if self._batch_depth > 0:
+            self._batch_changes.append( ( ELEMENT_ADDED, element, index_in_parent ) )
+
+    def _on_batched_element_updated( self, element, name, new_value, old_value ):
+        if self._batch_depth > 0:
+            self._batch_changes.append( ( ELEMENT_ATTRIBUTE_UPDATED, element, name,
+                                          new_value, old_value ) )
+
+    def _on_batched_element_about_to_be_removed( self, element, index_in_parent ):
+        if self._batch_depth > 0:
+            self._batch_changes.append( ( ELEMENT_ABOUT_TO_BE_REMOVED, element,
+                                          element.parent, index_in_parent ) )
+
     def generate_unique_identifier( self, id_meta ):
         """Generates an identifier value that is unique for the specified attribute
            id_meta in this world.
@@ -1550,9 +2126,9 @@ class Tree:
         assert root_element is None or isinstance( root_element, Element ), type( root_element )
         if self._root_element is not None:  # detach old root
             louie.send( ElementAboutToBeRemoved, self, self._root_element, 0 )
-            self._root_element._tree = None
+            self._root_element._set_tree( None )
         if root_element is not None: # attach new root
-            root_element._tree = self
+            root_element._set_tree( self )
             louie.send( ElementAdded, self, root_element, 0 )
         self._root_element = root_element
 
@@ -1612,12 +2188,20 @@ class Tree:
         assert self.root is not None
         return self.root.to_xml( encoding )
 
-    def to_yaml( self, encoding = None ):
+    def write_xml( self, output_file, encoding = None, pretty = False ):
+        """Writes the XML representing the tree into output_file.
+           See Element.write_xml().
+        """
+        assert self.root is not None
+        self.root.write_xml( output_file, encoding, pretty )
+
+    def to_yaml( self, encoding = None, stream = None ):
         """Outputs a YAML string representing the tree.
            The YAML is encoded using the specified encoding, or UTF-8 if none is specified.
+           If stream is specified, the YAML is written into it and None is returned.
         """
         assert self.root is not None
-        return self.root.to_yaml( encoding )
+        return self.root.to_yaml( encoding, stream )
 
     def clone( self ):
         """Makes a deep clone of the tree root element.
@@ -1627,21 +2211,28 @@ class Tree:
         return Tree( self, self.meta, cloned_root )
 
 
-# Provides support for attributes dict, children list and path look-up
-_ElementBase = xml.etree.ElementTree._ElementInterface
-
-class Element( _ElementBase ):
+class Element( object ):
     """Represents a tree that live in a World on a given Tree, described by an ElementMeta.
        The Element's description associates it with a given kind of Tree and restricts
        the kind of parent and child elements it may have.
+       Provides the attributes dict, children list and path look-up of
+       xml.etree.ElementTree elements, with a compact memory layout: there is
+       no per instance __dict__, and attributes dict keys are the attribute
+       names of the ElementMeta.
     """
+    __slots__ = ( 'tag', 'attrib', 'text', 'tail', '_children',
+                  '_element_meta', '_parent', '_tree', '_native_values' )
+
     def __init__( self, element_meta, attributes = None, children = None , text = None ):
         """Initializes the element of type element_meta with the specified attributes.
            element_meta: an ElementMeta instance
            attributes: a dictionary of (name, value) of attributes values
            children: an iterable (list) of child elements not attached to any tree to be attached as child of this element.
         """
-        _ElementBase.__init__( self, element_meta.tag, {} )
+        self.tag = element_meta.tag
+        self.attrib = {}
+        self.tail = None
+        self._children = []
 
         # rather than init the xml base element with the given attributes....
         # wait till it's init'd and has meta info
@@ -1653,13 +2244,78 @@ class Element( _ElementBase ):
         assert element_meta is not None
         self._element_meta = element_meta
         self._parent = None
-        self._tree = None # only set for the root element
+        self._tree = None # tree owning the element, see _set_tree()
+        self._native_values = None # dict(attribute name: native value), see get_native()
         for attribute, value in attributes.items():
             self._element_meta.attributes_by_name[attribute].set( self, value )
 
         for child in children or ():
             self.append( child )
 
+    def __repr__( self ):
+        return "<Element %s at 0x%x>" % ( repr( self.tag ), id( self ) )
+
+    def __len__( self ):
+        return len( self._children )
+
+    def __getitem__( self, index ):
+        return self._children[index]
+
+    def __getslice__( self, start, stop ):
+        return self._children[start:stop]
+
+    def __iter__( self ):
+        return iter( self._children )
+
+    def extend( self, elements ):
+        """Adds the elements to the end of this element."""
+        for element in elements:
+            self.append( element )
+
+    def getchildren( self ):
+        return self._children
+
+    def find( self, path, namespaces = None ):
+        return xml.etree.ElementPath.find( self, path, namespaces )
+
+    def findtext( self, path, default = None, namespaces = None ):
+        return xml.etree.ElementPath.findtext( self, path, default, namespaces )
+
+    def findall( self, path, namespaces = None ):
+        return xml.etree.ElementPath.findall( self, path, namespaces )
+
+    def iterfind( self, path, namespaces = None ):
+        return xml.etree.ElementPath.iterfind( self, path, namespaces )
+
+    def keys( self ):
+        return self.attrib.keys()
+
+    def items( self ):
+        return self.attrib.items()
+
+    def iter( self, tag = None ):
+        """Iterates over this element and all its descendants in document
+           order, only returning those with the specified tag if any."""
+        if tag == "*":
+            tag = None
+        if tag is None or self.tag == tag:
+            yield self
+        for child in self._children:
+            for element in child.iter( tag ):
+                yield element
+
+    def getiterator( self, tag = None ):
+        return list( self.iter( tag ) )
+
+    def itertext( self ):
+        if self.text:
+            yield self.text
+        for child in self._children:
+            for text in child.itertext():
+                yield text
+            if child.tail:
+                yield child.tail
+
     def is_root( self ):
         return self._parent is None
 
@@ -1679,9 +2335,7 @@ class Element( _ElementBase ):
 
     @property
     def tree( self ):
-        if self._parent is None:
-            return self._tree
-        return  self._parent.tree
+        return self._tree
 
     @property
     def parent( self ):
@@ -1718,64 +2372,93 @@ class Element( _ElementBase ):
     def get( self, attribute_name, default = None ):
         if attribute_name == '' or attribute_name == 'value':
             return self.text or default
-        return _ElementBase.get( self, attribute_name, default )
+        return self.attrib.get( attribute_name, default )
 
     def get_native( self, attribute_name, default = None ):
         """Returns the specified attribute as its python type value.
            Returns default if the attribute is not defined or not convertible to
-           its python type."""
-        return self.attribute_meta( attribute_name ).get_native( self, default )
+           its python type.
+           The converted value is cached until the attribute is set or unset.
+           List values are returned as a new list on each call."""
+        native_values = self._native_values
+        if native_values is None:
+            native_values = {}
+            if CACHE_NATIVE_VALUES:
+                self._native_values = native_values
+        native = native_values.get( attribute_name, _NOT_CONVERTED )
+        if native is _NOT_CONVERTED:
+            attribute_meta = self.attribute_meta( attribute_name )
+            native = attribute_meta.native_from_raw( attribute_meta.get( self ) )
+            native_values[attribute_name] = native
+        if native is None:
+            return default
+        if type( native ) is tuple:
+            return list( native )
+        return native
 
     def to_xml( self, encoding = None ):
         """Outputs a XML string representing the element and its children.
            The XML is encoded using the specified encoding, or UTF-8 if none is specified.
         """
-        encoding = encoding or 'utf-8'
-        xml_element = self._to_xml_element()
-        return xml.etree.ElementTree.tostring( xml_element, encoding )
+        output_file = cStringIO.StringIO()
+        self.write_xml( output_file, encoding )
+        return output_file.getvalue()
 
-    def _to_xml_element( self ):
-        """Returns the element and its children as a xml.etree element for serialization.
+    def write_xml( self, output_file, encoding = None, pretty = False ):
+        """Writes the XML representing the element and its children into
+           output_file, as it is returned by to_xml(), while visiting the elements.
            Takes care of expanding mapped attribute (center => x,y).
+           The XML is encoded using the specified encoding, or UTF-8 if none is specified.
+           pretty: if True, a new line is inserted between consecutive tags.
         """
-        attributes_by_name = {}
-        for attribute in self.meta.attributes:
-            attribute.to_xml( self, attributes_by_name )
-        element = xml.etree.ElementTree.Element( self.meta.tag, attributes_by_name )
-        if self.text is not None:
-            element.text = self.text
-        for child in self:
-            element.append( child._to_xml_element() )
-        return element
+        writer = XmlWriter( output_file, encoding or 'utf-8', pretty )
+        writer.write_element( self )
+        writer.flush()
 
-    def to_yaml( self, encoding = None ):
+    def to_yaml( self, encoding = None, stream = None ):
         """Outputs a YAML string representing the element and its children.
            The YAML is encoded using the specified encoding, or UTF-8 if none is specified.
+           If stream is specified, the YAML is written into it as the elements
+           are visited, and None is returned.
         """
         encoding = encoding or 'utf-8'
-        return yaml.dump( { self.meta.tag : self._to_yaml_element() }, encoding = encoding, allow_unicode = True )
+        return dump_yaml_events( self.meta.tag, self._yaml_events( {} ), stream, encoding )
 
-    def _to_yaml_element( self ):
+    def _yaml_events( self, scalar_events ):
+        """Yields the YAML events of the mapping representing the element:
+           the attributes, and a list of children for each child tag, sorted
+           by key.
+           scalar_events: dict caching the event of each attribute value.
+        """
         props = {}
         for attribute in self.meta.attributes:
             attribute.to_yaml( self, props )
-
 #        if self.text is not None:
 #            props[ '@text' ] = self.text
-        if len( self ) > 0:
-            children = []
-            for child in self:
-                children.append( ( child.meta.tag, child._to_yaml_element() ) )
-
-            # since child order have no matter, create a list of
-            # children with duplicated tags
-            taglist = set( [ x.meta.tag for x in self ] )
-            for tag in taglist:
-                props[ tag ] = []
-            for child in children:
-                props[ child[0] ].append( child[1] )
-
-        return props
+        # since child order have no matter, group the children by tag
+        for child in self:
+            children = props.get( child.meta.tag )
+            if children.__class__ is not _YamlChildren:
+                children = _YamlChildren()
+                props[child.meta.tag] = children
+            children.append( child )
+        yield yaml.MappingStartEvent( None, None, True, flow_style = False )
+        for key in sorted( props ):
+            yield yaml_scalar_event( key, scalar_events )
+            value = props[key]
+            if isinstance( value, list ):
+                yield yaml.SequenceStartEvent( None, None, True, flow_style = False )
+                if value.__class__ is _YamlChildren:
+                    for child in value:
+                        for event in child._yaml_events( scalar_events ):
+                            yield event
+                else:
+                    for component in value:
+                        yield yaml_scalar_event( component, scalar_events )
+                yield yaml.SequenceEndEvent()
+            else:
+                yield yaml_scalar_event( value, scalar_events )
+        yield yaml.MappingEndEvent()
 
     def is_detached( self ):
         """Indicates if the element does not belong to a tree. 
@@ -1846,11 +2529,12 @@ class Element( _ElementBase ):
             meta_attributes['tree_meta'] = self.tree.meta.name
         meta_attributes['element_meta_path'] = '/'.join( element_meta_path )
         meta_attributes['element_xpath'] = self.xpath()
-        meta_element = xml.etree.ElementTree.Element( 'MetaWorldElement',
-                                                      meta_attributes )
+        output_file = cStringIO.StringIO()
+        writer = XmlWriter( output_file, encoding )
         #@DaB - Fixes incorrectly pasted combined properties (x,y)
-        meta_element.append( self._to_xml_element() )
-        return xml.etree.ElementTree.tostring( meta_element, encoding )
+        writer.write_wrapped_element( 'MetaWorldElement', meta_attributes, self )
+        writer.flush()
+        return output_file.getvalue()
 
     def _make_element_from_xml( self, xml_data ):
         try:
@@ -1936,6 +2620,24 @@ class Element( _ElementBase ):
         value = attribute_meta.get( self )
         return attribute_meta.is_valid_value( value, world )
 
+    def get_attribute_issues( self, world ):
+        """Checks all the attributes of the element, as is_attribute_valid().
+           Returns a dict(attribute name: (message, args)) of the attributes
+           that are not valid.
+        """
+        issues = {}
+        attrib = self.attrib
+        for attribute_meta in self._element_meta.attributes_order:
+            name = attribute_meta.name
+            if name == 'value' or name == '':
+                value = self.text or None
+            else:
+                value = attrib.get( name )
+            status = attribute_meta.is_valid_value( value, world )
+            if status is not None:
+                issues[name] = status
+        return issues
+
     def append( self, element ):
         """Adds a subelement to the end of this element.
            @param element The element to add.
@@ -1971,7 +2673,7 @@ class Element( _ElementBase ):
         if tree:
             louie.send( ElementAboutToBeRemoved, tree, old_element, index )
         self._children[index] = element
-        old_element._parent = None
+        self._unparent_element( old_element )
         self._parent_element( element )
         if tree:
             louie.send( ElementAdded, tree, element, index )
@@ -1990,7 +2692,7 @@ class Element( _ElementBase ):
         if tree:
             louie.send( ElementAboutToBeRemoved, tree, element, index )
         del self._children[index]
-        element._parent = None
+        self._unparent_element( element )
 
     def __setslice__( self, start, stop, elements ):
         """Replaces a number of subelements with elements from a sequence.
@@ -2013,7 +2715,7 @@ class Element( _ElementBase ):
             element = self._children[start]
             if tree:
                 louie.send( ElementAboutToBeRemoved, tree, element, start )
-            element._parent = None
+            self._unparent_element( element )
             del self._children[start]
         for offset, element in enumerate( elements ):
             index = start + offset
@@ -2040,7 +2742,7 @@ class Element( _ElementBase ):
             element = self._children[start]
             if tree:
                 louie.send( ElementAboutToBeRemoved, tree, element, start )
-            element._parent = None
+            self._unparent_element( element )
             del self._children[start]
 
     def index_in_parent( self ):
@@ -2064,7 +2766,7 @@ class Element( _ElementBase ):
         if tree:
             louie.send( ElementAboutToBeRemoved, tree, element, index )
         del self._children[index]
-        element._parent = None
+        self._unparent_element( element )
 
     def clear( self ):
         """Resets an element.  This function removes all subelements, clears
@@ -2075,9 +2777,12 @@ class Element( _ElementBase ):
             element = self._children[0]
             if tree:
                 louie.send( ElementAboutToBeRemoved, tree, element, 0 )
-            element._parent = None
+            self._unparent_element( element )
             del self._children[0]
-        _ElementBase.clear( self )
+        self.attrib.clear()
+        self._native_values = None
+        self._children = []
+        self.text = self.tail = None
 
     def set( self, key, new_value ):
         """Sets an element attribute.
@@ -2087,10 +2792,14 @@ class Element( _ElementBase ):
         """
         # @todo check that value is string-like
         assert new_value is not None
-        if key not in self._element_meta.attributes_by_name:
+        attribute_meta = self._element_meta.attributes_by_name.get( key )
+        if attribute_meta is None:
             raise KeyError( 'element %(tag)s has no attribute %(name)s' % {
                 'tag': self.meta.tag,
                 'name': key } )
+        key = attribute_meta.name # shared by all the elements
+        if self._native_values:
+            self._native_values.pop( key, None )
         tree = self.tree
         if tree:
             if key == 'value':
@@ -2106,6 +2815,8 @@ class Element( _ElementBase ):
     def unset( self, attribute_name ):
         """Removes the specified attribute from the element.
         """
+        if self._native_values:
+            self._native_values.pop( attribute_name, None )
         tree = self.tree
         if tree:
             try:
@@ -2123,6 +2834,22 @@ class Element( _ElementBase ):
         assert isinstance( element, Element )
         assert element._parent is None
         element._parent = self
+        if element._tree is not self._tree:
+            element._set_tree( self._tree )
+
+    def _unparent_element( self, element ):
+        element._parent = None
+        if element._tree is not None:
+            element._set_tree( None )
+
+    def _set_tree( self, tree ):
+        """Sets the tree owning the element and all its descendants, so that
+           the tree of an element is found without walking its parents."""
+        elements = [ self ]
+        while elements:
+            element = elements.pop()
+            element._tree = tree
+            elements.extend( element._children )
 
     def clone( self ):
         """Makes a deep clone of the element.
@@ -2489,6 +3216,37 @@ if __name__ == "__main__":
                 pass
             events_checker.check()
 
+        def test_changes( self ):
+            s1 = self._make_element( LEVEL_SIGN )
+            self.level1.set_root( s1 )
+            batches = []
+            def on_elements_changed( changes ):
+                batches.append( changes )
+            louie.connect( on_elements_changed, ElementsChanged, self.world_level1 )
+            t1 = self._make_element( LEVEL_TEXT )
+            t2 = self._make_element( LEVEL_TEXT )
+            # no signal outside of a batch
+            s1.append( t1 )
+            self.assertEqual( [], batches )
+            # nested batches are broadcasted once
+            with self.world_level1.changes():
+                self.assertEqual( True, self.world_level1.is_batching_changes )
+                self.world_level1.begin_changes()
+                s1.append( t2 )
+                t2.set( 'id', 'TEXT_HI' )
+                self.world_level1.end_changes()
+                self.assertEqual( [], batches )
+                s1.remove( t1 )
+            self.assertEqual( False, self.world_level1.is_batching_changes )
+            self.assertEqual( [[ ( ELEMENT_ADDED, t2, 1 ),
+                                 ( ELEMENT_ATTRIBUTE_UPDATED, t2, 'id', 'TEXT_HI', None ),
+                                 ( ELEMENT_ABOUT_TO_BE_REMOVED, t1, s1, 0 ) ]], batches )
+            # empty batch does not emit signal
+            with self.world_level1.changes():
+                pass
+            self.assertEqual( 1, len( batches ) )
+            louie.disconnect( on_elements_changed, ElementsChanged, self.world_level1 )
+
         def test_from_to_xml_clone( self ):
             xml_data = """<inline>
 <text id ="TEXT_HI" fr="Salut" />
@@ -2533,6 +3291,174 @@ if __name__ == "__main__":
             xml_data = cloned_tree.to_xml()
             check( xml_data )
 
+        def test_fast_xml_loading( self ):
+            global FAST_XML_LOADING
+            xml_data = """<inline>
+<text id ="TEXT_HI" fr="Salut">some text</text>
+<unknown id="TEXT_SKIPPED"><text id="TEXT_SKIPPED_CHILD" /></unknown>
+<sign text="TEXT_HI" y="4567">
+  <text id="TEXT_CHILD" fr="Enfant" />
+  <unknown />
+</sign>
+<sign text="TEXT_HI" />
+</inline>
+"""
+            warnings = []
+            self.universe._warning = lambda message, **kwargs: warnings.append( message % kwargs )
+            trees = []
+            for fast_xml_loading in ( False, True ):
+                FAST_XML_LOADING = fast_xml_loading
+                try:
+                    trees.append( self.universe.make_unattached_tree_from_xml( TREE_TEST_LEVEL, xml_data ) )
+                finally:
+                    FAST_XML_LOADING = True
+            self.assertEqual( trees[0].to_xml(), trees[1].to_xml() )
+            self.assertEqual( warnings[:2], warnings[2:] )
+            inline = trees[1].root
+            self.assertEqual( 3, len( inline ) )
+            self.assertEqual( 'some text', inline[0].text )
+            self.assertEqual( ',4567', inline[1].get( 'pos' ) )
+            self.assertEqual( None, inline[2].get( 'pos' ) )
+            self.assertEqual( inline, inline[1].parent )
+            self.assertEqual( inline[1], inline[1][0].parent )
+            self.assertRaises( IOError, self.universe.make_unattached_tree_from_xml, TREE_TEST_LEVEL, '<inline>' )
+            self.assertRaises( WorldException, self.universe.make_unattached_tree_from_xml, TREE_TEST_LEVEL, '<sign />' )
+
+        def test_yaml( self ):
+            xml_data = """<inline>
+<text id ="TEXT_HI" fr="Salut" />
+<text id ="1.5" fr="caf\xc3\xa9" />
+<sign text="TEXT_HI" alt_text="true" x="-0.5" y="4567" />
+<sign text="TEXT_HI" />
+</inline>
+"""
+            self.universe._warning = lambda message, **kwargs: None
+            tree = self.universe.make_unattached_tree_from_xml( TREE_TEST_LEVEL, xml_data )
+            yaml_data = tree.to_yaml()
+            expected = { 'inline': {
+                'text': [ { 'id': 'TEXT_HI', 'fr': 'Salut' }, { 'id': '1.5', 'fr': u'caf\xe9' } ],
+                'sign': [ { 'text': [ 'TEXT_HI' ], 'alt_text': [ 'true' ], 'x': -0.5, 'y': 4567.0 },
+                          { 'text': [ 'TEXT_HI' ] } ] } }
+            self.assertEqual( yaml.dump( expected, Dumper = YamlDumper, encoding = 'utf-8', allow_unicode = True ),
+                              yaml_data )
+            self.assertEqual( expected, yaml.load( yaml_data, Loader = yaml.SafeLoader ) )
+            self.assertEqual( expected, load_yaml_data( yaml_data ) )
+            stream = cStringIO.StringIO()
+            self.assertEqual( None, tree.to_yaml( stream = stream ) )
+            self.assertEqual( yaml_data, stream.getvalue() )
+            # sign text attribute and text children share the same key: only load texts
+            del expected['inline']['sign']
+            yaml_data = yaml.dump( expected, Dumper = YamlDumper, encoding = 'utf-8', allow_unicode = True )
+            yaml_tree = self.universe.make_unattached_tree_from_yaml( TREE_TEST_LEVEL, yaml_data )
+            self.assertEqual( yaml_data, yaml_tree.to_yaml() )
+            self.assertEqual( u'caf\xe9', yaml_tree.root[1].get( 'fr' ) )
+            # aliases are resolved by the fallback loader
+            self.assertEqual( { 'a': [ 1, 2 ], 'b': [ 1, 2 ] }, load_yaml_data( 'a: &x [1, 2]\nb: *x\n' ) )
+            self.assertRaises( yaml.YAMLError, load_yaml_data, 'a: 1\n---\nb: 2\n' )
+            self.assertRaises( IOError, self.universe.make_unattached_tree_from_yaml, TREE_TEST_LEVEL, 'inline: [' )
+
+        def test_write_xml( self ):
+            xml_data = """<inline><text fr="a&amp;b &lt;&quot;&#10;" id="TEXT_HI">some &lt;text&gt;</text><sign text="TEXT_HI" x="1" y="2" /><text id="TEXT_2" /></inline>"""
+            self.universe._warning = lambda message, **kwargs: None
+            tree = self.universe.make_unattached_tree_from_xml( TREE_TEST_LEVEL, xml_data )
+            self.assertEqual( xml_data, tree.to_xml() )
+            self.assertEqual( "<?xml version='1.0' encoding='iso-8859-1'?>\n" + xml_data, tree.to_xml( 'iso-8859-1' ) )
+            output_file = cStringIO.StringIO()
+            tree.write_xml( output_file, pretty = True )
+            self.assertEqual( xml_data.replace( '><', '>\n<' ), output_file.getvalue() )
+            tree.root[2].text = u'\u263a'
+            self.assertEqual( '<text id="TEXT_2">\xe2\x98\xba</text>', tree.root[2].to_xml() )
+            self.assertEqual( '<text id="TEXT_2">&#9786;</text>', tree.root[2].to_xml( 'us-ascii' ) )
+            self.assertEqual( '<MetaWorldElement element_meta_path="inline/text" element_xpath="/inline/text[@id=\'TEXT_2\']" '
+                              'tree_meta="testlevel"><text id="TEXT_2">\xe2\x98\xba</text></MetaWorldElement>',
+                              tree.root[2].to_xml_with_meta() )
+            # flushes while writing the children must not lose the end tag
+            output_file = cStringIO.StringIO()
+            writer = XmlWriter( output_file, chunk_size = 2 )
+            writer.write_element( tree.root )
+            writer.flush()
+            self.assertEqual( tree.to_xml(), output_file.getvalue() )
+
+        def test_element_layout( self ):
+            xml_data = """<inline><text id="TEXT_HI" fr="0" /><sign text="TEXT_HI" x="0" y="1"><text id="TEXT_CHILD" fr="0" /></sign></inline>"""
+            world_level = self.world.make_world( WORLD_TEST_LEVEL, 'levellayout' )
+            root = world_level.make_tree_from_xml( TREE_TEST_LEVEL, xml_data ).root
+            self.assert_( not hasattr( root, '__dict__' ) )
+            # attribute names are the ones of the description, repeated values are shared
+            root[0].set( ''.join( ['f', 'r'] ), 'Salut' )
+            self.assert_( [ name for name in root[0].keys() if name == 'fr' ][0] is LEVEL_TEXT.attribute_by_name( 'fr' ).name )
+            self.assert_( root[0].get( 'id' ) is root[1].get( 'text' ) )
+            # xml.etree.ElementTree API
+            self.assertEqual( [ 'TEXT_HI', 'TEXT_CHILD' ], [ element.get( 'id' ) for element in root.findall( './/text' ) ] )
+            self.assertEqual( root[1][0], root.find( 'sign/text' ) )
+            self.assertEqual( [ root, root[0], root[1], root[1][0] ], list( root.iter() ) )
+            self.assertEqual( [ root[0], root[1][0] ], root.getiterator( 'text' ) )
+            self.assertEqual( [ root[0], root[1] ], list( root ) )
+            self.assertEqual( [ root[1] ], root[1:] )
+
+        def test_element_tree( self ):
+            xml_data = """<inline><text id="TEXT_HI" /><sign text="TEXT_HI"><text id="TEXT_CHILD" /></sign></inline>"""
+            world_level = self.world.make_world( WORLD_TEST_LEVEL, 'leveltree' )
+            tree = world_level.make_tree_from_xml( TREE_TEST_LEVEL, xml_data )
+            root = tree.root
+            sign, child = root[1], root[1][0]
+            self.assertEqual( [ tree ] * 4, [ element.tree for element in root.iter() ] )
+            self.assertEqual( world_level, child.world )
+            self.assertEqual( self.universe, child.universe )
+            # the tree of the removed subtree is reset
+            root.remove( sign )
+            self.assertEqual( ( None, None ), ( sign.tree, child.tree ) )
+            self.assertEqual( None, child.world )
+            # and set again once attached
+            root.insert( 0, sign )
+            self.assertEqual( ( tree, tree ), ( sign.tree, child.tree ) )
+            del root[0]
+            self.assertEqual( None, child.tree )
+            root[0] = sign
+            self.assertEqual( tree, child.tree )
+            root[0:1] = []
+            self.assertEqual( None, child.tree )
+            root[0:0] = [ sign ]
+            self.assertEqual( tree, child.tree )
+            tree.set_root( None )
+            self.assertEqual( None, child.tree )
+            tree.set_root( root )
+            self.assertEqual( tree, child.tree )
+
+        def test_native_values( self ):
+            root = self._make_element( GLOBAL_VALIDATION )
+            self.world.make_tree( TREE_TEST_VALIDATION, root )
+            root.set( 'xy', '1.5,2' )
+            root.set( 'empty_int', '3' )
+            root.set( 'enumlist', 'blue,red' )
+            self.assertEqual( [1.5, 2.0], root.get_native( 'xy' ) )
+            self.assertEqual( 3, root.get_native( 'empty_int' ) )
+            self.assertEqual( ['blue', 'red'], root.get_native( 'enumlist' ) )
+            self.assertEqual( ( 0, 0 ), root.get_native( 'rgb', ( 0, 0 ) ) )
+            # modifying the returned list does not modify the cached value
+            root.get_native( 'xy' ).append( 3.0 )
+            self.assertEqual( [1.5, 2.0], root.get_native( 'xy' ) )
+            # cached values are invalidated by set() and unset()
+            root.set( 'xy', '4,5' )
+            self.assertEqual( [4.0, 5.0], root.get_native( 'xy' ) )
+            root.set( 'empty_int', 'abc' )
+            self.assertEqual( -1, root.get_native( 'empty_int', -1 ) )
+            root.unset( 'enumlist' )
+            self.assertEqual( None, root.get_native( 'enumlist' ) )
+            root.set( 'bool', 'true' )
+            self.assertEqual( True, root.meta.attribute_by_name( 'bool' ).get_native( root ) )
+
+        def test_reference_validation( self ):
+            xml_data = """<inline><sign text="TEXT_HI" /></inline>"""
+            world_level = self.world.make_world( WORLD_TEST_LEVEL, 'levelvalidation' )
+            level_tree = world_level.make_tree_from_xml( TREE_TEST_LEVEL, xml_data )
+            sign = level_tree.root[0]
+            text_meta = sign.meta.attribute_by_name( 'text' )
+            self.assert_( sign.is_attribute_valid( text_meta, world_level ) is not None )
+            # reference statuses are not cached: they depend on the identifiers
+            level_tree.root.append( Element( LEVEL_TEXT, {'id':'TEXT_HI'} ) )
+            self.assertEqual( None, sign.is_attribute_valid( text_meta, world_level ) )
+
         def test_from_xml2( self ):
             xml_data = """<inline></inline>"""
             world_level = self.world.make_world( WORLD_TEST_LEVEL, 'levelxml' )
@@ -2673,6 +3599,18 @@ if __name__ == "__main__":
             check_not_valid( 'xy', ',0' )
             check_not_valid( 'xy', '0' )
             check_not_valid( 'xy', '0,0,0' )
+            # statuses of validated values are cached
+            attribute_meta = root.meta.attribute_by_name( 'rgb' )
+            self.assertEqual( attribute_meta.get_validator()( '0,0,0,0', self.world ),
+                              attribute_meta._validated_values['0,0,0,0'] )
+            # all attributes at once
+            expected_issues = {}
+            for attribute_meta in root.meta.attributes_order:
+                status = root.is_attribute_valid( attribute_meta, self.world )
+                if status is not None:
+                    expected_issues[attribute_meta.name] = status
+            self.assert_( expected_issues )
+            self.assertEqual( expected_issues, root.get_attribute_issues( self.world ) )
 
 # to test:
 
@@ -1,3 +1,4 @@
+import time
 import louie
 import metaworld
 
@@ -27,6 +28,16 @@ class ElementIssuesUpdated( louie.Signal ):
        elements: list of Element with modified issue
     """
 
+class ImagesLoaded( louie.Signal ):
+    """Emitted when images requested by a world have been decoded in the background.
+       Signature: (image_ids), sender: world
+       image_ids: set of the ids of the images that are now available. Empty
+                  if all the requested images failed to decode.
+    """
+
+# Undo action made of the list of actions of a batch of changes (see World.begin_changes)
+UNDO_BATCH = 'batch'
+
 class UndoWorldTracker( object ):
     def __init__( self, world, queue_depth = 0 ):
         """world: world that is tracked for change.
@@ -38,6 +49,7 @@ class UndoWorldTracker( object ):
         self.__redo_queue = []
         self.__active = True
         louie.connect( self.__on_tree_added, metaworld.TreeAdded, world )
+        louie.connect( self.__on_elements_changed, metaworld.ElementsChanged, world )
 
     def __on_tree_added( self, tree ):
         for tree_meta in self.__world.meta.trees:
@@ -50,18 +62,34 @@ class UndoWorldTracker( object ):
                                             self.__on_element_about_to_be_removed )
 
     def __on_element_added( self, element, index_in_parent ): #IGNORE:W0613
-        undo_action = [metaworld.ELEMENT_ADDED, element]
-        self.__add_to_undo_queue( undo_action )
+        if not self.__world.is_batching_changes:
+            undo_action = [metaworld.ELEMENT_ADDED, element]
+            self.__add_to_undo_queue( undo_action )
 
     def __on_element_about_to_be_removed( self, element, index_in_parent ): #IGNORE:W0613
-        undo_action = [metaworld.ELEMENT_ABOUT_TO_BE_REMOVED, element, element.parent, index_in_parent]
-        self.__add_to_undo_queue( undo_action )
+        if not self.__world.is_batching_changes:
+            undo_action = [metaworld.ELEMENT_ABOUT_TO_BE_REMOVED, element, element.parent, index_in_parent]
+            self.__add_to_undo_queue( undo_action )
 
     def __on_element_updated( self, element, name, new_value, old_value ): #IGNORE:W0613
-        if new_value != old_value:
+        if new_value != old_value and not self.__world.is_batching_changes:
             undo_action = [metaworld.ELEMENT_ATTRIBUTE_UPDATED, element, name, new_value, old_value]
             self.__add_to_undo_queue( undo_action )
 
+    def __on_elements_changed( self, changes ):
+        """Adds a batch of changes to the undo queue as a single undo action."""
+        undo_actions = []
+        for change in changes:
+            if change[0] == metaworld.ELEMENT_ADDED:
+                undo_actions.append( [metaworld.ELEMENT_ADDED, change[1]] )
+            elif change[0] == metaworld.ELEMENT_ATTRIBUTE_UPDATED:
+                if change[3] != change[4]:
+                    undo_actions.append( list( change ) )
+            else:
+                undo_actions.append( list( change ) )
+        if undo_actions:
+            self.__add_to_undo_queue( [UNDO_BATCH, undo_actions] )
+
     def __add_to_undo_queue( self, undo_action ):
         if self.__active:
             if self.__queue_depth > 0:  # 0 = infinite
@@ -106,29 +134,7 @@ class UndoWorldTracker( object ):
             # Undo-ing would add a new action into the undo queue.
             # so suspend undo, while we are undoing
             self.__active = False
-            if undo_action[0] == metaworld.ELEMENT_ADDED:
-                # action, element
-                element = undo_action[1]
-                redo_action = [undo_action[0], element,
-                                element.parent, element.index_in_parent()]
-                element.parent.remove( element )
-
-            elif undo_action[0] == metaworld.ELEMENT_ATTRIBUTE_UPDATED:
-                # action, element, attributename, newvalue, oldvalue
-                element = undo_action[1]
-                redo_action = undo_action
-                if undo_action[4] is None:
-                    element.unset( undo_action[2] )
-                else:
-                    element.set( undo_action[2], undo_action[4] )
-            elif undo_action[0] == metaworld.ELEMENT_ABOUT_TO_BE_REMOVED:
-                # action, element, parent, index in parent
-                redo_action = undo_action
-                element = undo_action[1]
-                parent = undo_action[2]
-                parent.insert( undo_action[3], element )
-            else:
-                print "Unknown Undo Action", undo_action
+            redo_action = self._undo_action( undo_action )
 
             # put the redo_action in the redo stack
             self.__redo_queue.append( redo_action )
@@ -137,6 +143,42 @@ class UndoWorldTracker( object ):
 
        # print "undo count=",len(self.__undo_queue)
 
+    def _undo_action( self, undo_action ):
+        """Reverts the specified undo action and returns the corresponding redo action."""
+        redo_action = undo_action
+        if undo_action[0] == metaworld.ELEMENT_ADDED:
+            # action, element
+            element = undo_action[1]
+            redo_action = [undo_action[0], element,
+                            element.parent, element.index_in_parent()]
+            element.parent.remove( element )
+
+        elif undo_action[0] == metaworld.ELEMENT_ATTRIBUTE_UPDATED:
+            # action, element, attributename, newvalue, oldvalue
+            element = undo_action[1]
+            if undo_action[4] is None:
+                element.unset( undo_action[2] )
+            else:
+                element.set( undo_action[2], undo_action[4] )
+        elif undo_action[0] == metaworld.ELEMENT_ABOUT_TO_BE_REMOVED:
+            # action, element, parent, index in parent
+            element = undo_action[1]
+            parent = undo_action[2]
+            parent.insert( undo_action[3], element )
+        elif undo_action[0] == UNDO_BATCH:
+            # action, list of actions
+            self.__world.begin_changes()
+            try:
+                redo_actions = [ self._undo_action( action )
+                                 for action in reversed( undo_action[1] ) ]
+            finally:
+                self.__world.end_changes()
+            redo_actions.reverse()
+            redo_action = [UNDO_BATCH, redo_actions]
+        else:
+            print "Unknown Undo Action", undo_action
+        return redo_action
+
     def redo( self ):
         initial_queue_length = len( self.__redo_queue )
         if initial_queue_length > 0:
@@ -147,25 +189,7 @@ class UndoWorldTracker( object ):
             # but doing it automatically would reset the redo queue...
             # so suspend undo, while we are redoing
             self.__active = False
-            if redo_action[0] == metaworld.ELEMENT_ADDED:
-                # action, element, parent, index in parent
-                element = redo_action[1]
-                parent = redo_action[2]
-                parent.insert( redo_action[3], element )
-
-            elif redo_action[0] == metaworld.ELEMENT_ATTRIBUTE_UPDATED:
-                # action, element, attributename, newvalue, oldvalue
-                element = redo_action[1]
-                if redo_action[3] is None:
-                    element.unset( redo_action[2] )
-                else:
-                    element.set( redo_action[2], redo_action[3] )
-            elif redo_action[0] == metaworld.ELEMENT_ABOUT_TO_BE_REMOVED:
-                # action, element, parent, index in parent
-                element = redo_action[1]
-                element.parent.remove( element )
-            else:
-                print "Unknown Redo Action", redo_action
+            self._redo_action( redo_action )
 
             # put this action back in the undo stack
             self.__undo_queue.append( redo_action )
@@ -174,6 +198,36 @@ class UndoWorldTracker( object ):
 
         #print "redo count=",len(self.__redo_queue)
 
+    def _redo_action( self, redo_action ):
+        """Applies again the specified redo action."""
+        if redo_action[0] == metaworld.ELEMENT_ADDED:
+            # action, element, parent, index in parent
+            element = redo_action[1]
+            parent = redo_action[2]
+            parent.insert( redo_action[3], element )
+
+        elif redo_action[0] == metaworld.ELEMENT_ATTRIBUTE_UPDATED:
+            # action, element, attributename, newvalue, oldvalue
+            element = redo_action[1]
+            if redo_action[3] is None:
+                element.unset( redo_action[2] )
+            else:
+                element.set( redo_action[2], redo_action[3] )
+        elif redo_action[0] == metaworld.ELEMENT_ABOUT_TO_BE_REMOVED:
+            # action, element, parent, index in parent
+            element = redo_action[1]
+            element.parent.remove( element )
+        elif redo_action[0] == UNDO_BATCH:
+            # action, list of actions
+            self.__world.begin_changes()
+            try:
+                for action in redo_action[1]:
+                    self._redo_action( action )
+            finally:
+                self.__world.end_changes()
+        else:
+            print "Unknown Redo Action", redo_action
+
 class DirtyWorldTracker( object ):
     """Provides the list of tree that have been modified in a world.
        Use element events to track change. Starts tracking for change
@@ -306,10 +360,28 @@ class SelectedElementsTracker( object ):
 CRITICAL_ISSUE = 'critical'
 WARNING_ISSUE = 'warning'
 
+# Maximum time in seconds spent checking element issues each time
+# RefreshElementIssues is received. The remaining checks are done on the
+# following refreshes.
+ISSUE_CHECK_TIME_SLICE = 0.004
+
 class ElementIssueTracker( object ):
     """Track a list of issue for all elements.
        Tracked issues concerns invalid element property, incorrect number of children,
        other constraints (missing mass for dynamic object...) 
+       Issues are checked incrementally: the attribute issues of each element are
+       memoized with the modification stamp of the element, so that they are
+       only validated again once modified (or once the identifiers they
+       reference are). The number of children of each kind and the children
+       with issues of each element are updated as children are added or
+       removed and as their issues appear or disappear.
+       Elements are checked in time slices of at most ISSUE_CHECK_TIME_SLICE seconds.
+       Counters:
+       - checked_count: number of element checks
+       - validated_count: number of checks that validated the element attributes
+       - slice_count: number of time slices that checked elements
+       - check_time: total time spent in the time slices, in seconds
+       - max_slice_time: longest time slice, in seconds
     """
     def __init__( self, world ):
         """world: world that is tracked for change.
@@ -318,9 +390,21 @@ class ElementIssueTracker( object ):
         louie.connect( self.__on_tree_added, metaworld.TreeAdded, world )
         louie.connect( self.__on_refresh_element_status, RefreshElementIssues )
         self._issues_by_element = {} #dict element:(child,attribute,node)
+        self._child_issues = {} # dict element: dict(child: issues) of its children with issues
+        self._stamp = 0 # incremented on each modification
+        self._attribute_stamps = {} # dict element: stamp of its last attribute modification
+        self._attribute_issues = {} # dict element: (attribute stamp, attribute issues)
+        self._child_counts = {} # dict element: dict(child element meta: number of children)
+        self._recount = set() # elements whose children must be counted again
         self._pending_full_check = set()
         self._pending_updated = set()
-        self._modified_issues = set()
+        self._walk_stack = [] # list of [element, index of next child to check, child counts] of the full check in progress
+        self._updated_issue_elements = set() # elements with modified issues not yet broadcast
+        self.checked_count = 0
+        self.validated_count = 0
+        self.slice_count = 0
+        self.check_time = 0.0
+        self.max_slice_time = 0.0
 
     def element_issue_level( self, element ):
         """Returns the most critical level of issue for the element.
@@ -365,6 +449,10 @@ class ElementIssueTracker( object ):
             return '\n'.join( report )
         return ''
 
+    def has_pending_checks( self ):
+        """Returns True if some elements remain to be checked."""
+        return bool( self._walk_stack or self._pending_full_check or self._pending_updated )
+
     def __on_tree_added( self, tree ):
         for tree_meta in self.__world.meta.trees:
             if self.__world.find_tree( tree_meta ) is None: # level not ready yet
@@ -374,112 +462,226 @@ class ElementIssueTracker( object ):
             tree.connect_to_element_events( self.__on_element_added,
                                             self.__on_element_updated,
                                             self.__on_element_about_to_be_removed )
-            self.__on_element_added( tree.root, 0 )
+            self._pending_full_check.add( tree.root )
 
     def __on_element_added( self, element, index_in_parent ): #IGNORE:W0613
         self._pending_full_check.add( element )
+        parent = element.parent
+        if parent is not None:
+            self._restart_walk( parent )
+            self._count_child( parent, element, 1 )
+        # references to the added identifiers may have become valid
+        for child in element.getiterator():
+            self._schedule_back_references( child )
 
     def __on_element_about_to_be_removed( self, element, index_in_parent ): #IGNORE:W0613
         parent = element.parent
+        removed_elements = list( element.getiterator() )
+        self._restart_walk( parent, set( removed_elements ) )
         if parent is not None:
+            self._count_child( parent, element, -1 )
+            self._set_child_issues( parent, element, None )
+        for child in removed_elements:
+            self._schedule_back_references( child )
+        # forgotten once all scheduled, as they may reference each other
+        for child in removed_elements:
+            self._forget_element( child )
+
+    def _restart_walk( self, parent, removed_elements = () ):
+        """Abandons the part of the walk in progress that is invalidated when a
+           child of parent is added or removed: the walk of parent, whose
+           children indexes shifted, and the walk of the removed elements.
+           The walk of parent is started again from scratch.
+        """
+        walk_stack = self._walk_stack
+        for index, entry in enumerate( walk_stack ):
+            if entry[0] is parent or entry[0] in removed_elements:
+                break
+        else:
+            return
+        if walk_stack[index][0] is parent:
             self._pending_full_check.add( parent )
-        self._schedule_back_references( element )
+        if index > 0: # the abandoned element is not counted by the walk of its parent
+            self._recount.add( walk_stack[index - 1][0] )
+        del walk_stack[index:]
+
+    def _forget_element( self, element ):
+        """Discards the memoized issues and the pending checks of a removed element."""
+        for memo in ( self._issues_by_element, self._child_issues, self._attribute_stamps,
+                      self._attribute_issues, self._child_counts ):
+            memo.pop( element, None )
+        for pending in ( self._recount, self._pending_full_check, self._pending_updated,
+                         self._updated_issue_elements ):
+            pending.discard( element )
+
+    def _touch( self, element ):
+        """Records that the element attributes were modified, so that they
+           are validated again on the next check."""
+        self._stamp += 1
+        self._attribute_stamps[element] = self._stamp
+        self._pending_updated.add( element )
 
-    def _schedule_back_references( self, element ):
-        """Schedule any back-references for check as they may have become invalid."""
+    def _count_child( self, element, child, delta ):
+        """Updates the number of children of the element when a child is
+           added (delta = 1) or removed (delta = -1)."""
+        child_counts = self._child_counts.get( element )
+        if child_counts is not None:
+            child_counts[child.meta] = child_counts.get( child.meta, 0 ) + delta
+        else: # not counted yet, or being counted by the full check in progress
+            self._recount.add( element )
+        self._pending_updated.add( element )
+
+    def _schedule_back_references( self, element, id_value = None ):
+        """Schedule any back-references for check as they may have become invalid.
+           id_value: identifier referenced, the element identifier by default.
+        """
         id_meta = element.meta.identifier_attribute
         if id_meta is not None:
-            id_value = id_meta.get( element )
+            if id_value is None:
+                id_value = id_meta.get( element )
             if id_value:
                 family = id_meta.reference_family
                 references = self.__world.universe.list_references( family, id_value )
                 for element, attribute_meta in references: #IGNORE:W0612
                     if element.world == self.__world:
-                        self._pending_full_check.add( element )
+                        self._touch( element )
 
     def __on_element_updated( self, element, name, new_value, old_value ): #IGNORE:W0613
         # Schedule non-recursive check
-        self._pending_updated.add( element )
+        self._touch( element )
         # if the identifier was updated, then also check all back-references
+        # to the previous and new identifier
         id_meta = element.meta.identifier_attribute
         if id_meta is not None and id_meta.name == name:
+            if old_value:
+                self._schedule_back_references( element, old_value )
             self._schedule_back_references( element )
 
     def __on_refresh_element_status( self ):
-#        import time
-#        start_time = time.clock()
-
-        checked_elements = set()
-        # Scan added or parent of removed elements and all their children
-        for element in self._pending_full_check:
-            self._check_element( element, checked_elements, recurse = True )
-        self._pending_full_check.clear()
-        # Scan updated elements, but not their children
-        for element in self._pending_updated:
-            self._check_element( element, checked_elements, recurse = False )
-        self._pending_updated.clear()
-
-        # Scan parents elements of any modified issue (need to escalate warning)
-        all_issue_elements = set()
-        while self._modified_issues:
-            self._modified_issues, modified_issues = set(), self._modified_issues
-            all_issue_elements |= modified_issues
-            parents_to_check = set( [ element.parent for element in modified_issues
-                                      if element.parent is not None ] )
-            for element in parents_to_check:
-                if element not in checked_elements:
-                    self._check_element( element, checked_elements, recurse = False )
-
-        if  all_issue_elements:
-#            print 'Refreshed element status: %.3fs' % (time.clock()-start_time)
-#            start_time = time.clock()
-#            print 'Broadcasting issues:', all_issue_elements
+        """Checks the pending elements for at most ISSUE_CHECK_TIME_SLICE seconds.
+           Returns True if some elements remain to be checked.
+        """
+        if not self.has_pending_checks() and not self._updated_issue_elements:
+            return False
+        start_time = time.time()
+        self._check_pending_elements( start_time + ISSUE_CHECK_TIME_SLICE )
+        elapsed = time.time() - start_time
+        self.slice_count += 1
+        self.check_time += elapsed
+        self.max_slice_time = max( self.max_slice_time, elapsed )
+
+        if self._updated_issue_elements:
+            all_issue_elements, self._updated_issue_elements = self._updated_issue_elements, set()
             louie.send( ElementIssuesUpdated, self.__world, all_issue_elements )
-#            print 'Broadcast modified element issues: %.3fs' % (time.clock()-start_time)
+        return self.has_pending_checks()
 
+    def _check_pending_elements( self, deadline ):
+        """Checks the pending elements until all are checked or the deadline
+           (time.time() value) is reached."""
+        checked_elements = set()
+        walk_stack = self._walk_stack
+        while time.time() < deadline:
+            if walk_stack:
+                # Continue the post-order walk of an added subtree, so that
+                # children are checked before their parent
+                for index in xrange( 64 ): #@UnusedVariable
+                    if not walk_stack:
+                        break
+                    entry = walk_stack[-1]
+                    element, child_index, child_counts = entry
+                    if child_index < len( element ):
+                        entry[1] += 1
+                        walk_stack.append( [ element[child_index], 0, {} ] )
+                    else:
+                        walk_stack.pop()
+                        if walk_stack: # count the children as they are walked
+                            parent_counts = walk_stack[-1][2]
+                            parent_counts[element.meta] = parent_counts.get( element.meta, 0 ) + 1
+                        if element not in self._recount:
+                            self._child_counts[element] = child_counts
+                        self._check_element( element, checked_elements, recurse = False )
+            elif self._pending_full_check:
+                # Scan added elements and all their children
+                walk_stack.append( [ self._pending_full_check.pop(), 0, {} ] )
+            elif self._pending_updated:
+                # Scan updated elements, parents of added or removed elements
+                # and parents of elements with new or fixed issues, but not their children
+                for index in xrange( 64 ): #@UnusedVariable
+                    if not self._pending_updated:
+                        break
+                    self._check_element( self._pending_updated.pop(), checked_elements, recurse = False )
+            else:
+                break
 
     def _check_element( self, element, checked_elements, recurse = True ):
-        checked_elements.add( self )
-        if element.is_detached():  # deleted element
+        checked_elements.add( element )
+        if element.tree is None:  # deleted element, or one of its descendants
             return
-        # check child for issues
-        child_issues = {}
-        children_by_meta = {}
-        for child in element:
-            if recurse:
+        self.checked_count += 1
+        if recurse:
+            for child in element:
                 self._check_element( child, checked_elements )
-            issue = self._issues_by_element.get( child )
-            if issue is not None:
-                child_issues[child] = issue
-            if child.meta not in children_by_meta:
-                children_by_meta[child.meta] = []
-            children_by_meta[child.meta].append( child )
-        # check attribute for issues
-        attribute_issues = {}
-        for attribute_meta in element.meta.attributes:
-            status = element.is_attribute_valid( attribute_meta, self.__world )
-            if status is not None:
-                attribute_issues[attribute_meta.name] = status
+        # check attribute for issues, unless unmodified since the last check
+        stamp = self._attribute_stamps.get( element, 0 )
+        checked_stamp, attribute_issues = self._attribute_issues.get( element, ( -1, None ) )
+        if checked_stamp != stamp:
+            self.validated_count += 1
+            attribute_issues = element.get_attribute_issues( self.__world )
+            self._attribute_issues[element] = ( stamp, attribute_issues )
         # check node issues (mandatory children...)
+        child_counts = self._child_counts.get( element )
+        if child_counts is None or element in self._recount:
+            child_counts = {}
+            for child in element:
+                child_counts[child.meta] = child_counts.get( child.meta, 0 ) + 1
+            self._child_counts[element] = child_counts
+            self._recount.discard( element )
         node_issues = {}
         for child_meta in element.meta.immediate_child_elements():
-            status = self._check_child_occurrences( child_meta, children_by_meta )
+            status = self._check_child_occurrences( child_meta, child_counts.get( child_meta, 0 ) )
             if status is not None:
                 node_issues[child_meta] = status
         # synthesis of issues
+        child_issues = self._child_issues.get( element, {} )
+        previous_issues = self._issues_by_element.get( element )
         if child_issues or attribute_issues or node_issues:
-            self._issues_by_element[element] = ( child_issues,
-                                                attribute_issues,
-                                                node_issues )
-            self._modified_issues.add( element )
+            issues = ( child_issues, attribute_issues, node_issues )
+            self._issues_by_element[element] = issues
+            if ( previous_issues is None or previous_issues[1] is not attribute_issues
+                 or previous_issues[2] != node_issues ):
+                self._updated_issue_elements.add( element )
 #            print 'Issue found on', element
-        elif element in self._issues_by_element:
+        elif previous_issues is not None:
 #            print 'Removing issue on ', element
             del self._issues_by_element[element]
-            self._modified_issues.add( element )
-
-    def _check_child_occurrences( self, meta, children_by_meta ):
-        occurrences = len( children_by_meta.get( meta, () ) )
+            issues = None
+            self._updated_issue_elements.add( element )
+        else:
+            return
+        if element.parent is not None:
+            self._set_child_issues( element.parent, element, issues )
+
+    def _set_child_issues( self, element, child, issues ):
+        """Records the issues of a child of element, None if it has none.
+           Schedules the element for check if the child has new or no more issues
+           (need to escalate warning)."""
+        child_issues = self._child_issues.get( element )
+        if issues is not None:
+            if child_issues is None:
+                child_issues = {}
+                self._child_issues[element] = child_issues
+            if child not in child_issues:
+                self._pending_updated.add( element )
+                self._updated_issue_elements.add( element )
+            child_issues[child] = issues
+        elif child_issues is not None and child in child_issues:
+            del child_issues[child]
+            if not child_issues:
+                del self._child_issues[element]
+            self._pending_updated.add( element )
+            self._updated_issue_elements.add( element )
+
+    def _check_child_occurrences( self, meta, occurrences ):
         if ( meta.min_occurrence is not None
              and occurrences < meta.min_occurrence ):
             if meta.min_occurrence == meta.max_occurrence:
@@ -499,3 +701,79 @@ class ElementIssueTracker( object ):
                 'type':meta.tag, 'count':meta.max_occurrence}
         return None
 
+
+if __name__ == '__main__':
+    import unittest #@UnresolvedImport
+    import metawog #@UnresolvedImport
+
+    def make_element( element_meta, depth ):
+        """Returns an element with its initial attribute values and, down to
+           depth, one child of each of its kinds."""
+        attributes = dict( [ ( attribute_meta.name, attribute_meta.init )
+                             for attribute_meta in element_meta.attributes
+                             if attribute_meta.init is not None ] )
+        children = []
+        if depth > 0:
+            children = [ make_element( child_meta, depth - 1 )
+                         for child_meta in element_meta.immediate_child_elements() ]
+        return metaworld.Element( element_meta, attributes, children )
+
+    class ElementIssueTrackerTest( unittest.TestCase ):
+        def setUp( self ):
+            universe = metaworld.Universe()
+            universe._warning = lambda message, **kwargs: None
+            game_world = universe.make_world( metawog.WORLD_GLOBAL, 'game' )
+            self.world = game_world.make_world( metawog.WORLD_LEVEL, 'level' )
+            self.tracker = ElementIssueTracker( self.world )
+            scene_meta = metawog.TREE_LEVEL_SCENE.root_element_meta
+            self.scene_root = make_element( scene_meta, 0 )
+            for index in xrange( 2000 ):
+                child_metas = scene_meta.immediate_child_elements()
+                self.scene_root.append( make_element( child_metas[index % len( child_metas )], 1 ) )
+            for tree_meta in self.world.meta.trees:
+                if tree_meta is metawog.TREE_LEVEL_SCENE:
+                    self.world.make_tree( tree_meta, self.scene_root )
+                else:
+                    self.world.make_tree( tree_meta, make_element( tree_meta.root_element_meta, 1 ) )
+
+        def check_all( self ):
+            while self.tracker.has_pending_checks():
+                self.tracker._check_pending_elements( time.time() + 1.0 )
+            self.tracker._updated_issue_elements.clear()
+            elements = set()
+            for tree in self.world.trees:
+                elements.update( tree.root.getiterator() )
+            for memo in ( self.tracker._issues_by_element, self.tracker._child_issues,
+                          self.tracker._attribute_stamps, self.tracker._attribute_issues,
+                          self.tracker._child_counts ):
+                self.assertEqual( set(), set( memo ) - elements )
+            for element in elements:
+                self.assert_( element in self.tracker._attribute_issues )
+                child_counts = {}
+                for child in element:
+                    child_counts[child.meta] = child_counts.get( child.meta, 0 ) + 1
+                self.assertEqual( child_counts, dict( [ ( meta, count ) for meta, count
+                                  in self.tracker._child_counts[element].iteritems() if count ] ) )
+
+        def start_scene_walk( self ):
+            """Checks the elements until the walk of the scene is in progress."""
+            walk_stack = self.tracker._walk_stack
+            while not walk_stack or walk_stack[0][0] is not self.scene_root or len( walk_stack ) < 2:
+                self.tracker._check_pending_elements( time.time() + 0.001 )
+            self.assert_( walk_stack[0][1] < len( self.scene_root ) - 1 )
+            return walk_stack
+
+        def test_remove_during_walk( self ):
+            walk_stack = self.start_scene_walk()
+            walked_element = walk_stack[1][0]
+            walked_element[0].set( walked_element[0].meta.attributes[0].name, 'modified' )
+            self.scene_root.remove( walked_element )
+            self.scene_root.remove( self.scene_root[0] ) # shifts the index of the walk
+            self.check_all()
+
+        def test_add_during_walk( self ):
+            walk_stack = self.start_scene_walk()
+            self.scene_root.insert( 0, self.scene_root[walk_stack[0][1]].clone() )
+            self.check_all()
+
+    unittest.main()
@@ -0,0 +1,185 @@
+"""Parallel zlib compression.
+
+The data is split into independent blocks that are deflated concurrently on a
+thread pool (zlib releases the GIL while compressing). Each block but the last
+one ends with a sync flush, so that the raw deflate streams can be
+concatenated, then wrapped in a zlib header and Adler-32 trailer: the result
+is a regular zlib stream that can be decompressed by zlib.decompress().
+
+Unlike pigz, blocks are not primed with the end of the previous block as a
+preset dictionary (zlib.compressobj() does not accept one in Python 2), so the
+output is slightly larger than with a single compressor.
+"""
+import zlib
+import struct
+import multiprocessing #@UnresolvedImport
+import multiprocessing.pool #@UnresolvedImport
+
+# Size of the blocks compressed independently. Matches pigz default.
+DEFAULT_BLOCK_SIZE = 128 * 1024
+
+_pools = {} # dict(threads: ThreadPool), shared by all compressors
+
+def default_threads():
+    """Returns the number of threads used when none is specified."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def _thread_pool( threads ):
+    pool = _pools.get( threads )
+    if pool is None:
+        pool = multiprocessing.pool.ThreadPool( threads )
+        _pools[threads] = pool
+    return pool
+
+def zlib_header( level ):
+    """Returns the 2 bytes zlib stream header for a 32KB window deflate
+       stream compressed at the specified level, as written by zlib."""
+    if level < 0:
+        level = 6 # Z_DEFAULT_COMPRESSION
+    if level < 2:
+        level_flags = 0
+    elif level < 6:
+        level_flags = 1
+    elif level == 6:
+        level_flags = 2
+    else:
+        level_flags = 3
+    header = ( ( zlib.DEFLATED + ( ( zlib.MAX_WBITS - 8 ) << 4 ) ) << 8 ) | ( level_flags << 6 )
+    header += 31 - header % 31
+    return struct.pack( '>H', header )
+
+def _deflate_block( task ):
+    """Returns the raw deflate stream of a block. task is a tuple
+       (level, data, last). Run in the pool threads."""
+    level, data, last = task
+    compressor = zlib.compressobj( level, zlib.DEFLATED, -zlib.MAX_WBITS )
+    return compressor.compress( data ) + compressor.flush( last and zlib.Z_FINISH or zlib.Z_SYNC_FLUSH )
+
+class ParallelCompressor( object ):
+    """Drop-in replacement of the object returned by zlib.compressobj().
+       compress() buffers the data until there is a block per thread to
+       compress, and returns the compressed data available so far.
+       flush() compresses the remaining data and terminates the stream.
+       threads: number of blocks compressed concurrently, by default one
+                per processor. With a single thread, a plain zlib
+                compressor is used.
+    """
+    def __init__( self, level = 9, threads = None, block_size = DEFAULT_BLOCK_SIZE ):
+        self.level = level
+        self.threads = threads or default_threads()
+        self.block_size = block_size
+        self._pending = []
+        self._pending_size = 0
+        self._adler = 1
+        self._header_written = False
+        if self.threads == 1:
+            self._compressor = zlib.compressobj( level )
+        else:
+            self._compressor = None
+
+    def compress( self, data ):
+        if self._compressor is not None:
+            return self._compressor.compress( data )
+        self._pending.append( data )
+        self._pending_size += len( data )
+        if self._pending_size < self.threads * self.block_size:
+            return ''
+        data = ''.join( self._pending )
+        block_count = len( data ) // self.block_size
+        end = block_count * self.block_size
+        self._pending = [ data[end:] ]
+        self._pending_size = len( data ) - end
+        blocks = [ data[start:start + self.block_size]
+                   for start in xrange( 0, end, self.block_size ) ]
+        return self._deflate( blocks, False )
+
+    def flush( self ):
+        if self._compressor is not None:
+            return self._compressor.flush()
+        data = ''.join( self._pending )
+        self._pending = []
+        self._pending_size = 0
+        blocks = [ data[start:start + self.block_size]
+                   for start in xrange( 0, len( data ), self.block_size ) ] or [ '' ]
+        return self._deflate( blocks, True ) + struct.pack( '>I', self._adler & 0xffffffff )
+
+    def _deflate( self, blocks, last ):
+        tasks = [ ( self.level, block, last and index == len( blocks ) - 1 )
+                  for index, block in enumerate( blocks ) ]
+        if len( tasks ) > 1:
+            compressed = _thread_pool( self.threads ).map( _deflate_block, tasks )
+        else:
+            compressed = map( _deflate_block, tasks )
+        for block in blocks:
+            self._adler = zlib.adler32( block, self._adler )
+        if not self._header_written:
+            self._header_written = True
+            compressed.insert( 0, zlib_header( self.level ) )
+        return ''.join( compressed )
+
+def compressobj( level = 9, threads = None ):
+    """Returns a zlib compressor using threads to compress at the level."""
+    return ParallelCompressor( level, threads )
+
+def compress( data, level = 9, threads = None ):
+    """Same as zlib.compress(), using threads to compress the data."""
+    compressor = ParallelCompressor( level, threads )
+    return compressor.compress( data ) + compressor.flush()
+
+def benchmark( size = 32 * 1024 * 1024 ):
+    """Compares the time and compressed size of zlib.compress() with
+       compress() for each compression level."""
+    import time #@UnresolvedImport
+    import random #@UnresolvedImport
+    generator = random.Random( 1234 )
+    # texture like data: flat areas, gradients and noise
+    noise = ''.join( [ chr( generator.randint( 0, 255 ) ) for index in xrange( 4096 ) ] )
+    gradient = ''.join( [ chr( index & 0xff ) * 4 for index in xrange( 1024 ) ] )
+    pattern = noise + gradient + '\0' * 8192
+    data = ( pattern * ( size / len( pattern ) + 1 ) )[:size]
+    for level in ( 1, 6, 9 ):
+        start_time = time.time()
+        expected = zlib.compress( data, level )
+        zlib_time = time.time() - start_time
+        start_time = time.time()
+        compressed = compress( data, level )
+        parallel_time = time.time() - start_time
+        assert zlib.decompress( compressed ) == data
+        print 'level %d: zlib %.2fs %d bytes, %d threads %.2fs %d bytes (x%.1f)' % (
+            level, zlib_time, len( expected ), default_threads(), parallel_time,
+            len( compressed ), zlib_time / max( parallel_time, 1e-6 ) )
+
+if __name__ == '__main__':
+    import sys
+    if sys.argv[1:] == ['benchmark']:
+        benchmark()
+        sys.exit( 0 )
+
+    import unittest #@UnresolvedImport
+
+    class ParallelCompressorTest( unittest.TestCase ):
+        def test_compress( self ):
+            data = ''.join( [ chr( ( index * 7 ) % 251 ) for index in xrange( 100000 ) ] )
+            for size in ( 0, 1, 1000, 4096, 4097, 100000 ):
+                for threads in ( 1, 2, 3 ):
+                    compressor = ParallelCompressor( 9, threads, block_size = 1024 )
+                    compressed = compressor.compress( data[:size] ) + compressor.flush()
+                    self.assertEqual( data[:size], zlib.decompress( compressed ) )
+
+        def test_streaming( self ):
+            compressor = ParallelCompressor( 6, 4, block_size = 100 )
+            chunks = [ str( index ) * ( index % 37 ) for index in xrange( 500 ) ]
+            compressed = ''.join( [ compressor.compress( chunk ) for chunk in chunks ] )
+            compressed += compressor.flush()
+            decompressor = zlib.decompressobj()
+            self.assertEqual( ''.join( chunks ), decompressor.decompress( compressed ) + decompressor.flush() )
+            self.assertEqual( '', decompressor.unused_data )
+
+        def test_header( self ):
+            for level in xrange( -1, 10 ):
+                self.assertEqual( zlib.compress( '', level )[:2], zlib_header( level ) )
+
+    unittest.main()
@@ -180,6 +180,11 @@ import sys
 import zlib
 # http://www.python.org/doc/2.4.4/lib/module-warnings.html
 import warnings
+# numpy is optional: it is used to accelerate the scanline filters.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 __all__ = ['Reader', 'Writer', 'write_chunks']
@@ -319,7 +324,8 @@ class Writer:
                  planes = None,
                  colormap = None,
                  maxval = None,
-                 chunk_limit = 2 ** 20 ):
+                 chunk_limit = 2 ** 20,
+                 compression_threads = 1 ):
         """
         Create a PNG encoder object.
 
@@ -349,6 +355,9 @@ class Writer:
           Create an interlaced image.
         chunk_limit
           Write multiple ``IDAT`` chunks to save memory.
+        compression_threads
+          Number of threads compressing the image data, ``None`` for
+          one per processor.
 
         The image size (in pixels) can be specified either by using the
         `width` and `height` arguments, or with the single `size`
@@ -419,6 +428,11 @@ class Writer:
 	no compression, rather it means that the default from the
 	``zlib`` module is used (which is generally acceptable).
 
+        If `compression_threads` is not 1, the image data is split in
+        blocks compressed concurrently by the ``parallelzlib`` module.
+        This is faster on multi-core machines at the cost of a slightly
+        larger file.
+
         If `interlace` is true then an interlaced image is created
         (using PNG's so far only interace method, *Adam7*).  This does not
         affect how the pixels should be presented to the encoder, rather
@@ -578,6 +592,7 @@ class Writer:
         self.bitdepth = int( bitdepth )
         self.compression = compression
         self.chunk_limit = chunk_limit
+        self.compression_threads = compression_threads
         self.interlace = bool( interlace )
         self.palette = check_palette( palette )
 
@@ -706,7 +721,13 @@ class Writer:
                             struct.pack( "!3H", *self.background ) )
 
         # http://www.w3.org/TR/PNG/#11IDAT
-        if self.compression is not None:
+        if self.compression_threads != 1:
+            import parallelzlib
+            if self.compression is not None:
+                compressor = parallelzlib.compressobj( self.compression, self.compression_threads )
+            else:
+                compressor = parallelzlib.compressobj( zlib.Z_DEFAULT_COMPRESSION, self.compression_threads )
+        elif self.compression is not None:
             compressor = zlib.compressobj( self.compression )
         else:
             compressor = zlib.compressobj()
@@ -970,6 +991,15 @@ def write_chunks( out, chunks ):
         write_chunk( out, *chunk )
 
 def filter_scanline( type, line, fo, prev = None ):
+    """Apply a scanline filter to a scanline.  Same as
+    :func:`filter_scanline_pure`, but uses the kernels selected by
+    :func:`use_filter_kernels`.
+    """
+
+    assert 0 <= type < 5
+    return _filter_scanline( type, line, fo, prev )
+
+def filter_scanline_pure( type, line, fo, prev = None ):
     """Apply a scanline filter to a scanline.  `type` specifies the
     filter type (0 to 4); `line` specifies the current (unfiltered)
     scanline as a sequence of bytes; `prev` specifies the previous
@@ -1035,7 +1065,7 @@ def filter_scanline( type, line, fo, prev = None ):
         # "left" (non-trivial, but true). "average" needs to be handled
         # specially.
         if type == 2: # "up"
-            return line # type = 0
+            type = 0
         elif type == 3:
             prev = [0] * len( line )
         elif type == 4: # "paeth"
@@ -1052,6 +1082,289 @@ def filter_scanline( type, line, fo, prev = None ):
         paeth()
     return out
 
+def _byte_array( bytes ):
+    """Returns a copy of the sequence of bytes as an ``array('B')``,
+    without iterating over the bytes when it already is one."""
+
+    if isarray( bytes ) and bytes.typecode == 'B':
+        return bytes[:]
+    return array( 'B', bytes )
+
+def _numpy_int16( bytes ):
+    """Returns the sequence of bytes as a numpy int16 array."""
+
+    if isarray( bytes ) and bytes.typecode == 'B':
+        return numpy.frombuffer( bytes, numpy.uint8 ).astype( numpy.int16 )
+    return numpy.array( bytes, numpy.int16 )
+
+def _filter_scanline_bytearray( type, line, fo, prev = None ):
+    """Same as :func:`filter_scanline_pure`, with the loops written as
+    list comprehensions over the whole scanline.
+    """
+
+    out = array( 'B', [type] )
+    n = len( line )
+    if type == 0:
+        out.extend( line )
+        return out
+    if not prev:
+        # "up" becomes "none", "paeth" becomes "sub", see
+        # filter_scanline_pure().
+        prev = [0] * n
+    # a: byte on the left, c: byte on the left in the previous line.
+    a = ( [0] * fo + list( line ) )[:n]
+    if type == 1:
+        out.extend( [( x - y ) & 0xff for x, y in itertools.izip( line, a )] )
+    elif type == 2:
+        out.extend( [( x - b ) & 0xff for x, b in itertools.izip( line, prev )] )
+    elif type == 3:
+        out.extend( [( x - ( ( y + b ) >> 1 ) ) & 0xff
+                     for x, y, b in itertools.izip( line, a, prev )] )
+    else: # type == 4
+        c = ( [0] * fo + list( prev ) )[:n]
+        filtered = []
+        append = filtered.append
+        for x, a, b, c in itertools.izip( line, a, prev, c ):
+            pa = abs( b - c )
+            pb = abs( a - c )
+            pc = abs( a + b - c - c )
+            if pa <= pb and pa <= pc: append( ( x - a ) & 0xff )
+            elif pb <= pc: append( ( x - b ) & 0xff )
+            else: append( ( x - c ) & 0xff )
+        out.extend( filtered )
+    return out
+
+def _filter_scanline_numpy( type, line, fo, prev = None ):
+    """Same as :func:`filter_scanline_pure`, vectorized with numpy: unlike
+    undoing them, applying the filters does not depend on the previously
+    computed output bytes.
+    """
+
+    out = array( 'B', [type] )
+    if type == 0:
+        out.extend( line )
+        return out
+    x = _numpy_int16( line )
+    n = len( x )
+    if prev:
+        b = _numpy_int16( prev )
+    else:
+        # With a zero previous line, "up" is "none" and "paeth" is "sub".
+        b = numpy.zeros( n, numpy.int16 )
+    a = numpy.zeros( n, numpy.int16 )
+    a[fo:] = x[:n - fo]
+    if type == 1:
+        x -= a
+    elif type == 2:
+        x -= b
+    elif type == 3:
+        x -= ( a + b ) >> 1
+    else: # type == 4
+        c = numpy.zeros( n, numpy.int16 )
+        c[fo:] = b[:n - fo]
+        pa = numpy.abs( b - c )
+        pb = numpy.abs( a - c )
+        pc = numpy.abs( a + b - c - c )
+        x -= numpy.where( ( pa <= pb ) & ( pa <= pc ), a, numpy.where( pb <= pc, b, c ) )
+    out.fromstring( ( x & 0xff ).astype( numpy.uint8 ).tostring() )
+    return out
+
+def undo_filter_pure( filter_type, scanline, previous, fu ):
+    """Undo the filter for a scanline, see :meth:`Reader.undo_filter`.
+    `fu` is the filter unit: the size of a pixel in bytes, or 1 for bit
+    depths < 8.  This is the reference implementation of the kernels
+    selected by :func:`use_filter_kernels`.
+    """
+
+    # :todo: Would it be better to update scanline in place?
+
+    # Create the result byte array.  It seems that the best way to
+    # create the array to be the right size is to copy from an
+    # existing sequence.  *sigh*
+    # If we fill the result with scanline, then this allows a
+    # micro-optimisation in the "null" and "sub" cases.
+    result = array( 'B', scanline )
+
+    if filter_type == 0:
+        # And here, we _rely_ on filling the result with scanline,
+        # above.
+        return result
+
+    if filter_type not in ( 1, 2, 3, 4 ):
+        raise FormatError( 'Invalid PNG Filter Type.'
+          '  See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .' )
+
+    # For the first line of a pass, synthesize a dummy previous
+    # line.  An alternative approach would be to observe that on the
+    # first line 'up' is the same as 'null', 'paeth' is the same
+    # as 'sub', with only 'average' requiring any special case.
+    if not previous:
+        previous = array( 'B', [0] * len( scanline ) )
+
+    def sub():
+        """Undo sub filter."""
+
+        ai = 0
+        # Loops starts at index fu.  Observe that the initial part
+        # of the result is already filled in correctly with
+        # scanline.
+        for i in range( fu, len( result ) ):
+            x = scanline[i]
+            a = result[ai]
+            result[i] = ( x + a ) & 0xff
+            ai += 1
+
+    def up():
+        """Undo up filter."""
+
+        for i in range( len( result ) ):
+            x = scanline[i]
+            b = previous[i]
+            result[i] = ( x + b ) & 0xff
+
+    def average():
+        """Undo average filter."""
+
+        ai = -fu
+        for i in range( len( result ) ):
+            x = scanline[i]
+            if ai < 0:
+                a = 0
+            else:
+                a = result[ai]
+            b = previous[i]
+            result[i] = ( x + ( ( a + b ) >> 1 ) ) & 0xff
+            ai += 1
+
+    def paeth():
+        """Undo Paeth filter."""
+
+        # Also used for ci.
+        ai = -fu
+        for i in range( len( result ) ):
+            x = scanline[i]
+            if ai < 0:
+                a = c = 0
+            else:
+                a = result[ai]
+                c = previous[ai]
+            b = previous[i]
+            p = a + b - c
+            pa = abs( p - a )
+            pb = abs( p - b )
+            pc = abs( p - c )
+            if pa <= pb and pa <= pc:
+                pr = a
+            elif pb <= pc:
+                pr = b
+            else:
+                pr = c
+            result[i] = ( x + pr ) & 0xff
+            ai += 1
+
+    # Call appropriate filter algorithm.  Note that 0 has already
+    # been dealt with.
+    ( None, sub, up, average, paeth )[filter_type]()
+    return result
+
+def _undo_filter_bytearray( filter_type, scanline, previous, fu ):
+    """Same as :func:`undo_filter_pure`, working in place in a bytearray.
+    The bytes of each channel are processed in sequence, so that the
+    reconstructed byte on the left and the byte above it are carried over
+    in local variables instead of being indexed again.
+    """
+
+    if filter_type == 0:
+        return _byte_array( scanline )
+    if filter_type not in ( 1, 2, 3, 4 ):
+        return undo_filter_pure( filter_type, scanline, previous, fu )
+    result = bytearray( scanline )
+    n = len( result )
+    if not previous:
+        if filter_type == 2:
+            return _byte_array( scanline )
+        if filter_type == 4:
+            filter_type = 1
+        else:
+            previous = bytearray( n )
+    if filter_type == 2:
+        result = bytearray( [( x + b ) & 0xff for x, b in itertools.izip( scanline, previous )] )
+        return array( 'B', str( result ) )
+    for channel in xrange( min( fu, n ) ):
+        if filter_type == 1:
+            a = result[channel]
+            for i in xrange( channel + fu, n, fu ):
+                a = result[i] = ( result[i] + a ) & 0xff
+        elif filter_type == 3:
+            a = result[channel] = ( result[channel] + ( previous[channel] >> 1 ) ) & 0xff
+            for i in xrange( channel + fu, n, fu ):
+                a = result[i] = ( result[i] + ( ( a + previous[i] ) >> 1 ) ) & 0xff
+        else: # filter_type == 4
+            # Without a left pixel, the predictor is always the byte above.
+            c = previous[channel]
+            a = result[channel] = ( result[channel] + c ) & 0xff
+            for i in xrange( channel + fu, n, fu ):
+                b = previous[i]
+                pa = abs( b - c )
+                pb = abs( a - c )
+                pc = abs( a + b - c - c )
+                if pa <= pb and pa <= pc:
+                    a = result[i] = ( result[i] + a ) & 0xff
+                elif pb <= pc:
+                    a = result[i] = ( result[i] + b ) & 0xff
+                else:
+                    a = result[i] = ( result[i] + c ) & 0xff
+                c = b
+    return array( 'B', str( result ) )
+
+def _undo_filter_numpy( filter_type, scanline, previous, fu ):
+    """Same as :func:`undo_filter_pure`.  "sub" is a cumulative sum per
+    channel and "up" an element-wise sum, both vectorized with numpy.
+    "average" and "paeth" depend on the previously reconstructed byte,
+    so they use the bytearray kernel.
+    """
+
+    n = len( scanline )
+    if filter_type == 1 and n % fu == 0:
+        pixels = numpy.frombuffer( scanline, numpy.uint8 ).reshape( n // fu, fu )
+        # uint8 arithmetic wraps modulo 256, as required.
+        return array( 'B', numpy.cumsum( pixels, axis = 0, dtype = numpy.uint8 ).tostring() )
+    if filter_type == 2 and previous:
+        result = numpy.frombuffer( scanline, numpy.uint8 ) + numpy.frombuffer( previous, numpy.uint8 )
+        return array( 'B', result.tostring() )
+    return _undo_filter_bytearray( filter_type, scanline, previous, fu )
+
+# Scanline filter kernels by name: (undo filter, filter scanline)
+_filter_kernels = {
+    'pure': ( undo_filter_pure, filter_scanline_pure ),
+    'bytearray': ( _undo_filter_bytearray, _filter_scanline_bytearray ) }
+if numpy is not None:
+    _filter_kernels['numpy'] = ( _undo_filter_numpy, _filter_scanline_numpy )
+
+def filter_kernels_names():
+    """Returns the names of the available scanline filter kernels."""
+    return sorted( _filter_kernels.keys() )
+
+def use_filter_kernels( name = None ):
+    """Selects the kernels used by :meth:`Reader.undo_filter` and
+    :func:`filter_scanline`: 'pure', 'bytearray' or 'numpy'.  By default,
+    the numpy ones if numpy is installed, otherwise the bytearray ones.
+    Returns the previously selected kernels name.
+    """
+
+    global _undo_filter, _filter_scanline, filter_kernels
+    if name is None:
+        name = numpy is not None and 'numpy' or 'bytearray'
+    if name not in _filter_kernels:
+        raise ValueError( 'Unknown filter kernels %r, expected one of %s'
+                          % ( name, ', '.join( filter_kernels_names() ) ) )
+    previous_name = globals().get( 'filter_kernels' )
+    _undo_filter, _filter_scanline = _filter_kernels[name]
+    filter_kernels = name
+    return previous_name
+
+use_filter_kernels()
+
 
 class _readable:
     """
@@ -1190,23 +1503,11 @@ class Reader:
 
         The scanline will have the effects of filtering removed, and the
         result will be returned as a fresh sequence of bytes.
+        The filter is undone by the kernels selected by
+        :func:`use_filter_kernels`.
         """
 
-        # :todo: Would it be better to update scanline in place?
-
-        # Create the result byte array.  It seems that the best way to
-        # create the array to be the right size is to copy from an
-        # existing sequence.  *sigh*
-        # If we fill the result with scanline, then this allows a
-        # micro-optimisation in the "null" and "sub" cases.
-        result = array( 'B', scanline )
-
-        if filter_type == 0:
-            # And here, we _rely_ on filling the result with scanline,
-            # above.
-            return result
-
-        if filter_type not in ( 1, 2, 3, 4 ):
+        if filter_type not in ( 0, 1, 2, 3, 4 ):
             raise FormatError( 'Invalid PNG Filter Type.'
               '  See http://www.w3.org/TR/2003/REC-PNG-20031110/#9Filters .' )
 
@@ -1214,80 +1515,7 @@ class Reader:
         # byte from the previous previous.  Normally this is the pixel
         # size in bytes, but when this is smaller than 1, the previous
         # byte is used instead.
-        fu = max( 1, self.psize )
-
-        # For the first line of a pass, synthesize a dummy previous
-        # line.  An alternative approach would be to observe that on the
-        # first line 'up' is the same as 'null', 'paeth' is the same
-        # as 'sub', with only 'average' requiring any special case.
-        if not previous:
-            previous = array( 'B', [0] * len( scanline ) )
-
-        def sub():
-            """Undo sub filter."""
-
-            ai = 0
-            # Loops starts at index fu.  Observe that the initial part
-            # of the result is already filled in correctly with
-            # scanline.
-            for i in range( fu, len( result ) ):
-                x = scanline[i]
-                a = result[ai]
-                result[i] = ( x + a ) & 0xff
-                ai += 1
-
-        def up():
-            """Undo up filter."""
-
-            for i in range( len( result ) ):
-                x = scanline[i]
-                b = previous[i]
-                result[i] = ( x + b ) & 0xff
-
-        def average():
-            """Undo average filter."""
-
-            ai = -fu
-            for i in range( len( result ) ):
-                x = scanline[i]
-                if ai < 0:
-                    a = 0
-                else:
-                    a = result[ai]
-                b = previous[i]
-                result[i] = ( x + ( ( a + b ) >> 1 ) ) & 0xff
-                ai += 1
-
-        def paeth():
-            """Undo Paeth filter."""
-
-            # Also used for ci.
-            ai = -fu
-            for i in range( len( result ) ):
-                x = scanline[i]
-                if ai < 0:
-                    a = c = 0
-                else:
-                    a = result[ai]
-                    c = previous[ai]
-                b = previous[i]
-                p = a + b - c
-                pa = abs( p - a )
-                pb = abs( p - b )
-                pc = abs( p - c )
-                if pa <= pb and pa <= pc:
-                    pr = a
-                elif pb <= pc:
-                    pr = b
-                else:
-                    pr = c
-                result[i] = ( x + pr ) & 0xff
-                ai += 1
-
-        # Call appropriate filter algorithm.  Note that 0 has already
-        # been dealt with.
-        ( None, sub, up, average, paeth )[filter_type]()
-        return result
+        return _undo_filter( filter_type, scanline, previous, max( 1, self.psize ) )
 
     def deinterlace( self, raw ):
         """
@@ -2394,6 +2622,28 @@ class Test( unittest.TestCase ):
             data = data.encode( 'zip' )
             return ( chunk[0], data )
         self.assertRaises( FormatError, self.helperFormat, eachchunk )
+    def testFilterKernels( self ):
+        """Check the filter kernels against the pure ones."""
+        import random
+        generator = random.Random( 1 )
+        for fo in ( 1, 3, 4 ):
+            prev = array( 'B', [generator.randint( 0, 255 ) for i in range( 12 * fo )] )
+            line = array( 'B', [generator.randint( 0, 255 ) for i in range( 12 * fo )] )
+            for type in range( 5 ):
+                for previous in ( None, prev ):
+                    expected = filter_scanline_pure( type, line, fo, previous )
+                    for name in filter_kernels_names():
+                        undo, filter = _filter_kernels[name]
+                        self.assertEqual( expected, filter( type, line, fo, previous ) )
+                        self.assertEqual( line, undo( type, expected[1:], previous, fo ) )
+    def testCompressionThreads( self ):
+        """Test compressing with several threads."""
+        rows = [range( i, i + 300 ) for i in range( 0, 256 * 3, 3 )]
+        rows = [map( lambda x: x & 0xff, row ) for row in rows]
+        pngdata = topngbytes( 'threads.png', rows, 100, 256, compression = 9,
+                              compression_threads = 3 )
+        x, y, pixels, meta = Reader( bytes = pngdata ).read() #@UnusedVariable
+        self.assertEqual( map( list, pixels ), rows )
     def testFlat( self ):
         """Test read_flat."""
         import hashlib
@@ -3435,8 +3685,75 @@ def _main( argv ):
         else:
             writer.convert_pnm( infile, outfile )
 
+def benchmark_filters( width = 512, height = 512 ):
+    """Measures the time spent by each available scanline filter kernels
+    to filter and unfilter a RGBA texture with each filter type, and to
+    read a PNG using all the filter types.
+    """
+
+    import random
+    import time
+    generator = random.Random( 1234 )
+    # A texture with flat areas, gradients and noise.
+    noise = [generator.randint( 0, 255 ) for i in range( 4096 )]
+    rows = []
+    for y in range( height ):
+        row = array( 'B' )
+        for x in range( width ):
+            if x < width // 3:
+                row.extend( ( 32, 64, 128, 255 ) )
+            elif x < 2 * width // 3:
+                row.extend( ( x & 0xff, y & 0xff, ( x + y ) & 0xff, 255 ) )
+            else:
+                row.extend( noise[( x * 4 + y * 7 ) % 4092:( x * 4 + y * 7 ) % 4092 + 4] )
+        rows.append( row )
+    filter_names = ( 'none', 'sub', 'up', 'average', 'paeth' )
+    previous_kernels = filter_kernels
+    try:
+        for name in filter_kernels_names():
+            use_filter_kernels( name )
+            for type in range( 5 ):
+                start_time = time.time()
+                filtered = []
+                prev = None
+                for row in rows:
+                    filtered.append( filter_scanline( type, row, 4, prev ) )
+                    prev = row
+                filter_time = time.time() - start_time
+                start_time = time.time()
+                prev = None
+                for line in filtered:
+                    prev = _undo_filter( line[0], line[1:], prev, 4 )
+                undo_time = time.time() - start_time
+                print '%(kernels)-9s %(filter)-7s filter %(filter_time)6.3fs, undo %(undo_time)6.3fs' % {
+                    'kernels': name, 'filter': filter_names[type],
+                    'filter_time': filter_time, 'undo_time': undo_time }
+            # A PNG with the filter type of each row cycling over all types.
+            use_filter_kernels( 'pure' )
+            data = array( 'B' )
+            prev = None
+            for y, row in enumerate( rows ):
+                data.extend( filter_scanline( y % 5, row, 4, prev ) )
+                prev = row
+            use_filter_kernels( name )
+            output = StringIO()
+            write_chunks( output, [
+                ( 'IHDR', struct.pack( "!2I5B", width, height, 8, 6, 0, 0, 0 ) ),
+                ( 'IDAT', zlib.compress( tostring( data ) ) ),
+                ( 'IEND', '' ) ] )
+            start_time = time.time()
+            pixels = Reader( bytes = output.getvalue() ).asRGBA8()[2]
+            for row in pixels:
+                pass
+            print '%-9s read PNG %dx%d with all filter types: %.3fs' % ( name, width, height,
+                                                                          time.time() - start_time )
+    finally:
+        use_filter_kernels( previous_kernels )
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['benchmark']:
+        benchmark_filters()
+        sys.exit( 0 )
     try:
         _main( sys.argv )
     except Error, e:
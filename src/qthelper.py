@@ -86,6 +86,17 @@ def standardModelTreeItems( model, root_index = None ):
         items.append( model.itemFromIndex( index ) )
     return items
 
+def graphicsItemDescendants( item ):
+    """Returns all the child items of the specified QGraphicsItem recursively.
+    """
+    items = []
+    parent_items = list( item.childItems() )
+    while parent_items:
+        child = parent_items.pop()
+        parent_items.extend( child.childItems() )
+        items.append( child )
+    return items
+
 def get_row_item_sibling( item, column ):
     """Returns the item corresponding to the column column on the same row as item.
     """
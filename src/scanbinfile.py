@@ -1,7 +1,13 @@
 import wogfile
+import filemanifest
 import os.path
 import optparse #@UnresolvedImport
 import sys
+import time #@UnresolvedImport
+import multiprocessing #@UnresolvedImport
+
+# Name of the manifest written in the output directory in incremental mode
+MANIFEST_FILE_NAME = '.scanbinfile-manifest.json'
 
 def make_path_dirs( path ):
     """Creates the parent directory of the specified file path if required.
@@ -12,35 +18,134 @@ def make_path_dirs( path ):
         print 'Created directory: "%s"' % parent_dir
     return True
 
-def decrypt_dir_files( input_dir, output_dir ):
+def decrypted_file_name( entry ):
+    """Returns the name of the .xml file corresponding to the .bin file entry."""
+    entry_xml = os.path.splitext( entry )[0]
+    if not entry_xml.lower().endswith( '.xml' ):
+        entry_xml += '.xml'
+    return entry_xml
+
+def encrypted_file_name( entry ):
+    """Returns the name of the .bin file corresponding to the .xml file entry.
+       Inverse of decrypted_file_name(): name.level.xml is encrypted into
+       name.level.bin, but name.xml into name.xml.bin.
+    """
+    entry_bin, extension = os.path.splitext( entry )
+    if extension.lower() == '.xml' and not os.path.splitext( entry_bin )[1]:
+        entry_bin = entry
+    return entry_bin + '.bin'
+
+def list_dir_files( input_dir, output_dir, extension, output_name ):
+    """Walks the directory tree once and returns the list of tuple
+       (input_path, output_path) for all the files with the specified
+       extension. output_name( entry ) returns the output file name.
+    """
+    files = []
+    for dir_path, dir_names, file_names in os.walk( input_dir ): #@UnusedVariable
+        relative_dir = os.path.relpath( dir_path, input_dir )
+        for entry in file_names:
+            if os.path.splitext( entry )[1].lower() == extension:
+                output_path = os.path.normpath( os.path.join( output_dir, relative_dir, output_name( entry ) ) )
+                files.append( ( os.path.join( dir_path, entry ), output_path ) )
+    return files
+
+def convert_file( task ):
+    """Decrypts or encrypts a single file.
+       task is a tuple (encrypt, input_path, output_path, with_digest).
+       Returns a tuple (input_path, output_path, input_size, digest, error) where
+       error is None on success, and digest is the content hash of the input
+       file if with_digest is True.
+       Run in the worker processes, so errors are returned instead of being raised.
+    """
+    encrypt, input_path, output_path, with_digest = task
+    try:
+        if encrypt:
+            wogfile.encrypt_file( input_path, output_path )
+        else:
+            wogfile.decrypt_file( input_path, output_path )
+        digest = with_digest and filemanifest.file_digest( input_path ) or None
+        return input_path, output_path, os.path.getsize( input_path ), digest, None
+    except ( IOError, OSError, ValueError ), e:
+        if os.path.isfile( output_path ): # do not leave a partially converted file
+            os.remove( output_path )
+        return input_path, output_path, 0, None, unicode( e )
+
+def convert_dir_files( input_dir, output_dir, encrypt = False, jobs = 1, manifest = None ):
+    """Decrypts all .bin files (or encrypts all .xml files if encrypt is True)
+       found in the directory and its subdirectories into output_dir.
+       jobs: number of processes used to convert the files.
+       manifest: if specified, a filemanifest.FileManifest used to skip the
+                 files that did not change since they were converted, and
+                 to remove the outputs of the deleted files.
+       Returns a tuple (converted_count, converted_bytes, errors) where errors
+       is a list of tuple (input_path, error message).
+    """
+    if encrypt:
+        files = list_dir_files( input_dir, output_dir, '.xml', encrypted_file_name )
+    else:
+        files = list_dir_files( input_dir, output_dir, '.bin', decrypted_file_name )
+    if manifest is not None:
+        manifest.remove_stale( [ input_path for input_path, output_path in files ], input_dir ) #@UnusedVariable
+        files = [ ( input_path, output_path ) for input_path, output_path in files
+                  if not manifest.is_up_to_date( input_path, output_path ) ]
+    # create the output directories once, before dispatching the files
+    output_path_by_dir = dict( [ ( os.path.dirname( output_path ), output_path )
+                                 for input_path, output_path in files ] ) #@UnusedVariable
+    for output_path in output_path_by_dir.itervalues():
+        make_path_dirs( output_path )
+    tasks = [ ( encrypt, input_path, output_path, manifest is not None )
+              for input_path, output_path in files ]
+    if jobs > 1 and len( tasks ) > 1:
+        pool = multiprocessing.Pool( jobs )
+        try:
+            results = pool.map( convert_file, tasks, chunksize = max( 1, len( tasks ) / ( jobs * 8 ) ) )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map( convert_file, tasks )
+    converted_count, converted_bytes, errors = 0, 0, []
+    for input_path, output_path, size, digest, error in results:
+        if error is None:
+            converted_count += 1
+            converted_bytes += size
+            if manifest is not None:
+                manifest.update( input_path, output_path, digest )
+        else:
+            errors.append( ( input_path, error ) )
+    return converted_count, converted_bytes, errors
+
+def decrypt_dir_files( input_dir, output_dir, jobs = 1 ):
     """Decrypts all .bin files found in the directory and
     recurse in subdirectories."""
-    for entry in os.listdir( input_dir ):
-        entry_path = os.path.join( input_dir, entry )
-        if os.path.isdir( entry_path ):
-            if not decrypt_dir_files( entry_path,
-                                      os.path.join( output_dir, entry ) ):
-                return False
-        elif os.path.splitext( entry )[1].lower() == '.bin':
-            entry_xml = os.path.splitext( entry )[0]
-            if not entry_xml.lower().endswith( '.xml' ):
-                entry_xml += '.xml'
-            output_path = os.path.join( output_dir, entry_xml )
-            if not make_path_dirs( output_path ):
-                return False
-            if not wogfile.decrypt_file( entry_path, output_path ):
-                return False
-    return True
+    converted_count, converted_bytes, errors = convert_dir_files( input_dir, output_dir, False, jobs ) #@UnusedVariable
+    return not errors
+
+def encrypt_dir_files( input_dir, output_dir, jobs = 1 ):
+    """Encrypts all .xml files found in the directory and
+    recurse in subdirectories."""
+    converted_count, converted_bytes, errors = convert_dir_files( input_dir, output_dir, True, jobs ) #@UnusedVariable
+    return not errors
 
 def main():
-    parser = optparse.OptionParser( """%prog res-dir-path output-dir-path
+    parser = optparse.OptionParser( """%prog [--encrypt] [--jobs N] res-dir-path output-dir-path
 
 This applications decrypt all *.bin files found in res-dir-path sub-directories,
 and output them in output-dir-path after replacing the extension with .xml.
+With --encrypt, all *.xml files are encrypted into *.bin files instead.
 """ )
-    ( options, args ) = parser.parse_args() #@UnusedVariable
+    parser.add_option( '-e', '--encrypt', dest = 'encrypt', action = "store_true", default = False,
+                       help = 'Encrypt *.xml files instead of decrypting *.bin files' )
+    parser.add_option( '-j', '--jobs', dest = 'jobs', type = 'int', default = 1,
+                       help = 'Number of processes used to convert the files' )
+    parser.add_option( '-i', '--incremental', dest = 'incremental', action = "store_true", default = False,
+                       help = 'Only convert the files modified since the previous incremental run, '
+                              'and remove the outputs of the deleted files' )
+    ( options, args ) = parser.parse_args()
     if len( args ) != 2:
         parser.error( 'You must specify the input and ouput path' )
+    if options.jobs < 1:
+        parser.error( 'The number of jobs must be at least 1' )
 
     levels_dir, output_dir = args[0], args[1]
     if not os.path.isdir( levels_dir ):
@@ -48,15 +153,46 @@ and output them in output-dir-path after replacing the extension with .xml.
     if not os.path.isdir( output_dir ):
         parser.error( '"%s" is not a directory' % output_dir )
 
-    if decrypt_dir_files( levels_dir, output_dir ):
-        print 'Done.'
-        return True
-    else:
+    manifest = None
+    if options.incremental:
+        manifest = filemanifest.FileManifest( os.path.join( output_dir, MANIFEST_FILE_NAME ) )
+    start_time = time.time()
+    converted_count, converted_bytes, errors = convert_dir_files( levels_dir, output_dir,
+                                                                  options.encrypt, options.jobs,
+                                                                  manifest )
+    elapsed = max( time.time() - start_time, 1e-6 )
+    if manifest is not None:
+        manifest.save()
+        print '%d files skipped, %d converted, %d removed' % (
+            manifest.skipped, manifest.converted, manifest.removed )
+    for input_path, error in errors:
+        print 'Error: failed to convert "%s": %s' % ( input_path, error )
+    print '%d files (%.1f MB) converted in %.2fs: %.1f files/s, %.1f MB/s' % (
+        converted_count, converted_bytes / ( 1024.0 * 1024.0 ), elapsed,
+        converted_count / elapsed, converted_bytes / ( 1024.0 * 1024.0 ) / elapsed )
+    if errors:
+        print '%d files failed' % len( errors )
         return False
+    print 'Done.'
+    return True
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['test']:
+        import unittest #@UnresolvedImport
+
+        class FileNameTest( unittest.TestCase ):
+            def test_round_trip( self ):
+                for entry, entry_xml in ( ( 'text.xml.bin', 'text.xml' ),
+                                          ( 'balls.xml.bin', 'balls.xml' ),
+                                          ( 'Fx.XML.bin', 'Fx.XML' ),
+                                          ( 'GoingUp.level.bin', 'GoingUp.level.xml' ),
+                                          ( 'GoingUp.scene.bin', 'GoingUp.scene.xml' ),
+                                          ( 'GoingUp.resrc.bin', 'GoingUp.resrc.xml' ) ):
+                    self.assertEqual( entry_xml, decrypted_file_name( entry ) )
+                    self.assertEqual( entry, encrypted_file_name( entry_xml ) )
+
+        unittest.main( argv = sys.argv[:1] )
     succeed = main()
     if not succeed:
         print 'Failed'
         sys.exit( 2 )
-
@@ -0,0 +1,194 @@
+"""On-disk cache of decoded images.
+
+Each cached image is stored in its own file as a raw 32 bits pixel buffer,
+ready to be copied into a premultiplied QImage without decoding the PNG.
+Entries are keyed by the source image path, and are only valid while the
+source file modification time and size are unchanged.
+"""
+import os
+import os.path
+import mmap
+import struct
+import hashlib
+
+CACHE_FILE_EXTENSION = '.tex'
+# magic, source mtime, source size, width, height, bytes per line, source path length
+_HEADER_FORMAT = '<8sdqIIII'
+_HEADER_SIZE = struct.calcsize( _HEADER_FORMAT )
+_MAGIC = 'AMYTEX01'
+
+class TextureDiskCache( object ):
+    """Persists decoded image pixels in cache_dir.
+       Cached files are memory-mapped when read back.
+    """
+    def __init__( self, cache_dir ):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _cache_path( self, source_path ):
+        key = os.path.normcase( os.path.abspath( source_path ) )
+        if isinstance( key, unicode ):
+            key = key.encode( 'utf-8' )
+        return os.path.join( self.cache_dir, hashlib.sha1( key ).hexdigest() + CACHE_FILE_EXTENSION )
+
+    def load( self, source_path ):
+        """Returns the tuple (width, height, bytes_per_line, pixels) cached for
+           the source image, or None if there is no up to date entry.
+           Out of date entries are removed.
+        """
+        cache_path = self._cache_path( source_path )
+        try:
+            source_stat = os.stat( source_path )
+            cache_file = open( cache_path, 'rb' )
+        except ( OSError, IOError ):
+            self.misses += 1
+            return None
+        try:
+            try:
+                mapped = mmap.mmap( cache_file.fileno(), 0, access = mmap.ACCESS_READ )
+            except ( mmap.error, ValueError ):
+                mapped = None
+            if mapped is not None:
+                try:
+                    entry = self._read_entry( mapped, source_stat )
+                finally:
+                    mapped.close()
+            else:
+                entry = None
+        finally:
+            cache_file.close()
+        if entry is None:
+            self._remove( cache_path )
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _read_entry( self, mapped, source_stat ):
+        if len( mapped ) < _HEADER_SIZE:
+            return None
+        magic, mtime, size, width, height, bytes_per_line, path_length = \
+            struct.unpack( _HEADER_FORMAT, mapped[:_HEADER_SIZE] )
+        if magic != _MAGIC or mtime != source_stat.st_mtime or size != source_stat.st_size:
+            return None
+        offset = _HEADER_SIZE + path_length
+        pixels_size = bytes_per_line * height
+        if len( mapped ) != offset + pixels_size:
+            return None
+        return width, height, bytes_per_line, mapped[offset:offset + pixels_size]
+
+    def store( self, source_path, width, height, bytes_per_line, pixels ):
+        """Caches the decoded pixels of the source image.
+           Failure to write the cache is not an error: the image will just
+           be decoded again next time.
+        """
+        try:
+            source_stat = os.stat( source_path )
+            if not os.path.isdir( self.cache_dir ):
+                os.makedirs( self.cache_dir )
+        except OSError:
+            return False
+        encoded_path = os.path.abspath( source_path )
+        if isinstance( encoded_path, unicode ):
+            encoded_path = encoded_path.encode( 'utf-8' )
+        header = struct.pack( _HEADER_FORMAT, _MAGIC, source_stat.st_mtime, source_stat.st_size,
+                              width, height, bytes_per_line, len( encoded_path ) )
+        cache_path = self._cache_path( source_path )
+        temp_path = cache_path + '.tmp'
+        try:
+            with open( temp_path, 'wb' ) as cache_file:
+                cache_file.write( header )
+                cache_file.write( encoded_path )
+                cache_file.write( pixels )
+            if os.path.exists( cache_path ): # rename does not overwrite on Windows
+                os.remove( cache_path )
+            os.rename( temp_path, cache_path )
+        except ( OSError, IOError ):
+            self._remove( temp_path )
+            return False
+        self.stores += 1
+        return True
+
+    def evict_stale( self ):
+        """Removes the entries whose source image was modified or deleted.
+           Returns the number of removed entries.
+        """
+        if not os.path.isdir( self.cache_dir ):
+            return 0
+        evicted = 0
+        for entry in os.listdir( self.cache_dir ):
+            if not entry.endswith( CACHE_FILE_EXTENSION ):
+                continue
+            cache_path = os.path.join( self.cache_dir, entry )
+            if self._is_stale( cache_path ):
+                self._remove( cache_path )
+                evicted += 1
+        return evicted
+
+    def _is_stale( self, cache_path ):
+        try:
+            with open( cache_path, 'rb' ) as cache_file:
+                header = cache_file.read( _HEADER_SIZE )
+                if len( header ) != _HEADER_SIZE:
+                    return True
+                magic, mtime, size, width, height, bytes_per_line, path_length = \
+                    struct.unpack( _HEADER_FORMAT, header ) #@UnusedVariable
+                if magic != _MAGIC:
+                    return True
+                source_path = cache_file.read( path_length ).decode( 'utf-8' )
+            source_stat = os.stat( source_path )
+        except ( OSError, IOError, UnicodeDecodeError ):
+            return True
+        return mtime != source_stat.st_mtime or size != source_stat.st_size
+
+    def clear( self ):
+        """Removes all the cached entries."""
+        if os.path.isdir( self.cache_dir ):
+            for entry in os.listdir( self.cache_dir ):
+                if entry.endswith( CACHE_FILE_EXTENSION ):
+                    self._remove( os.path.join( self.cache_dir, entry ) )
+
+    def _remove( self, path ):
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+if __name__ == '__main__':
+    import unittest #@UnresolvedImport
+    import tempfile #@UnresolvedImport
+    import shutil #@UnresolvedImport
+
+    class TextureDiskCacheTest( unittest.TestCase ):
+        def setUp( self ):
+            self.temp_dir = tempfile.mkdtemp()
+            self.source_path = os.path.join( self.temp_dir, 'image.png' )
+            with open( self.source_path, 'wb' ) as source_file:
+                source_file.write( 'not really a png' )
+            self.cache = TextureDiskCache( os.path.join( self.temp_dir, 'cache' ) )
+
+        def tearDown( self ):
+            shutil.rmtree( self.temp_dir )
+
+        def test_store_load( self ):
+            self.assertEqual( None, self.cache.load( self.source_path ) )
+            pixels = ''.join( [ chr( index % 256 ) for index in xrange( 3 * 8 * 4 ) ] )
+            self.assert_( self.cache.store( self.source_path, 8, 3, 32, pixels ) )
+            self.assertEqual( ( 8, 3, 32, pixels ), self.cache.load( self.source_path ) )
+            self.assertEqual( ( 1, 1 ), ( self.cache.hits, self.cache.misses ) )
+
+        def test_stale( self ):
+            self.cache.store( self.source_path, 1, 1, 4, '\0\0\0\0' )
+            self.assertEqual( 0, self.cache.evict_stale() )
+            with open( self.source_path, 'ab' ) as source_file:
+                source_file.write( 'modified' )
+            self.assertEqual( 1, self.cache.evict_stale() )
+            self.assertEqual( None, self.cache.load( self.source_path ) )
+            self.cache.store( self.source_path, 1, 1, 4, '\0\0\0\0' )
+            os.remove( self.source_path )
+            self.assertEqual( 1, self.cache.evict_stale() )
+            self.assertEqual( [], os.listdir( self.cache.cache_dir ) )
+
+    unittest.main()
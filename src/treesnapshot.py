@@ -0,0 +1,336 @@
+"""Binary snapshots of the trees of a world.
+
+A snapshot stores the elements of several trees, as loaded from their source
+files, so that they can be rebuilt without parsing the XML or YAML sources:
+- all the strings (tags, attribute names and values, texts) are interned in a
+  single string table;
+- each tree is an array of integers listing its elements in document order:
+  tag, text, attribute count, child count, then the (name, value) string
+  indexes of each attribute.
+
+A snapshot is only valid while all its source files keep their modification
+time and size, and while the description of the trees is unchanged.
+"""
+import os
+import os.path
+import sys
+import struct
+import hashlib
+from array import array
+
+import metaworld
+
+SNAPSHOT_FILE_EXTENSION = '.snap'
+# magic, schema digest, source count, string count, tree count
+_HEADER_FORMAT = '<8s40sIII'
+_HEADER_SIZE = struct.calcsize( _HEADER_FORMAT )
+_MAGIC = 'AMYSNAP1'
+# source mtime, source size, source path length
+_SOURCE_FORMAT = '<dqI'
+_SOURCE_SIZE = struct.calcsize( _SOURCE_FORMAT )
+_NO_TEXT = 0 # text string index is offset by one, 0 meaning None
+
+def schema_digest( tree_metas ):
+    """Returns a digest of the tags and attribute names described by the trees.
+       Snapshots of trees whose description changed are not loaded."""
+    digest = hashlib.sha1()
+    for tree_meta in tree_metas:
+        digest.update( '<%s>' % tree_meta.name )
+        element_metas = tree_meta.all_descendant_element_metas()
+        for tag in sorted( element_metas.iterkeys() ):
+            element_meta = element_metas[tag]
+            digest.update( '%s(%s)%s;' % ( tag, ','.join( sorted( element_meta.attributes_by_name.iterkeys() ) ),
+                                           ','.join( sorted( element_meta.elements_by_tag.iterkeys() ) ) ) )
+    return digest.hexdigest()
+
+def _encode_string( value ):
+    if isinstance( value, unicode ):
+        return value.encode( 'utf-8' )
+    if not isinstance( value, str ):
+        return unicode( value ).encode( 'utf-8' )
+    return value
+
+def _decode_string( data ):
+    # like ElementTree, plain ASCII strings are str, the others unicode
+    try:
+        data.decode( 'ascii' )
+        return data
+    except UnicodeDecodeError:
+        return data.decode( 'utf-8' )
+
+def _int_array( data ):
+    values = array( 'I' )
+    values.fromstring( data )
+    if sys.byteorder == 'big': # snapshots are little endian
+        values.byteswap()
+    return values
+
+def _int_array_data( values ):
+    if sys.byteorder == 'big':
+        values = array( 'I', values )
+        values.byteswap()
+    return values.tostring()
+
+class _StaleSnapshot( Exception ):
+    pass
+
+def dumps( trees, sources ):
+    """Returns the snapshot data of the trees.
+       sources: list of source file paths the trees were loaded from, one per tree.
+    """
+    string_indexes = {}
+    strings = []
+    def intern( value ):
+        value = _encode_string( value )
+        index = string_indexes.get( value )
+        if index is None:
+            index = len( strings )
+            string_indexes[value] = index
+            strings.append( value )
+        return index
+    tree_arrays = []
+    for tree in trees:
+        values = array( 'I' )
+        append = values.append
+        stack = [ tree.root ]
+        while stack:
+            element = stack.pop()
+            append( intern( element.tag ) )
+            if element.text is None:
+                append( _NO_TEXT )
+            else:
+                append( intern( element.text ) + 1 )
+            attributes = element.attrib
+            append( len( attributes ) )
+            append( len( element ) )
+            for name, value in attributes.iteritems():
+                append( intern( name ) )
+                append( intern( value ) )
+            stack.extend( reversed( element[:] ) )
+        tree_arrays.append( values )
+    header = struct.pack( _HEADER_FORMAT, _MAGIC, schema_digest( [ tree.meta for tree in trees ] ),
+                          len( sources ), len( strings ), len( trees ) )
+    data = [ header ]
+    for source_path in sources:
+        source_stat = os.stat( source_path )
+        encoded_path = _encode_string( os.path.abspath( source_path ) )
+        data.append( struct.pack( _SOURCE_FORMAT, source_stat.st_mtime, source_stat.st_size,
+                                  len( encoded_path ) ) )
+        data.append( encoded_path )
+    data.append( _int_array_data( array( 'I', [ len( value ) for value in strings ] ) ) )
+    data.extend( strings )
+    for values in tree_arrays:
+        data.append( struct.pack( '<I', len( values ) ) )
+        data.append( _int_array_data( values ) )
+    return ''.join( data )
+
+def loads( universe, data, tree_metas, sources ):
+    """Returns the list of unattached trees described by tree_metas from the
+       snapshot data, or None if the snapshot is invalid or out of date:
+       sources are not the files the snapshot was made from, or they were
+       modified since.
+    """
+    try:
+        return _loads( universe, data, tree_metas, sources )
+    except ( _StaleSnapshot, struct.error, IndexError, KeyError, ValueError, OSError ):
+        return None
+
+def _loads( universe, data, tree_metas, sources ):
+    if len( data ) < _HEADER_SIZE:
+        raise _StaleSnapshot()
+    magic, schema, source_count, string_count, tree_count = struct.unpack( _HEADER_FORMAT, data[:_HEADER_SIZE] )
+    if ( magic != _MAGIC or source_count != len( sources ) or tree_count != len( tree_metas ) or
+         schema != schema_digest( tree_metas ) ):
+        raise _StaleSnapshot()
+    offset = _HEADER_SIZE
+    for source_path in sources:
+        mtime, size, path_length = struct.unpack( _SOURCE_FORMAT, data[offset:offset + _SOURCE_SIZE] )
+        offset += _SOURCE_SIZE
+        encoded_path = data[offset:offset + path_length]
+        offset += path_length
+        source_stat = os.stat( source_path )
+        if ( encoded_path != _encode_string( os.path.abspath( source_path ) ) or
+             mtime != source_stat.st_mtime or size != source_stat.st_size ):
+            raise _StaleSnapshot()
+    lengths = _int_array( data[offset:offset + string_count * 4] )
+    offset += string_count * 4
+    strings = []
+    for length in lengths:
+        strings.append( _decode_string( data[offset:offset + length] ) )
+        offset += length
+    trees = []
+    for tree_meta in tree_metas:
+        value_count, = struct.unpack( '<I', data[offset:offset + 4] )
+        offset += 4
+        values = _int_array( data[offset:offset + value_count * 4] )
+        offset += value_count * 4
+        next_value = iter( values ).next
+        root_meta = tree_meta.root_element_meta
+        if strings[next_value()] != root_meta.tag:
+            raise _StaleSnapshot()
+        root_element = _read_element( root_meta, next_value, strings )
+        trees.append( metaworld.Tree( universe, tree_meta, root_element = root_element ) )
+    if offset != len( data ):
+        raise _StaleSnapshot()
+    return trees
+
+def _read_element( element_meta, next_value, strings ):
+    """Builds the element whose tag was just read, and its children."""
+    text = next_value()
+    if text == _NO_TEXT:
+        text = None
+    else:
+        text = strings[text - 1]
+    attribute_count = next_value()
+    child_count = next_value()
+    attributes = {}
+    for index in xrange( attribute_count ): #@UnusedVariable
+        name = strings[next_value()]
+        attributes[name] = strings[next_value()]
+    children = []
+    if child_count:
+        child_metas_by_tag = element_meta.elements_by_tag
+        for index in xrange( child_count ): #@UnusedVariable
+            child_meta = child_metas_by_tag[strings[next_value()]]
+            children.append( _read_element( child_meta, next_value, strings ) )
+    return element_meta.make_element_from_stored_values( attributes, text, children )
+
+class TreeSnapshotCache( object ):
+    """Stores the snapshots of the trees of each world in cache_dir, keyed by
+       an identifier of the world such as its directory.
+    """
+    def __init__( self, cache_dir ):
+        self.cache_dir = cache_dir
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+
+    def _cache_path( self, key ):
+        key = os.path.normcase( os.path.abspath( key ) )
+        if isinstance( key, unicode ):
+            key = key.encode( 'utf-8' )
+        return os.path.join( self.cache_dir, hashlib.sha1( key ).hexdigest() + SNAPSHOT_FILE_EXTENSION )
+
+    def load( self, universe, key, tree_metas, sources ):
+        """Returns the list of unattached trees described by tree_metas, or None
+           if there is no up to date snapshot for the sources.
+           Out of date snapshots are removed.
+        """
+        cache_path = self._cache_path( key )
+        try:
+            with open( cache_path, 'rb' ) as cache_file:
+                data = cache_file.read()
+        except IOError:
+            self.misses += 1
+            return None
+        trees = loads( universe, data, tree_metas, sources )
+        if trees is None:
+            self.remove( key )
+            self.misses += 1
+        else:
+            self.hits += 1
+        return trees
+
+    def store( self, key, trees, sources ):
+        """Writes the snapshot of the trees loaded from (or saved to) sources.
+           Failure to write the snapshot is not an error: the trees will just
+           be parsed from their sources next time.
+        """
+        try:
+            data = dumps( trees, sources )
+            if not os.path.isdir( self.cache_dir ):
+                os.makedirs( self.cache_dir )
+        except OSError:
+            return False
+        cache_path = self._cache_path( key )
+        temp_path = cache_path + '.tmp'
+        try:
+            with open( temp_path, 'wb' ) as cache_file:
+                cache_file.write( data )
+            if os.path.exists( cache_path ): # rename does not overwrite on Windows
+                os.remove( cache_path )
+            os.rename( temp_path, cache_path )
+        except ( OSError, IOError ):
+            self._remove( temp_path )
+            return False
+        self.stores += 1
+        return True
+
+    def remove( self, key ):
+        """Removes the snapshot of the specified world, if any."""
+        self._remove( self._cache_path( key ) )
+
+    def _remove( self, path ):
+        try:
+            os.remove( path )
+        except OSError:
+            pass
+
+def load_tree_source( universe, tree_meta, path ):
+    """Returns the unattached tree parsed from the XML or YAML file path."""
+    data = file( path, 'rb' ).read()
+    if data.lstrip().startswith( '<' ):
+        return universe.make_unattached_tree_from_xml( tree_meta, data )
+    return universe.make_unattached_tree_from_yaml( tree_meta, data )
+
+if __name__ == '__main__':
+    import unittest #@UnresolvedImport
+    import tempfile #@UnresolvedImport
+    import shutil #@UnresolvedImport
+    import time #@UnresolvedImport
+    import metawog #@UnresolvedImport
+
+    def make_element( element_meta, depth ):
+        """Returns an element with its initial attribute values and, down to
+           depth, one child of each of its kinds."""
+        attributes = dict( [ ( attribute_meta.name, attribute_meta.init )
+                             for attribute_meta in element_meta.attributes
+                             if attribute_meta.init is not None ] )
+        children = []
+        if depth > 0:
+            children = [ make_element( child_meta, depth - 1 )
+                         for child_meta in element_meta.immediate_child_elements() ]
+        return metaworld.Element( element_meta, attributes, children )
+
+    class TreeSnapshotCacheTest( unittest.TestCase ):
+        def setUp( self ):
+            self.temp_dir = tempfile.mkdtemp()
+            self.universe = metaworld.Universe()
+            self.universe._warning = lambda message, **kwargs: None
+            self.cache = TreeSnapshotCache( os.path.join( self.temp_dir, 'cache' ) )
+            root = make_element( metawog.TREE_LEVEL_SCENE.root_element_meta, 2 )
+            root[0].text = u'caf\xe9'
+            root[1].set( root[1].meta.attributes[0].name, u'\u263a' )
+            self.source_path = os.path.join( self.temp_dir, 'level.scene' )
+            self.write( root.to_xml() )
+            self.tree = load_tree_source( self.universe, metawog.TREE_LEVEL_SCENE, self.source_path )
+
+        def tearDown( self ):
+            shutil.rmtree( self.temp_dir )
+
+        def write( self, data, mtime = None ):
+            with open( self.source_path, 'wb' ) as output_file:
+                output_file.write( data )
+            if mtime is not None:
+                os.utime( self.source_path, ( mtime, mtime ) )
+
+        def load( self ):
+            return self.cache.load( self.universe, self.temp_dir, [ metawog.TREE_LEVEL_SCENE ], [ self.source_path ] )
+
+        def test_store_load( self ):
+            self.assertEqual( None, self.load() )
+            self.assert_( self.cache.store( self.temp_dir, [ self.tree ], [ self.source_path ] ) )
+            trees = self.load()
+            self.assertEqual( self.tree.to_xml(), trees[0].to_xml() )
+            self.assertEqual( u'caf\xe9', trees[0].root[0].text )
+            for element in trees[0].root.getiterator():
+                self.assert_( element.parent is None or element in element.parent )
+            self.assertEqual( ( 1, 1 ), ( self.cache.hits, self.cache.misses ) )
+
+        def test_stale( self ):
+            self.cache.store( self.temp_dir, [ self.tree ], [ self.source_path ] )
+            self.write( self.tree.to_xml(), time.time() + 10 )
+            self.assertEqual( None, self.load() )
+            self.assertEqual( [], os.listdir( self.cache.cache_dir ) )
+
+    unittest.main()
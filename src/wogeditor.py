@@ -18,6 +18,8 @@
 # - specific text/fx resources
 import xml.etree.ElementTree #@UnresolvedImport
 import os.path
+import collections
+import time
 import glob #@UnresolvedImport
 import subprocess #@UnresolvedImport
 import louie
@@ -36,11 +38,17 @@ import qthelper
 import editleveldialog
 import newleveldialog_ui
 import errors
+import texturecache
+import treesnapshot
+import filemanifest
 from utils import * #@UnusedWildImport
 from datetime import datetime
 
 YAML_FORMAT = True
 LOG_TO_FILE = False
+TEXTURE_DISK_CACHE = True
+LEVEL_SNAPSHOT_CACHE = True
+PNGBINLTL_MANIFEST_FILE_NAME = '.pngbinltl-manifest.json'
 APP_NAME_UPPER = 'DFG-AMY-EDITOR'
 APP_NAME_LOWER = 'dfg-amy-editor'
 APP_NAME_PROPER = 'Amy In Da Farm! Editor'
@@ -175,64 +183,390 @@ def flattened_element_children( element ):
 class GameModelException( Exception ):
     pass
 
+def colorize_image( image, colorize ):
+    """Returns a copy of a 32 bits image with its red, green and blue channels
+       multiplied by colorize[0]/255, colorize[1]/255 and colorize[2]/255.
+       Factors outside the range [0-255] are clamped to it.
+    """
+    image = image.copy()
+    pixels = image.bits()
+    pixels.setsize( image.bytesPerLine() * image.height() )
+    data = bytearray( pixels.asstring() )
+    # pixels are stored as native endian 0xAARRGGBB integers
+    if sys.byteorder == 'little':
+        offsets = ( 2, 1, 0 )
+    else:
+        offsets = ( 1, 2, 3 )
+    for offset, factor in zip( offsets, colorize ):
+        # out of range factors are clamped, as they may come from invalid levels
+        factor = min( max( int( factor ), 0 ), 255 )
+        if factor != 255:
+            table = ''.join( [ chr( value * factor / 255 ) for value in xrange( 256 ) ] )
+            data[offset::4] = data[offset::4].translate( table )
+    pixels[:] = str( data )
+    return image
+
+def premultiplied_image( img ):
+    """Returns the image in ARGB32_Premultiplied format.
+       The source image is assumed to be already in premultiplied alpha format,
+       so its pixels are copied as is instead of being converted.
+    """
+    if not img.hasAlphaChannel():
+        return img.convertToFormat( QtGui.QImage.Format_ARGB32_Premultiplied )
+    img = img.convertToFormat( QtGui.QImage.Format_ARGB32 )
+    img2 = QtGui.QImage( img.width(), img.height(), QtGui.QImage.Format_ARGB32_Premultiplied )
+    size = img.bytesPerLine() * img.height()
+    pixels = img.bits()
+    pixels.setsize( size )
+    pixels_new = img2.bits()
+    pixels_new.setsize( size )
+    pixels_new[:] = pixels[:]
+    return img2
+
+def half_image( img ):
+    """Returns the image downscaled by half, used to build mip levels."""
+    return img.scaled( max( 1, img.width() / 2 ), max( 1, img.height() / 2 ),
+                       Qt.IgnoreAspectRatio, Qt.SmoothTransformation )
+
+# Default maximum size of the decoded images kept by PixmapCache
+PIXMAP_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def image_byte_size( img ):
+    """Returns the memory used by the pixels of a 32 bits image."""
+    return img.width() * img.height() * 4
+
+def load_disk_cached_image( disk_cache, path ):
+    """Returns the premultiplied image stored in the disk cache for the
+       PNG file path, or None if it is not cached or out of date.
+    """
+    entry = disk_cache.load( path )
+    if entry is None:
+        return None
+    width, height, bytes_per_line, data = entry
+    img = QtGui.QImage( width, height, QtGui.QImage.Format_ARGB32_Premultiplied )
+    if img.bytesPerLine() != bytes_per_line:
+        return None
+    pixels = img.bits()
+    pixels.setsize( bytes_per_line * height )
+    pixels[:] = data
+    return img
+
+def store_disk_cached_image( disk_cache, path, img ):
+    """Stores the pixels of the premultiplied image in the disk cache."""
+    pixels = img.bits()
+    pixels.setsize( img.bytesPerLine() * img.height() )
+    disk_cache.store( path, img.width(), img.height(), img.bytesPerLine(),
+                      pixels.asstring() )
+
+def decode_image_file( path, disk_cache = None ):
+    """Loads the PNG file path as a premultiplied image, using the disk cache
+       if specified. Does not use any GUI resources, so it may be called from
+       a worker thread.
+       Returns a tuple (image, from_disk_cache). image is None on failure.
+    """
+    if disk_cache is not None:
+        img = load_disk_cached_image( disk_cache, path )
+        if img is not None:
+            return img, True
+    img = QtGui.QImage()
+    if not img.load( path ):
+        data = file( path, 'rb' ).read()
+        if not img.loadFromData( data ):
+            return None, False
+    img = premultiplied_image( img )
+    if disk_cache is not None:
+        store_disk_cached_image( disk_cache, path, img )
+    return img, False
+
+class ImageDecoder( QtCore.QRunnable ):
+    """Decodes an image file in a thread pool worker.
+       The notifier imageDecoded() signal is emitted with the result.
+    """
+    def __init__( self, notifier, disk_cache, image_path, path ):
+        QtCore.QRunnable.__init__( self )
+        self._notifier = notifier
+        self._disk_cache = disk_cache
+        self._image_path = image_path
+        self._path = path
+
+    def run( self ):
+        img, from_disk_cache = decode_image_file( self._path, self._disk_cache )
+        self._notifier.emit( QtCore.SIGNAL( 'imageDecoded(PyQt_PyObject,PyQt_PyObject,PyQt_PyObject,PyQt_PyObject)' ),
+                             self._image_path, self._path, img, from_disk_cache )
+
 class PixmapCache( object ):
-    """A global pixmap cache the cache the pixmap associated to each element.
+    """A global pixmap cache the cache the pixmap associated to each image path.
+       The cache is bounded: least recently used images are evicted once the
+       decoded images exceed max_bytes, unless they are used by an open world.
+       If disk_cache is specified, decoded images are persisted in it and
+       reused instead of decoding the PNG again.
+       Images may be decoded in the background by a thread pool (see
+       get_pixmap() and prefetch()). metaworldui.ImagesLoaded is emitted
+       for the requesting worlds once they are available.
        Maintains the cache up to date by listening for element events.
     """
-    def __init__( self, amy_dir, universe ):
+    def __init__( self, amy_dir, universe, max_bytes = PIXMAP_CACHE_MAX_BYTES, disk_cache = None,
+                  max_threads = None ):
         self._amy_dir = amy_dir
-        self._pixmaps_by_path = {}
+        self.max_bytes = max_bytes
+        self.disk_cache = disk_cache
+        self._thread_pool = QtCore.QThreadPool()
+        if max_threads is not None:
+            self._thread_pool.setMaxThreadCount( max_threads )
+        self._decode_notifier = QtCore.QObject()
+        QtCore.QObject.connect( self._decode_notifier,
+            QtCore.SIGNAL( 'imageDecoded(PyQt_PyObject,PyQt_PyObject,PyQt_PyObject,PyQt_PyObject)' ),
+            self._on_image_decoded, Qt.QueuedConnection )
+        self._loading_worlds = {} # dict(path: set(world)) images decoded in the background
+        self._loaded_by_world = {} # dict(world: set(path)) loaded images to notify
+        self._failed_filedate_by_path = {} # dict(path: file date) images that failed to decode
+        self._pixmaps_by_path = collections.OrderedDict() # least recently used first
         self._filedate_by_path = {}
+        self._variants = collections.OrderedDict() # dict((path,colorize,filedate,lod): image), least recently used first
+        self._variant_keys_by_path = {} # dict(path: set(key in _variants))
+        self._bytes_by_path = {}
+        self._paths_by_world = {} # dict(world: set(path)) images pinned by open worlds
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.decoded = 0
+        self.disk_loaded = 0
         self.__event_synthetizer = metaworld.ElementEventsSynthetizer( universe,
             None,
             self._on_element_updated,
             self._on_element_about_to_be_removed )
+        louie.connect( self._on_world_about_to_be_removed, metaworld.WorldAboutToBeRemoved )
 
-    def get_pixmap( self, image_id ):
+    def get_pixmap( self, image_id, colorize = None, world = None, background = False, lod = 0 ):
         """Returns a pixmap corresponding to the image id (actually image path).
            The pixmap is loaded if not present in the cache.
+           colorize: optional (red,green,blue) factors in range [0-255] applied
+                     to the pixmap color channels.
+           lod: mip level of the returned pixmap. Level n is the image
+                downscaled by 2^n. Mip levels are built on demand and cached.
+           world: if specified, the image is kept in the cache until the world
+                  is removed or no longer references the image.
+           background: if True, a pixmap not present in the cache is decoded
+                       in the background and None is returned. is_loading()
+                       returns True until it is available.
            None is returned on failure to load the pixmap.
         """
         image_path = image_id
-        pixmap = self._pixmaps_by_path.get( image_path )
+        if world is not None:
+            self._paths_by_world.setdefault( world, set() ).add( image_path )
+        pixmap = self._pixmaps_by_path.pop( image_path, None )
         if pixmap:
-            return pixmap
-        path = os.path.join( self._amy_dir, image_path + '.png' )
-        if not os.path.isfile( path ):
-            print 'Warning: invalid image path "%(path)s"' % { 'path': image_path }
+            self._pixmaps_by_path[image_path] = pixmap # most recently used
+            self.hits += 1
         else:
-            return self._addToCache( path, image_id )
+            self.misses += 1
+            path = os.path.join( self._amy_dir, image_path + '.png' )
+            if not os.path.isfile( path ):
+                print 'Warning: invalid image path "%(path)s"' % { 'path': image_path }
+                return None
+            if self._hasFailed( image_path, path ):
+                return None
+            if background:
+                self._loadInBackground( path, image_path, world )
+                return None
+            pixmap = self._addToCache( path, image_id )
+            if pixmap is None:
+                return None
+        if colorize is not None:
+            colorize = tuple( colorize[:3] )
+            if colorize == ( 255, 255, 255 ):
+                colorize = None
+        if colorize is None and lod == 0:
+            return pixmap
+        variant = self._getVariant( image_path, pixmap, colorize, lod )
+        self._evict()
+        return variant
+
+    def _getVariant( self, image_path, pixmap, colorize, lod ):
+        """Returns the colorized and/or downscaled variant of the pixmap,
+           building and caching it if required.
+        """
+        if colorize is None and lod == 0:
+            return pixmap
+        key = ( image_path, colorize, self._filedate_by_path[image_path], lod )
+        variant = self._variants.pop( key, None )
+        if variant is None:
+            if lod == 0:
+                variant = colorize_image( pixmap, colorize )
+            else:
+                variant = half_image( self._getVariant( image_path, pixmap, colorize, lod - 1 ) )
+            self._variant_keys_by_path.setdefault( image_path, set() ).add( key )
+            self.cached_bytes += image_byte_size( variant )
+        self._variants[key] = variant # most recently used
+        return variant
+
+    def _removeVariant( self, key ):
+        self.cached_bytes -= image_byte_size( self._variants.pop( key ) )
+        keys = self._variant_keys_by_path[key[0]]
+        keys.remove( key )
+        if not keys:
+            del self._variant_keys_by_path[key[0]]
+
+    def prefetch( self, image_ids, world = None ):
+        """Starts decoding in the background the images not yet in the cache."""
+        for image_path in image_ids:
+            if world is not None:
+                self._paths_by_world.setdefault( world, set() ).add( image_path )
+            if image_path not in self._pixmaps_by_path:
+                path = os.path.join( self._amy_dir, image_path + '.png' )
+                if os.path.isfile( path ) and not self._hasFailed( image_path, path ):
+                    self._loadInBackground( path, image_path, world )
+
+    def is_loading( self, image_id ):
+        """Returns True if the image is being decoded in the background."""
+        return image_id in self._loading_worlds
+
+    def loading_count( self, world ):
+        """Returns the number of images requested by the world that are being
+           decoded in the background."""
+        return len( [ worlds for worlds in self._loading_worlds.itervalues() if world in worlds ] )
+
+    def image_size( self, image_id ):
+        """Returns the size of the image as a QSize without decoding it.
+           None is returned if the size can not be determined.
+        """
+        pixmap = self._pixmaps_by_path.get( image_id )
+        if pixmap is not None:
+            return pixmap.size()
+        size = QtGui.QImageReader( os.path.join( self._amy_dir, image_id + '.png' ) ).size()
+        if size.isValid():
+            return size
         return None
 
+    def _hasFailed( self, image_path, path ):
+        """Returns True if the image failed to decode and its file is unchanged since."""
+        return self._failed_filedate_by_path.get( image_path ) == os.path.getmtime( path )
+
+    def _loadInBackground( self, path, image_path, world ):
+        worlds = self._loading_worlds.get( image_path )
+        if worlds is None:
+            worlds = self._loading_worlds[image_path] = set()
+            self._thread_pool.start( ImageDecoder( self._decode_notifier, self.disk_cache,
+                                                   image_path, path ) )
+        if world is not None:
+            worlds.add( world )
+
+    def _on_image_decoded( self, image_path, path, img, from_disk_cache ):
+        worlds = self._loading_worlds.pop( image_path, None )
+        if worlds is None:
+            return
+        # the image may have been loaded synchronously in the meantime
+        if image_path not in self._pixmaps_by_path:
+            self._cacheImage( path, image_path, img, from_disk_cache )
+        loaded = image_path in self._pixmaps_by_path
+        if not self._loaded_by_world:
+            QtCore.QTimer.singleShot( 0, self._notifyLoadedImages )
+        for world in worlds:
+            # images that failed to decode are not notified, so they are not requested again
+            image_paths = self._loaded_by_world.setdefault( world, set() )
+            if loaded:
+                image_paths.add( image_path )
+
+    def _notifyLoadedImages( self ):
+        """Notifies each world of the images decoded in the background since
+           the last notification.
+        """
+        loaded_by_world, self._loaded_by_world = self._loaded_by_world, {}
+        for world, image_paths in loaded_by_world.iteritems():
+            if world in self._paths_by_world: # world not removed
+                louie.send( metaworldui.ImagesLoaded, world, image_paths )
+
     def _addToCache( self, path, image_id ):
-            img = QtGui.QImage()
-            image_path = image_id
-            if not img.load( path ):
-                data = file( path, 'rb' ).read()
-                if not img.loadFromData( data ):
-                    if image_path in self._pixmaps_by_path.keys():
-                        del self._pixmaps_by_path[image_path]
-                        del self._filedate_by_path[image_path]
-                    print 'Warning: failed to load image "%(path)s"' % { 'path' : image_path }
-                    return None
-
-            # assume source image is in premultiplied alpha format
-            # so, after converting image to ARGB32_Premultiplied
-            # we need to restore its pixels to the pixels of original image
-            img2 = img.convertToFormat( QtGui.QImage.Format_ARGB32_Premultiplied )
-            if img.hasAlphaChannel():
-                #img = img.convertToFormat( QtGui.QImage.Format_ARGB32 )
-                w = img.width()
-                for y in xrange( img.height() ):
-                    pixels = img.scanLine( y )
-                    pixels.setsize( 4 * w )
-                    pixels_new = img2.scanLine( y )
-                    pixels_new.setsize( 4 * w )
-                    pixels_new[:] = pixels[:]
-
-            self._pixmaps_by_path[image_path] = img2
-            self._filedate_by_path[image_path] = os.path.getmtime( path )
-            return img2
+        img, from_disk_cache = decode_image_file( path, self.disk_cache )
+        return self._cacheImage( path, image_id, img, from_disk_cache )
+
+    def _cacheImage( self, path, image_path, img2, from_disk_cache ):
+        self._removeFromCache( image_path )
+        if img2 is None:
+            print 'Warning: failed to load image "%(path)s"' % { 'path' : image_path }
+            if os.path.isfile( path ):
+                self._failed_filedate_by_path[image_path] = os.path.getmtime( path )
+            return None
+        self._failed_filedate_by_path.pop( image_path, None )
+        if from_disk_cache:
+            self.disk_loaded += 1
+        else:
+            self.decoded += 1
+        self._pixmaps_by_path[image_path] = img2
+        self._filedate_by_path[image_path] = os.path.getmtime( path )
+        self._bytes_by_path[image_path] = image_byte_size( img2 )
+        self.cached_bytes += image_byte_size( img2 )
+        self._evict()
+        return img2
+
+    def _removeFromCache( self, image_path ):
+        """Removes the image and its colorized variants from the cache."""
+        if image_path in self._pixmaps_by_path:
+            del self._pixmaps_by_path[image_path]
+            del self._filedate_by_path[image_path]
+            self.cached_bytes -= self._bytes_by_path.pop( image_path )
+        for key in list( self._variant_keys_by_path.get( image_path, () ) ):
+            self._removeVariant( key )
+
+    def _is_pinned( self, image_path ):
+        for paths in self._paths_by_world.itervalues():
+            if image_path in paths:
+                return True
+        return False
+
+    def _evict( self ):
+        """Removes least recently used images until the cache fits in max_bytes.
+           Colorized and downscaled variants are evicted first, as they are
+           rebuilt without decoding the image again. Images used by open
+           worlds are never evicted, but their variants are.
+        """
+        if self.cached_bytes <= self.max_bytes:
+            return
+        for key in list( self._variants ):
+            if self.cached_bytes <= self.max_bytes:
+                return
+            self._removeVariant( key )
+            self.evictions += 1
+        for image_path in list( self._pixmaps_by_path ):
+            if self.cached_bytes <= self.max_bytes:
+                break
+            if not self._is_pinned( image_path ):
+                self._removeFromCache( image_path )
+                self.evictions += 1
+
+    def _unpin_unused( self, world, image_paths, removed_element = None ):
+        """Unpins the images that are no longer referenced by any element of
+           the world. The elements of the subtree of removed_element, about
+           to be removed, are ignored.
+        """
+        paths = self._paths_by_world.get( world )
+        if not paths:
+            return
+        image_paths = paths.intersection( image_paths )
+        if not image_paths:
+            return
+        removed_elements = removed_element is not None and set( removed_element.getiterator() ) or ()
+        for tree in world.trees:
+            for element in tree.root.getiterator():
+                if element in removed_elements:
+                    continue
+                for attribute_meta in element.meta.attributes:
+                    if attribute_meta.type == metaworld.PATH_TYPE:
+                        image_paths.discard( element.get( attribute_meta.name ) )
+                if not image_paths: # all still used
+                    return
+        paths -= image_paths
+        self._evict()
+
+    @property
+    def statistics( self ):
+        """Returns a dict with the cache usage counters."""
+        return { 'hits': self.hits, 'misses': self.misses,
+                 'evictions': self.evictions, 'decoded': self.decoded,
+                 'disk_loaded': self.disk_loaded, 'loading': len( self._loading_worlds ), 'images': len( self._pixmaps_by_path ),
+                 'failed': len( self._failed_filedate_by_path ),
+                 'bytes': self.cached_bytes, 'max_bytes': self.max_bytes }
 
     def refresh( self ):
         # check each file in the cache...
@@ -240,24 +574,35 @@ class PixmapCache( object ):
         for image_path, filedate in self._filedate_by_path.items():
             path = os.path.normpath( os.path.join( self._amy_dir, image_path + '.png' ) )
             if not os.path.isfile( path ):
-                if image_path in self._pixmaps_by_path.keys():
-                    del self._pixmaps_by_path[image_path]
-                    del self._filedate_by_path[image_path]
+                self._removeFromCache( image_path )
                 print 'Warning: File is missing %s' % path
             elif os.path.getmtime( path ) > filedate:
                 # refresh
-                self._addToCache( path, {'id':path, 'path':image_path} )
+                self._addToCache( path, image_path )
 
+    def _on_world_about_to_be_removed( self, world ):
+        if self._paths_by_world.pop( world, None ) is not None:
+            self._evict()
 
-    def _on_element_about_to_be_removed( self, element, index_in_parent ): #IGNORE:W0
-        if element.tag == 'Image':
-            if element.get( 'path', '' ) in self._pixmaps_by_element:
-                del self._pixmaps_by_element[element.get( 'path', '' )]
+    def _on_element_about_to_be_removed( self, element, index_in_parent ): #IGNORE:W0613
+        # the world may no longer use the images referenced by the element
+        world = element.world
+        if world not in self._paths_by_world:
+            return
+        image_paths = set()
+        for child_element in element.getiterator():
+            for attribute_meta in child_element.meta.attributes:
+                if attribute_meta.type == metaworld.PATH_TYPE:
+                    image_path = child_element.get( attribute_meta.name )
+                    if image_path:
+                        image_paths.add( image_path )
+        self._unpin_unused( world, image_paths, element )
 
     def _on_element_updated( self, element, name, new_value, old_value ): #IGNORE:W0613
-        if element.tag == 'Image':
-            if old_value in self._pixmaps_by_element:
-                del self._pixmaps_by_element[old_value]
+        if old_value and element.world in self._paths_by_world:
+            attribute_meta = element.meta.attribute_by_name( name )
+            if attribute_meta is not None and attribute_meta.type == metaworld.PATH_TYPE:
+                self._unpin_unused( element.world, ( old_value, ) )
 
 class GameModel( QtCore.QObject ):
     def __init__( self, amy_path, window ):
@@ -286,21 +631,24 @@ class GameModel( QtCore.QObject ):
         # convert all .png.binltl to .png
         if ON_PLATFORM == PLATFORM_MAC:
             window.statusBar().showMessage( self.tr( "Checking graphics files..." ) )
-            skipped, processed, found = 0, 0, 0
+            processed, found = 0, 0
             lresdir = len( self._res_dir )
             toconvert = []
+            found_paths = []
+            # converted files are tracked so that only modified files are converted again
+            manifest = filemanifest.FileManifest( os.path.join( self._res_dir, PNGBINLTL_MANIFEST_FILE_NAME ) )
             for ( path, dirs, files ) in os.walk( self._res_dir ): #@UnusedVariable
                 for name in files:
                     if name.endswith( '.png.binltl' ):
                         found += 1
+                        input_path = os.path.join( path, name )
+                        found_paths.append( input_path )
                         output_path = os.path.join( path, name[:-11] ) + '.png'
-                        if not os.path.isfile( output_path ):
-                            toconvert.append( [os.path.join( path, name ), output_path, os.path.join( path, name )[lresdir:]] )
+                        if not manifest.is_up_to_date( input_path, output_path ):
+                            toconvert.append( [input_path, output_path, input_path[lresdir:]] )
                             processed += 1
-                        else:
-                            skipped += 1
+            manifest.remove_stale( found_paths )
 
-            #print "png.binltl found",found,'processed',processed,'skipped',skipped
             if processed > 0:
                 progress = QtGui.QProgressDialog( "", QtCore.QString(), 0, processed, window );
                 progress.setWindowTitle( window.tr( "Converting PNG.BINLTL files to PNG..." ) );
@@ -313,7 +661,10 @@ class GameModel( QtCore.QObject ):
                     progress.setValue( progress.value() + 1 );
                     progress.setLabelText( filepair[2] )
                     wogfile.pngbinltl2png( filepair[0], filepair[1] )
+                    manifest.update( filepair[0], filepair[1] )
                 progress.setValue( progress.value() + 1 );
+            manifest.save()
+            print "png.binltl found", found, 'skipped', manifest.skipped, 'converted', manifest.converted, 'removed', manifest.removed
 
         window.statusBar().showMessage( self.tr( "Game Model : Initializing" ) )
         self._universe = metaworld.Universe()
@@ -332,9 +683,31 @@ class GameModel( QtCore.QObject ):
         louie.connect( self._onElementAdded, metaworld.ElementAdded )
         louie.connect( self._onElementAboutToBeRemoved, metaworld.ElementAboutToBeRemoved )
         louie.connect( self._onElementUpdated, metaworld.AttributeUpdated )
-        self.pixmap_cache = PixmapCache( self._amy_dir, self._universe )
+        self.pixmap_cache = PixmapCache( self._amy_dir, self._universe,
+                                         disk_cache = self._makeTextureDiskCache() )
+        self.snapshot_cache = self._makeSnapshotCache()
         window.statusBar().showMessage( self.tr( "Game Model : Complete" ) )
 
+    def _makeTextureDiskCache( self ):
+        """Returns the on-disk cache of decoded images, or None if disabled."""
+        if not TEXTURE_DISK_CACHE:
+            return None
+        cache_dir = unicode( QtGui.QDesktopServices.storageLocation( QtGui.QDesktopServices.CacheLocation ) )
+        if not cache_dir:
+            return None
+        disk_cache = texturecache.TextureDiskCache( os.path.join( cache_dir, u'textures' ) )
+        disk_cache.evict_stale()
+        return disk_cache
+
+    def _makeSnapshotCache( self ):
+        """Returns the cache of the level trees snapshots, or None if disabled."""
+        if not LEVEL_SNAPSHOT_CACHE:
+            return None
+        cache_dir = unicode( QtGui.QDesktopServices.storageLocation( QtGui.QDesktopServices.CacheLocation ) )
+        if not cache_dir:
+            return None
+        return treesnapshot.TreeSnapshotCache( os.path.join( cache_dir, u'snapshots' ) )
+
     @property
     def is_dirty( self ):
         worlds = self.modified_worlds_to_check
@@ -380,25 +753,26 @@ class GameModel( QtCore.QObject ):
         if not os.path.isdir( directory ):
             os.makedirs( directory )
         output_path = os.path.join( directory, file_name )
-        if YAML_FORMAT:
-            data = '## ' + CREATED_BY + '\n' + tree.to_yaml()
-        else:
-            data = tree.to_xml()
-            data = '<!-- ' + CREATED_BY + ' -->\n' + data.replace( '><', '>\n<' )
-        file( output_path, 'wb' ).write( data )
+        with wogfile.open_output_file( output_path ) as output_file:
+            self._writeTree( output_file, tree )
         tree.setFilename( output_path )
 
     def _saveTree( self, directory, file_name, tree ):
         if not os.path.isdir( directory ):
             os.makedirs( directory )
         path = os.path.join( directory, file_name )
+        with wogfile.open_output_file( path, encrypt = True ) as output_file:
+            self._writeTree( output_file, tree )
+        tree.setFilename( path )
+
+    def _writeTree( self, output_file, tree ):
+        """Writes the tree into output_file while visiting its elements."""
         if YAML_FORMAT:
-            data = '## ' + CREATED_BY + '\n' + tree.to_yaml()
+            output_file.write( '## ' + CREATED_BY + '\n' )
+            tree.to_yaml( stream = output_file )
         else:
-            data = tree.to_xml()
-            data = '<!-- ' + CREATED_BY + ' -->\n' + data.replace( '><', '>\n<' )
-        wogfile.encrypt_file_data( path, data )
-        tree.setFilename( path )
+            output_file.write( '<!-- ' + CREATED_BY + ' -->\n' )
+            tree.write_xml( output_file, pretty = True )
 
     def _loadDirList( self, directory, filename_filter ):
         if not os.path.isdir( directory ):
@@ -446,12 +820,19 @@ class GameModel( QtCore.QObject ):
                                                         LevelWorld,
                                                         self )
 
-            self._loadUnPackedTree( world, metawog.TREE_LEVEL_GAME,
-                            folder, name + '.level' )
-            self._loadUnPackedTree( world, metawog.TREE_LEVEL_SCENE,
-                            folder, name + '.scene' )
-            self._loadUnPackedTree( world, metawog.TREE_LEVEL_RESOURCE,
-                            folder, name + '.resrc' )
+            if self._loadLevelSnapshot( world, name ):
+                resource_tree = world.find_tree( metawog.TREE_LEVEL_RESOURCE )
+                self._prefetchLevelImages( world, resource_tree )
+            else:
+                resource_tree = self._loadUnPackedTree( world, metawog.TREE_LEVEL_RESOURCE,
+                                folder, name + '.resrc' )
+                # decodes the level images while the other trees are parsed
+                self._prefetchLevelImages( world, resource_tree )
+                self._loadUnPackedTree( world, metawog.TREE_LEVEL_GAME,
+                                folder, name + '.level' )
+                self._loadUnPackedTree( world, metawog.TREE_LEVEL_SCENE,
+                                folder, name + '.scene' )
+                self.storeLevelSnapshot( world )
 
             if world.isReadOnly:
                 world.clean_dirty_tracker()
@@ -460,6 +841,48 @@ class GameModel( QtCore.QObject ):
 
         return self.models_by_name[name]
 
+    def _prefetchLevelImages( self, world, resource_tree ):
+        self.pixmap_cache.prefetch( [ image.get( 'path' )
+                                      for image in resource_tree.root.findall( './/Image' )
+                                      if image.get( 'path' ) ], world )
+
+    def _levelTreeSources( self, name ):
+        """Returns the list of (tree_meta, path) of the files of the level trees."""
+        folder = os.path.join( self._res_dir, STR_DIR_STUB, name )
+        return [ ( metawog.TREE_LEVEL_RESOURCE, os.path.join( folder, name + '.resrc' ) ),
+                 ( metawog.TREE_LEVEL_GAME, os.path.join( folder, name + '.level' ) ),
+                 ( metawog.TREE_LEVEL_SCENE, os.path.join( folder, name + '.scene' ) ) ]
+
+    def _loadLevelSnapshot( self, world, name ):
+        """Adds the level trees to the world from their snapshot.
+           Returns False if there is no snapshot up to date with the level files.
+        """
+        if self.snapshot_cache is None:
+            return False
+        sources = self._levelTreeSources( name )
+        trees = self.snapshot_cache.load( self._universe, os.path.dirname( sources[0][1] ),
+                                          [ tree_meta for tree_meta, path in sources ], #@UnusedVariable
+                                          [ path for tree_meta, path in sources ] ) #@UnusedVariable
+        if trees is None:
+            return False
+        for tree, ( tree_meta, path ) in zip( trees, sources ): #@UnusedVariable
+            world.add_tree( [tree] )
+            tree.setFilename( path )
+        return True
+
+    def storeLevelSnapshot( self, world ):
+        """Writes the snapshot of the level trees, once loaded or saved."""
+        if self.snapshot_cache is None:
+            return
+        sources = self._levelTreeSources( world.name )
+        paths = [ path for tree_meta, path in sources ] #@UnusedVariable
+        for path in paths:
+            if not os.path.isfile( path ):
+                return
+        self.snapshot_cache.store( os.path.dirname( paths[0] ),
+                                   [ world.find_tree( tree_meta ) for tree_meta, path in sources ], #@UnusedVariable
+                                   paths )
+
     def selectLevel( self, name ):
         """Activate the specified level and load it if required.
            Returns the activated LevelWorld.
@@ -937,8 +1360,9 @@ class LevelWorld( ThingWorld ):
                 _recursive_remove( child )
 
         _recursive_remove( element )
-        for element in to_remove:
-            element.parent.remove( element )
+        with self.changes():
+            for element in to_remove:
+                element.parent.remove( element )
         self.activate_undo()
 
     def _get_used_resources( self ):
@@ -1020,12 +1444,13 @@ class LevelWorld( ThingWorld ):
 
     def _cleanscenetree( self ):
         self.suspend_undo()
-        for hinge in self.scene_root.findall( 'hinge' ):
-            self.scene_root.remove( hinge )
-            self.scene_root.append( hinge )
-        for motor in self.scene_root.findall( 'motor' ):
-            self.scene_root.remove( motor )
-            self.scene_root.append( motor )
+        with self.changes():
+            for hinge in self.scene_root.findall( 'hinge' ):
+                self.scene_root.remove( hinge )
+                self.scene_root.append( hinge )
+            for motor in self.scene_root.findall( 'motor' ):
+                self.scene_root.remove( motor )
+                self.scene_root.append( motor )
         self.activate_undo()
 
     def _cleanresourcetree( self ):
@@ -1102,17 +1527,34 @@ class LevelWorld( ThingWorld ):
                     self._cleanscenetree()
                 self.game_model._saveUnPackedTree( dir, name + '.scene', self.scene_root.tree )
 
+            self.game_model.storeLevelSnapshot( self )
+
         self.__dirty_tracker.clean()
 
     def clean_dirty_tracker( self ):
         self.__dirty_tracker.clean()
 
-    def getImagePixmap( self, image_id ):
-        pixmap = self.game_model.pixmap_cache.get_pixmap( image_id )
-        if pixmap is None:
+    def getImagePixmap( self, image_id, colorize = None, background = False, lod = 0 ):
+        """Returns the image pixmap for the specified image id.
+           colorize: optional (red,green,blue) factors applied to the pixmap.
+           lod: mip level of the pixmap, level n is downscaled by 2^n.
+           background: if True and the image is not loaded yet, it is decoded
+                       in the background and None is returned. isImageLoading()
+                       returns True until metaworldui.ImagesLoaded is emitted.
+        """
+        pixmap_cache = self.game_model.pixmap_cache
+        pixmap = pixmap_cache.get_pixmap( image_id, colorize, self, background, lod )
+        if pixmap is None and not pixmap_cache.is_loading( image_id ):
             print 'Warning: invalid image reference:|', image_id, '|'
         return pixmap
 
+    def isImageLoading( self, image_id ):
+        return self.game_model.pixmap_cache.is_loading( image_id )
+
+    def getImageSize( self, image_id ):
+        """Returns the size of the image as a QSize, or None if unknown."""
+        return self.game_model.pixmap_cache.image_size( image_id )
+
     def updateResources( self ):
         """Ensures all image/sound resource present in the level directory 
            are in the resource tree.
@@ -1250,6 +1692,7 @@ class MainWindow( QtGui.QMainWindow ):
         self.statusTimer = None
         self._amy_path = None # Path to 'amy' executable
         self.recentfiles = None
+        self._level_open_stats = {} # dict(world: (name, start_time, decoded, disk_loaded, snapshot_hits))
         self.createMDIArea()
         self.createActions()
         self.createMenus()
@@ -1329,6 +1772,11 @@ class MainWindow( QtGui.QMainWindow ):
                     self._setRecentFile( name )
 
     def open_level_view_by_name( self, name ):
+        pixmap_cache = self._game_model.pixmap_cache
+        start_time = time.time()
+        decoded, disk_loaded = pixmap_cache.decoded, pixmap_cache.disk_loaded
+        snapshot_cache = self._game_model.snapshot_cache
+        snapshot_hits = snapshot_cache and snapshot_cache.hits or 0
         try:
             world = self._game_model.selectLevel( name )
         except GameModelException, e:
@@ -1340,9 +1788,34 @@ class MainWindow( QtGui.QMainWindow ):
                 self.mdiArea.setActiveSubWindow( sub_window )
             else:
                 self._addGraphicView( world )
+                self._level_open_stats[world] = ( name, start_time, decoded, disk_loaded, snapshot_hits )
+                louie.connect( self._onLevelImagesLoaded, metaworldui.ImagesLoaded, world )
+                self._reportLevelOpenTime( world )
             return True
         return False
 
+    def _onLevelImagesLoaded( self, image_ids, sender ): #IGNORE:W0613
+        self._reportLevelOpenTime( sender )
+
+    def _reportLevelOpenTime( self, world ):
+        """Reports the time taken to open the level once all its images are loaded."""
+        pixmap_cache = self._game_model.pixmap_cache
+        if world not in self._level_open_stats or pixmap_cache.loading_count( world ):
+            return
+        name, start_time, decoded, disk_loaded, snapshot_hits = self._level_open_stats.pop( world )
+        louie.disconnect( self._onLevelImagesLoaded, metaworldui.ImagesLoaded, world )
+        decoded = pixmap_cache.decoded - decoded
+        disk_loaded = pixmap_cache.disk_loaded - disk_loaded
+        snapshot_cache = self._game_model.snapshot_cache
+        from_snapshot = snapshot_cache is not None and snapshot_cache.hits > snapshot_hits
+        message = 'Level %(name)s opened in %(time)dms (%(state)s: %(decoded)d images decoded, %(disk_loaded)d read from disk cache, trees %(trees)s)' % {
+            'name': name, 'time': ( time.time() - start_time ) * 1000.0,
+            'state': decoded and 'cold' or 'warm',
+            'decoded': decoded, 'disk_loaded': disk_loaded,
+            'trees': from_snapshot and 'read from snapshot' or 'parsed' }
+        print message
+        self.statusBar().showMessage( message, 5000 )
+
     def _addGraphicView( self, world ):
         """Adds a new MDI GraphicView window for the specified level."""
         level_view = levelview.LevelGraphicView( world, self.view_actions, self.common_actions )
@@ -1638,25 +2111,26 @@ class MainWindow( QtGui.QMainWindow ):
         paste_posx, paste_posy = view._last_pos.x(), -view._last_pos.y()
         copy_posx, copy_posy = float( clipboard_element.get( 'posx', 0 ) ), float( clipboard_element.get( 'posy', 0 ) )
         pasted_elements = []
-        for clip_child in clipboard_element.getchildren():
-            xml_data = xml.etree.ElementTree.tostring( clip_child, 'utf-8' )
-            for element in [tree.root for tree in world.trees]:
-                child_elements = element.make_detached_child_from_xml( xml_data )
-                if child_elements:
-                    pasted_elements.extend( child_elements )
-                    for child_element in child_elements:
-                        # find the pos attribute in the meta
-                        # set it to view._last_release_at
-                        pos_attribute = self._getPositionAttribute( child_element )
-                        if pos_attribute is not None:
-                            old_pos = pos_attribute.get_native( child_element, ( 0, 0 ) )
-                            if clipboard_element.__len__() == 1:
-                                pos_attribute.set_native( child_element, [view._last_pos.x(), -view._last_pos.y()] )
-                            else:
-                                pos_attribute.set_native( child_element, [old_pos[0] + paste_posx - copy_posx, old_pos[1] + paste_posy - copy_posy] )
-
-                        element.safe_identifier_insert( len( element ), child_element )
-                    break
+        with world.changes():
+            for clip_child in clipboard_element.getchildren():
+                xml_data = xml.etree.ElementTree.tostring( clip_child, 'utf-8' )
+                for element in [tree.root for tree in world.trees]:
+                    child_elements = element.make_detached_child_from_xml( xml_data )
+                    if child_elements:
+                        pasted_elements.extend( child_elements )
+                        for child_element in child_elements:
+                            # find the pos attribute in the meta
+                            # set it to view._last_release_at
+                            pos_attribute = self._getPositionAttribute( child_element )
+                            if pos_attribute is not None:
+                                old_pos = pos_attribute.get_native( child_element, ( 0, 0 ) )
+                                if clipboard_element.__len__() == 1:
+                                    pos_attribute.set_native( child_element, [view._last_pos.x(), -view._last_pos.y()] )
+                                else:
+                                    pos_attribute.set_native( child_element, [old_pos[0] + paste_posx - copy_posx, old_pos[1] + paste_posy - copy_posy] )
+
+                            element.safe_identifier_insert( len( element ), child_element )
+                        break
         if len( pasted_elements ) >= 1:
             world.set_selection( pasted_elements )
 
@@ -1680,17 +2154,18 @@ class MainWindow( QtGui.QMainWindow ):
         # Try to paste in one of the selected elements. Stop when succeed
         clipboard_element = xml.etree.ElementTree.fromstring( xml_data )
         pasted_elements = []
-        for clip_child in clipboard_element.getchildren():
-            xml_data = xml.etree.ElementTree.tostring( clip_child, 'utf-8' )
-            for element in elements:
-                while element is not None:
-                    child_elements = element.make_detached_child_from_xml( xml_data )
-                    if child_elements:
-                        for child_element in child_elements:
-                            element.safe_identifier_insert( len( element ), child_element )
-                        pasted_elements.extend( child_elements )
-                        break
-                    element = element.parent
+        with world.changes():
+            for clip_child in clipboard_element.getchildren():
+                xml_data = xml.etree.ElementTree.tostring( clip_child, 'utf-8' )
+                for element in elements:
+                    while element is not None:
+                        child_elements = element.make_detached_child_from_xml( xml_data )
+                        if child_elements:
+                            for child_element in child_elements:
+                                element.safe_identifier_insert( len( element ), child_element )
+                            pasted_elements.extend( child_elements )
+                            break
+                        element = element.parent
         if len( pasted_elements ) >= 1:
             element.world.set_selection( pasted_elements )
 
@@ -1712,20 +2187,21 @@ class MainWindow( QtGui.QMainWindow ):
             return
         deleted_elements = []
         previous_element = None
-        for element in list( world.selected_elements ):
-            if element.meta.read_only:
-                #messagebox
-                QtGui.QMessageBox.warning( self, self.tr( "Cannot delete read only element!" ),
-                              self.tr( 'This element is read only.\n'
-                                      'It cannot be deleted' ) )
+        with world.changes():
+            for element in list( world.selected_elements ):
+                if element.meta.read_only:
+                    #messagebox
+                    QtGui.QMessageBox.warning( self, self.tr( "Cannot delete read only element!" ),
+                                  self.tr( 'This element is read only.\n'
+                                          'It cannot be deleted' ) )
 
-                return 0
-            elif not element.is_root():
-                if element.previous_element() not in list( world.selected_elements ):
-                    previous_element = element.previous_element()
+                    return 0
+                elif not element.is_root():
+                    if element.previous_element() not in list( world.selected_elements ):
+                        previous_element = element.previous_element()
 
-                deleted_elements.append( element.tag )
-                element.parent.remove( element )
+                    deleted_elements.append( element.tag )
+                    element.parent.remove( element )
 
         if is_cut_action:
             return len( deleted_elements )
@@ -1811,7 +2287,17 @@ class MainWindow( QtGui.QMainWindow ):
 
     def _on_refresh_element_status( self ):
         # broadcast the event to all ElementIssueTracker
-        louie.send_minimal( metaworldui.RefreshElementIssues )
+        responses = louie.send_minimal( metaworldui.RefreshElementIssues )
+        # each tracker only checks elements for a short time slice: keep
+        # checking as soon as the event loop is idle until all are done
+        if ( True in [ pending for receiver, pending in responses ] #@UnusedVariable
+             and not self._element_status_continued ):
+            self._element_status_continued = True
+            QtCore.QTimer.singleShot( 0, self._continue_refresh_element_status )
+
+    def _continue_refresh_element_status( self ):
+        self._element_status_continued = False
+        self._on_refresh_element_status()
 
     def createMDIArea( self ):
         self.mdiArea = QtGui.QMdiArea()
@@ -2036,6 +2522,7 @@ class MainWindow( QtGui.QMainWindow ):
         self.connect( self.actionTimer, QtCore.SIGNAL( "timeout()" ), self.onRefreshAction )
         self.actionTimer.start( 250 )    # Refresh action enabled flag every 250ms.
 
+        self._element_status_continued = False
         self.statusTimer = QtCore.QTimer( self )
         self.connect( self.statusTimer, QtCore.SIGNAL( "timeout()" ),
                       self._on_refresh_element_status )
@@ -2243,8 +2730,87 @@ class MainWindow( QtGui.QMainWindow ):
         QtGui.QMainWindow.closeEvent( self, event )
         event.accept()
 
+def benchmark_premultiplied_image( sizes = ( 512, 1024, 2048 ), iterations = 5 ):
+    """Compares premultiplied_image() with the former scanline by scanline copy."""
+    def copy_by_scanlines( img ):
+        img2 = img.convertToFormat( QtGui.QImage.Format_ARGB32_Premultiplied )
+        w = img.width()
+        for y in xrange( img.height() ):
+            pixels = img.scanLine( y )
+            pixels.setsize( 4 * w )
+            pixels_new = img2.scanLine( y )
+            pixels_new.setsize( 4 * w )
+            pixels_new[:] = pixels[:]
+        return img2
+    for size in sizes:
+        img = QtGui.QImage( size, size, QtGui.QImage.Format_ARGB32 )
+        img.fill( 0x80402010 )
+        timings = []
+        for convert in ( copy_by_scanlines, premultiplied_image ):
+            start_time = time.clock()
+            for index in xrange( iterations ): #@UnusedVariable
+                convert( img )
+            timings.append( ( time.clock() - start_time ) * 1000.0 / iterations )
+        print '%(size)dx%(size)d: scanlines %(old).1fms, bulk %(new).1fms' % {
+            'size': size, 'old': timings[0], 'new': timings[1] }
+
+def benchmark_level_redraw( layer_count = 100, image_size = 1024, zooms = ( 0.1, 0.25, 1.0 ), iterations = 5 ):
+    """Measures the time taken to redraw a level made of layer_count full
+       resolution scenelayers at several zoom levels, with and without
+       image mip levels.
+    """
+    import tempfile #@UnresolvedImport
+    import shutil #@UnresolvedImport
+    class BenchmarkGameModel( object ):
+        def __init__( self, pixmap_cache ):
+            self.pixmap_cache = pixmap_cache
+    amy_dir = tempfile.mkdtemp()
+    try:
+        for index in xrange( 4 ):
+            img = QtGui.QImage( image_size, image_size, QtGui.QImage.Format_ARGB32 )
+            img.fill( 0x80402010 + index * 0x10 )
+            img.save( os.path.join( amy_dir, 'layer%d.png' % index ) )
+        universe = metaworld.Universe()
+        game_world = universe.make_world( metawog.WORLD_GLOBAL, 'game' )
+        game_model = BenchmarkGameModel( PixmapCache( amy_dir, universe ) )
+        world = game_world.make_world( metawog.WORLD_LEVEL, 'benchmark', LevelWorld, game_model )
+        layers = ['<scenelayer image="layer%d" center="%d,%d" depth="0" />' %
+                  ( index % 4, ( index % 10 ) * image_size, ( index / 10 ) * image_size )
+                  for index in xrange( layer_count )]
+        world.make_tree_from_xml( metawog.TREE_LEVEL_GAME, metawog.LEVEL_GAME_TEMPLATE )
+        world.make_tree_from_xml( metawog.TREE_LEVEL_SCENE, '<scene minx="0" miny="0" maxx="%d" maxy="%d">%s</scene>' % (
+            10 * image_size, 10 * image_size, ''.join( layers ) ) )
+        world.make_tree_from_xml( metawog.TREE_LEVEL_RESOURCE, metawog.LEVEL_RESOURCE_TEMPLATE )
+        view = levelview.LevelGraphicView( world, {}, {} )
+        view.background_image_loading = False
+        view.resize( 1024, 768 )
+        target = QtGui.QPixmap( view.viewport().size() )
+        for image_lod in ( False, True ):
+            view.image_lod = image_lod
+            for zoom in zooms:
+                view.resetMatrix()
+                view.scale( zoom, zoom )
+                view.refreshFromModel()
+                view.centerOn( view.scene().itemsBoundingRect().center() )
+                start_time = time.time()
+                for index in xrange( iterations ): #@UnusedVariable
+                    painter = QtGui.QPainter( target )
+                    painter.setRenderHints( view.renderHints() )
+                    view.render( painter )
+                    painter.end()
+                elapsed = ( time.time() - start_time ) * 1000.0 / iterations
+                print 'Zoom %(zoom)3d%%, %(mode)s: %(time).1fms per redraw' % {
+                    'zoom': zoom * 100, 'mode': image_lod and 'mip levels' or 'full resolution',
+                    'time': elapsed }
+    finally:
+        shutil.rmtree( amy_dir )
+
 if __name__ == "__main__":
     app = QtGui.QApplication( sys.argv )
+    if sys.argv[1:] == ['benchmark']:
+        benchmark_premultiplied_image()
+        benchmark_level_redraw()
+        sys.exit( 0 )
     # Set keys for settings
     app.setOrganizationName( "DreamFarmGames" )
     app.setOrganizationDomain( "dreamfarmgames.com" )
@@ -1,7 +1,14 @@
 import sys, zlib, struct #@UnresolvedImport
 import optparse #@UnresolvedImport
+import binascii #@UnresolvedImport
+import time #@UnresolvedImport
+import mmap #@UnresolvedImport
+import contextlib #@UnresolvedImport
+import cStringIO #@UnresolvedImport
+from array import array #@UnresolvedImport
 import os.path
 import png
+import parallelzlib
 
 PLATFORM_WIN = 0
 PLATFORM_LINUX = 1
@@ -19,26 +26,69 @@ else:
 if ON_PLATFORM != PLATFORM_MAC:
     from Crypto.Cipher import AES #@UnresolvedImport
 
-def pngbinltl2png( input_path, output_path ):
+# Size of the blocks read/written by the streaming PNG converters
+PNG_STREAM_CHUNK_SIZE = 256 * 1024
+# zlib compression level used by the PNG converters: lower is faster but
+# produces larger files.
+PNG_COMPRESSION_LEVEL = 9
+
+def png_chunk( fh, type, data ):
+    """Writes a PNG chunk of the specified type into the file fh."""
+    check = type + data
+    fh.write( struct.pack( ">I", len( data ) ) )
+    fh.write( check )
+    fh.write( struct.pack( ">I", zlib.crc32( check ) & 0xffffffff ) )
+
+def pngbinltl2png( input_path, output_path, level = PNG_COMPRESSION_LEVEL, threads = None ):
     # repack .png.binltl files into png
-    text = file( input_path, 'rb' ).read()
-    width, height, size, fullsize = struct.unpack( "<HHII", text[:12] ) #@UnusedVariable
-    data = zlib.decompress( text[12:12 + size] )
-    side = 1
-    while side < width or side < height:
-        side *= 2
-    def chunk( fh, type, data ):
-        check = type + data
-        fh.write( struct.pack( ">I", len( data ) ) )
-        fh.write( check )
-        fh.write( struct.pack( ">I", zlib.crc32( check ) & 0xffffffff ) )
-
-    # output png
-    with file( output_path, 'wb' ) as fout:
-        fout.write( "\x89\x50\x4E\x47\x0D\x0A\x1A\x0A" )
-        chunk( fout, "IHDR", struct.pack( ">II", width, height ) + "\x08\x06\x00\x00\x00" )
-        chunk( fout, "IDAT", zlib.compress( "\x00" + "\x00".join( *[( data[line * side * 4:( line * side + width ) * 4] for line in range( height ) )] ), 9 ) )
-        chunk( fout, "IEND", "" )
+    # The texture is decompressed and the png compressed row by row, so only
+    # a few rows and compressed blocks are in memory at any time.
+    # threads: number of threads compressing the png, by default one per processor.
+    with file( input_path, 'rb' ) as fin:
+        width, height, size, fullsize = struct.unpack( "<HHII", fin.read( 12 ) ) #@UnusedVariable
+        side = 1
+        while side < width or side < height:
+            side *= 2
+        row_size = side * 4
+        decompressor = zlib.decompressobj()
+        compressor = parallelzlib.compressobj( level, threads )
+        with file( output_path, 'wb' ) as fout:
+            fout.write( "\x89\x50\x4E\x47\x0D\x0A\x1A\x0A" )
+            png_chunk( fout, "IHDR", struct.pack( ">II", width, height ) + "\x08\x06\x00\x00\x00" )
+            idat = []
+            idat_size = 0
+            data = ''
+            line = 0
+            remaining = size
+            cdata = ''
+            while line < height:
+                if not cdata:
+                    cdata = fin.read( min( remaining, PNG_STREAM_CHUNK_SIZE ) )
+                    remaining -= len( cdata )
+                if cdata:
+                    # limits the decompressed size, highly compressed blocks
+                    # would otherwise be inflated all at once
+                    data += decompressor.decompress( cdata, max( row_size, PNG_STREAM_CHUNK_SIZE ) )
+                    cdata = decompressor.unconsumed_tail
+                else:
+                    data += decompressor.flush()
+                    if len( data ) < row_size * ( height - line ):
+                        raise IOError( 'Truncated texture data in "%s"' % input_path )
+                row_count = min( len( data ) // row_size, height - line )
+                for row in xrange( row_count ):
+                    start = row * row_size
+                    compressed = compressor.compress( "\x00" + data[start:start + width * 4] )
+                    if compressed:
+                        idat.append( compressed )
+                        idat_size += len( compressed )
+                data = data[row_count * row_size:]
+                line += row_count
+                if idat_size >= PNG_STREAM_CHUNK_SIZE:
+                    png_chunk( fout, "IDAT", ''.join( idat ) )
+                    idat, idat_size = [], 0
+            idat.append( compressor.flush() )
+            png_chunk( fout, "IDAT", ''.join( idat ) )
+            png_chunk( fout, "IEND", "" )
 
     return width, height
 
@@ -70,49 +120,190 @@ def pngbinltl2png( input_path, output_path ):
 # if cid == "IEND":
 # break
 
-def png2pngbinltl( input_path, output_path ):
-    r = png.Reader( filename = input_path )
-    width, height, pixels, meta = r.asRGBA8() #@UnusedVariable
+def png2pngbinltl( input_path, output_path, level = PNG_COMPRESSION_LEVEL, threads = None ):
+    # The png is decoded and the texture compressed row by row. The header,
+    # which contains the compressed size, is written once all rows are done.
+    # threads: number of threads compressing the texture, by default one per processor.
+    width, height, pixels, meta = png.Reader( filename = input_path ).asRGBA()
+    if meta['bitdepth'] != 8:
+        width, height, pixels, meta = png.Reader( filename = input_path ).asRGBA8() #@UnusedVariable
     size = 1
     while size < width or size < height:
         size *= 2
     #print "width=",width,"height=",height,"size=",size
-    rowend = ''.join( [chr( 0 ) for i in range( ( size - width ) * 4 )] ) #@UnusedVariable
-    fullrow = ''.join( [chr( 0 ) for i in range( size * 4 )] ) #@UnusedVariable
-    imagelist = []
-    for row in pixels:
-        imagelist.append( ''.join( [chr( v ) for v in row] ) + rowend )
-    for i in range( size - height ): #@UnusedVariable
-        imagelist.append( fullrow )
-    imagedata = ''.join( imagelist )
-    assert len( imagedata ) == size * size * 4
-    cdata = zlib.compress( imagedata, 9 )
-    #print len(imagedata),len(cdata)
+    rowend = '\0' * ( ( size - width ) * 4 )
+    compressor = parallelzlib.compressobj( level, threads )
+    csize = 0
     with file( output_path, 'wb' ) as fout:
-        fout.write( struct.pack( "<HHII", width, height, len( cdata ), len( imagedata ) ) )
+        fout.write( struct.pack( "<HHII", width, height, 0, 0 ) )
+        for row in pixels:
+            cdata = compressor.compress( array( 'B', row ).tostring() + rowend )
+            fout.write( cdata )
+            csize += len( cdata )
+        fullrow = '\0' * ( size * 4 )
+        for i in xrange( size - height ): #@UnusedVariable
+            cdata = compressor.compress( fullrow )
+            fout.write( cdata )
+            csize += len( cdata )
+        cdata = compressor.flush()
         fout.write( cdata )
+        csize += len( cdata )
+        fout.seek( 0 )
+        fout.write( struct.pack( "<HHII", width, height, csize, size * size * 4 ) )
 
 #.png.binltl
 #>HHII  width, height, size, fullsize
 #{Data} compressed
 
+# AES 192 bits keys used to encrypt/decrypt data
+AES_KEY = binascii.unhexlify( '0D0607070C01080506090904060D030F03060E010E02070B' )
+AES_BLOCK_SIZE = 16
+# Appended to the data so that its length is a multiple of AES_BLOCK_SIZE
+AES_FILLER = '\xfd\xfd\xfd\xfd' + '\0' * 12
+
+def aes_filler_index( xml_data ):
+    """Returns the index of the filler in decrypted data, -1 if not found."""
+    # Usually has '\xfd\xfd\xfd\xfd\0' at the end, but this may be truncated
+    # to first '\xfd' if size is nearly a multiple of 16, though there will
+    # always be at least one '\xfd'.
+    zero_index = xml_data.find( '\0' )
+    fd_index = xml_data.find( '\xfd' )
+    if zero_index == -1 or ( fd_index != -1 and fd_index < zero_index ):
+        return fd_index
+    return zero_index
+
+class AESCodec( object ):
+    """Encrypts/decrypts .bin files data.
+       The codec can be reused for any number of files: a new CBC cipher is
+       made from the precomputed key for each encryption/decryption.
+       Data may be provided as a string or any object supporting the buffer
+       protocol (buffer, bytearray, mmap...) without being copied, or as file
+       objects which are processed by chunks of chunk_size bytes.
+    """
+    def __init__( self, key = AES_KEY, chunk_size = 1024 * 1024 ):
+        assert chunk_size % AES_BLOCK_SIZE == 0
+        self._key = key
+        self._iv = '\0' * AES_BLOCK_SIZE
+        self.chunk_size = chunk_size
+
+    def new_cipher( self ):
+        return AES.new( self._key, AES.MODE_CBC, self._iv )
+
+    def encrypt( self, xml_data ):
+        """Returns the encrypted data, filler included."""
+        cipher = self.new_cipher()
+        block_size = len( xml_data ) - len( xml_data ) % AES_BLOCK_SIZE
+        last_block = str( buffer( xml_data, block_size ) ) + AES_FILLER[:AES_BLOCK_SIZE - len( xml_data ) % AES_BLOCK_SIZE]
+        return ''.join( ( cipher.encrypt( buffer( xml_data, 0, block_size ) ),
+                          cipher.encrypt( last_block ) ) )
+
+    def decrypt( self, crypted_data ):
+        """Returns the decrypted data, filler removed."""
+        if not isinstance( crypted_data, str ):
+            crypted_data = buffer( crypted_data ) # bytearray is not accepted by the cipher
+        xml_data = self.new_cipher().decrypt( crypted_data )
+        filler_index = aes_filler_index( xml_data )
+        if filler_index != -1:
+            xml_data = xml_data[:filler_index]
+        return xml_data
+
+    def encrypt_stream( self, input_file, output_file ):
+        """Encrypts the data read from input_file into output_file.
+           Returns the size of the data read.
+        """
+        writer = self.encrypt_writer( output_file )
+        while True:
+            chunk = input_file.read( self.chunk_size )
+            if not chunk:
+                break
+            writer.write( chunk )
+        return writer.close()
+
+    def encrypt_writer( self, output_file ):
+        """Returns a file-like object encrypting the data written into it
+           into output_file. See AESEncryptWriter."""
+        return AESEncryptWriter( self.new_cipher(), output_file, self.chunk_size )
+
+    def decrypt_stream( self, input_file, output_file ):
+        """Decrypts the data read from input_file into output_file, filler removed.
+           Returns the size of the data written.
+        """
+        cipher = self.new_cipher()
+        size = 0
+        remaining = ''
+        while True:
+            chunk = input_file.read( self.chunk_size )
+            if not chunk:
+                break
+            chunk = remaining + chunk
+            block_size = len( chunk ) - len( chunk ) % AES_BLOCK_SIZE
+            remaining = chunk[block_size:]
+            xml_data = cipher.decrypt( chunk[:block_size] )
+            filler_index = aes_filler_index( xml_data )
+            if filler_index != -1:
+                # everything after the filler is ignored
+                output_file.write( xml_data[:filler_index] )
+                return size + filler_index
+            output_file.write( xml_data )
+            size += len( xml_data )
+        if remaining:
+            raise ValueError( 'Input strings must be a multiple of 16 in length' )
+        return size
+
+    def decrypt_file( self, input_path ):
+        """Decrypts the .bin file input_path and returns the corresponding XML.
+           The file is memory-mapped instead of being read into a string.
+        """
+        with file( input_path, 'rb' ) as input_file:
+            if os.fstat( input_file.fileno() ).st_size == 0: # can not map an empty file
+                return self.decrypt( '' )
+            crypted_data = mmap.mmap( input_file.fileno(), 0, access = mmap.ACCESS_READ )
+            try:
+                return self.decrypt( crypted_data )
+            finally:
+                crypted_data.close()
+
+class AESEncryptWriter( object ):
+    """File-like object encrypting the data written into it into output_file.
+       The data is encrypted by chunks of about chunk_size bytes. close() must
+       be called to encrypt the remaining data and the filler; it does not
+       close output_file.
+    """
+    def __init__( self, cipher, output_file, chunk_size ):
+        self._cipher = cipher
+        self._output_file = output_file
+        self.chunk_size = chunk_size
+        self._pending = []
+        self._pending_size = 0
+        self.size = 0 # size of the data encrypted so far
+
+    def write( self, data ):
+        self._pending.append( data )
+        self._pending_size += len( data )
+        if self._pending_size >= self.chunk_size:
+            data = ''.join( self._pending )
+            block_size = len( data ) - len( data ) % AES_BLOCK_SIZE
+            self._output_file.write( self._cipher.encrypt( buffer( data, 0, block_size ) ) )
+            self.size += block_size
+            self._pending = [ data[block_size:] ]
+            self._pending_size = len( data ) - block_size
+
+    def close( self ):
+        """Encrypts the remaining data and the filler.
+           Returns the size of the data written into the writer."""
+        data = ''.join( self._pending )
+        self._pending = []
+        self._pending_size = 0
+        self.size += len( data )
+        self._output_file.write( self._cipher.encrypt( data + AES_FILLER[:AES_BLOCK_SIZE - len( data ) % AES_BLOCK_SIZE] ) )
+        return self.size
+
+aes_codec = AESCodec()
+
 def make_aes_cipher():
     """Returns a new cipher object initialized with the correct key
        that can be used to encrypt/decrypt files."""
-    # AES 192 bits keys used to encrypt/decrypt data
-    key = '0D0607070C01080506090904060D030F03060E010E02070B'
-
-    def key_as_binary( key ):
-        """Converts the specified hexadecimal string into a byte string."""
-        assert len( key ) % 2 == 0
-        binary_key = []
-        for index in xrange( 0, len( key ), 2 ):
-            binary_key.append( chr( int( key[index:index + 2], 16 ) ) )
-        return ''.join( binary_key )
-
-    binary_key = key_as_binary( key )
-    cipher = AES.new( binary_key, AES.MODE_CBC )
-    return cipher
+    return aes_codec.new_cipher()
 
 def encrypt_file_data( output_path, xml_data ):
     """Encrypt the string xml_data into a .bin file output_path."""
@@ -120,76 +311,315 @@ def encrypt_file_data( output_path, xml_data ):
         #print "XOR encrypting",output_path
         encrypted_data = XORencrypt( xml_data )
     else:
-        cipher = make_aes_cipher()
-        # adds filler so that input data length is a multiple of 16
-        filler = '\xfd\xfd\xfd\xfd' + '\0' * 12
-        filler_size = 16 - len( xml_data ) % 16
-        xml_data += filler[0:filler_size]
-        # encrypt the data
-        encrypted_data = cipher.encrypt( xml_data )
+        encrypted_data = aes_codec.encrypt( xml_data )
 
     file( output_path, 'wb' ).write( encrypted_data )
     return True
 
+@contextlib.contextmanager
+def open_output_file( output_path, encrypt = False ):
+    """Context manager providing a file-like object to write the content of
+       output_path into, encrypted as a .bin file if encrypt is True.
+       The data is written into a temporary file that replaces output_path
+       only if the block exits without exception, so that the existing file
+       is kept if the data can not be completely written.
+    """
+    temp_path = output_path + '.tmp'
+    try:
+        with file( temp_path, 'wb' ) as output_file:
+            if not encrypt:
+                yield output_file
+            elif ON_PLATFORM == PLATFORM_MAC:
+                # the XOR key depends on the data size: encrypted once complete
+                xml_file = cStringIO.StringIO()
+                yield xml_file
+                output_file.write( XORencrypt( xml_file.getvalue() ) )
+            else:
+                writer = aes_codec.encrypt_writer( output_file )
+                yield writer
+                writer.close()
+        if os.path.exists( output_path ): # rename does not overwrite on Windows
+            os.remove( output_path )
+        os.rename( temp_path, output_path )
+    except:
+        if os.path.exists( temp_path ):
+            os.remove( temp_path )
+        raise
+
 def encrypt_file( input_path, output_path ):
     """Encrypt XML file input_path into .bin file output_path using AES algorithm."""
-    xml_data = file( input_path, 'rb' ).read()
-    if encrypt_file_data( output_path, xml_data ):
-        print 'Encrypted "%s" into "%s"' % ( input_path, output_path )
+    if ON_PLATFORM == PLATFORM_MAC:
+        xml_data = file( input_path, 'rb' ).read()
+        encrypt_file_data( output_path, xml_data )
+    else:
+        with file( input_path, 'rb' ) as input_file:
+            with file( output_path, 'wb' ) as output_file:
+                aes_codec.encrypt_stream( input_file, output_file )
+    print 'Encrypted "%s" into "%s"' % ( input_path, output_path )
     return True
 
 ## MAC XOR decrypt and encrypt functions taken from goocrypt.py by SoulTaker
+# Each byte is xored with a key byte, which is rotated left by one bit and
+# xored with the encrypted byte to get the key of the next byte.
+_XOR_ROTATE_LEFT = [ ( ( a & 0x7f ) << 1 | ( a & 0x80 ) >> 7 ) for a in xrange( 256 ) ]
+
+def _xor_initial_key( size ):
+    return ( ( ( size & 1 ) << 6 ) | ( ( size & 2 ) << 3 ) | ( size & 4 ) ) ^ 0xab
+
 def XORdecrypt( input ):
-    output = ''
-    size = len( input )
-    a = ( ( ( size & 1 ) << 6 ) | ( ( size & 2 ) << 3 ) | ( size & 4 ) ) ^ 0xab
-    for c in input:
-        output += chr( a ^ ord( c ) )
-        a = ( ( a & 0x7f ) << 1 | ( a & 0x80 ) >> 7 ) ^ ord( c )
-    return output
+    data = bytearray( input )
+    rotate_left = _XOR_ROTATE_LEFT
+    a = _xor_initial_key( len( data ) )
+    for index, c in enumerate( data ):
+        data[index] = a ^ c
+        a = rotate_left[a] ^ c
+    return str( data )
 
 def XORencrypt( input ):
-    output = ''
-    size = len( input )
-    a = ( ( ( size & 1 ) << 6 ) | ( ( size & 2 ) << 3 ) | ( size & 4 ) ) ^ 0xab
-    for c in input:
-        output += chr( a ^ ord( c ) )
-        a = ( ( a & 0x7f ) << 1 | ( a & 0x80 ) >> 7 ) ^ ord( output[-1] )
-    return output
+    data = bytearray( input )
+    rotate_left = _XOR_ROTATE_LEFT
+    a = _xor_initial_key( len( data ) )
+    for index, c in enumerate( data ):
+        c ^= a
+        data[index] = c
+        a = rotate_left[a] ^ c
+    return str( data )
 
 def decrypt_file_data( input_path ):
     """Decrypt a .bin file input_path and return the corresponding XML. May raise IOError exception."""
-    crypted_data = file( input_path, 'rb' ).read()
-
     if ON_PLATFORM == PLATFORM_MAC:
         #print "XOR decrypting",input_path
+        crypted_data = file( input_path, 'rb' ).read()
         xml_data = XORdecrypt( crypted_data )
     else:
-        cipher = make_aes_cipher()
-        xml_data = cipher.decrypt( crypted_data )
-        # clean-up the data. Usually has '\xfd\xfd\xfd\xfd\0' at the
-        # end, but this may be truncated to first '\xfd' if
-        # size is nearly a multiple of 16, though there will
-        # always be at least one '\xfd'.
-        zero_index = xml_data.find( '\0' )
-        if zero_index != -1:
-            xml_data = xml_data[:zero_index]
-        fd_index = xml_data.find( '\xfd' )
-        if fd_index != -1:
-            xml_data = xml_data[:fd_index]
+        xml_data = aes_codec.decrypt_file( input_path )
     return xml_data
 
 def decrypt_file( input_path, output_path ):
     """Decrypt a .bin file input_path into .xml file output_path using AES algorithm."""
-    xml_data = decrypt_file_data( input_path )
-    file( output_path, 'wb' ).write( xml_data )
+    if ON_PLATFORM == PLATFORM_MAC:
+        xml_data = decrypt_file_data( input_path )
+        file( output_path, 'wb' ).write( xml_data )
+    else:
+        with file( input_path, 'rb' ) as input_file:
+            with file( output_path, 'wb' ) as output_file:
+                aes_codec.decrypt_stream( input_file, output_file )
     print 'Decrypted "%s" into "%s"' % ( input_path, output_path )
     return True
 
+def benchmark_png_conversion( side = 1024 ):
+    """Measures the time and peak memory used to convert a side x side
+       texture between .png.binltl and .png, with the former in memory
+       converters and the streaming ones. Each conversion is run in its own
+       process to measure its peak memory (not available on Windows).
+    """
+    import tempfile #@UnresolvedImport
+    import shutil #@UnresolvedImport
+    import random #@UnresolvedImport
+    import multiprocessing #@UnresolvedImport
+    temp_dir = tempfile.mkdtemp()
+    try:
+        # a texture with some noise, so that it does not compress too well
+        generator = random.Random( 1234 )
+        noise = ''.join( [ chr( generator.randint( 0, 255 ) ) for index in xrange( 4096 ) ] )
+        row = ( noise + '\0' * 4096 ) * ( side * 4 / 8192 + 1 )
+        imagedata = ''.join( [ row[( line * 16 ) % 4096:( line * 16 ) % 4096 + side * 4] for line in xrange( side ) ] )
+        cdata = zlib.compress( imagedata, 9 )
+        binltl_path = os.path.join( temp_dir, 'texture.png.binltl' )
+        with file( binltl_path, 'wb' ) as fout:
+            fout.write( struct.pack( "<HHII", side, side, len( cdata ), len( imagedata ) ) )
+            fout.write( cdata )
+        del imagedata, cdata
+        png_path = os.path.join( temp_dir, 'texture.png' )
+        pngbinltl2png( binltl_path, png_path )
+        for name, function, input_path in ( ( 'binltl->png', 'pngbinltl2png', binltl_path ),
+                                            ( 'png->binltl', 'png2pngbinltl', png_path ) ):
+            for mode in ( 'former', 'streaming' ):
+                queue = multiprocessing.Queue()
+                process = multiprocessing.Process( target = _benchmark_png_conversion_process,
+                    args = ( queue, mode, function, input_path, os.path.join( temp_dir, 'output' ) ) )
+                process.start()
+                elapsed, peak_memory = queue.get()
+                process.join()
+                if peak_memory is not None:
+                    print '%(name)s %(mode)s: %(time).2fs, peak memory %(memory).1f MB' % {
+                        'name': name, 'mode': mode, 'time': elapsed, 'memory': peak_memory }
+                else:
+                    print '%(name)s %(mode)s: %(time).2fs' % { 'name': name, 'mode': mode, 'time': elapsed }
+    finally:
+        shutil.rmtree( temp_dir )
+
+def _benchmark_png_conversion_process( queue, mode, function, input_path, output_path ):
+    """Runs a conversion for benchmark_png_conversion() and puts the
+       tuple (elapsed time, peak memory increase in MB) in the queue."""
+    try:
+        import resource #@UnresolvedImport
+        def peak_memory():
+            # ru_maxrss is in KB on Linux but in bytes on Mac
+            return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / ( ON_PLATFORM == PLATFORM_MAC and 1024.0 or 1.0 ) / 1024.0
+    except ImportError:
+        peak_memory = lambda: None
+
+    def former_pngbinltl2png( input_path, output_path ):
+        text = file( input_path, 'rb' ).read()
+        width, height, size, fullsize = struct.unpack( "<HHII", text[:12] ) #@UnusedVariable
+        data = zlib.decompress( text[12:12 + size] )
+        side = 1
+        while side < width or side < height:
+            side *= 2
+        with file( output_path, 'wb' ) as fout:
+            fout.write( "\x89\x50\x4E\x47\x0D\x0A\x1A\x0A" )
+            png_chunk( fout, "IHDR", struct.pack( ">II", width, height ) + "\x08\x06\x00\x00\x00" )
+            png_chunk( fout, "IDAT", zlib.compress( "\x00" + "\x00".join( *[( data[line * side * 4:( line * side + width ) * 4] for line in range( height ) )] ), 9 ) )
+            png_chunk( fout, "IEND", "" )
+
+    def former_png2pngbinltl( input_path, output_path ):
+        width, height, pixels, meta = png.Reader( filename = input_path ).asRGBA8() #@UnusedVariable
+        size = 1
+        while size < width or size < height:
+            size *= 2
+        rowend = ''.join( [chr( 0 ) for i in range( ( size - width ) * 4 )] ) #@UnusedVariable
+        fullrow = ''.join( [chr( 0 ) for i in range( size * 4 )] ) #@UnusedVariable
+        imagelist = []
+        for row in pixels:
+            imagelist.append( ''.join( [chr( v ) for v in row] ) + rowend )
+        for i in range( size - height ): #@UnusedVariable
+            imagelist.append( fullrow )
+        imagedata = ''.join( imagelist )
+        cdata = zlib.compress( imagedata, 9 )
+        with file( output_path, 'wb' ) as fout:
+            fout.write( struct.pack( "<HHII", width, height, len( cdata ), len( imagedata ) ) )
+            fout.write( cdata )
+
+    functions = { ( 'former', 'pngbinltl2png' ): former_pngbinltl2png,
+                  ( 'former', 'png2pngbinltl' ): former_png2pngbinltl,
+                  ( 'streaming', 'pngbinltl2png' ): pngbinltl2png,
+                  ( 'streaming', 'png2pngbinltl' ): png2pngbinltl }
+    initial_memory = peak_memory()
+    start_time = time.time()
+    functions[( mode, function )]( input_path, output_path )
+    elapsed = time.time() - start_time
+    if initial_memory is not None:
+        queue.put( ( elapsed, peak_memory() - initial_memory ) )
+    else:
+        queue.put( ( elapsed, None ) )
+
+def benchmark_xor( size = 1024 * 1024, iterations = 3 ):
+    """Measures the XOR encryption/decryption throughput in MB/s."""
+    xml_data = ( '<scene><scenelayer image="image" center="0,0" depth="0" /></scene>' * ( size / 64 ) )[:size]
+    crypted_data = XORencrypt( xml_data )
+    timings = []
+    for function, data in ( ( XORencrypt, xml_data ), ( XORdecrypt, crypted_data ) ):
+        start_time = time.time()
+        for index in xrange( iterations ): #@UnusedVariable
+            function( data )
+        timings.append( size * iterations / ( 1024.0 * 1024.0 ) / max( time.time() - start_time, 1e-6 ) )
+    print 'XOR: encrypt %(encrypt).1f MB/s, decrypt %(decrypt).1f MB/s' % {
+        'encrypt': timings[0], 'decrypt': timings[1] }
+
+def benchmark_aes( size = 16 * 1024 * 1024, iterations = 3 ):
+    """Measures the AES encryption/decryption throughput in MB/s, comparing
+       the former per call key conversion and full buffer copies with AESCodec.
+    """
+    xml_data = ( '<scene><scenelayer image="image" center="0,0" depth="0" /></scene>' * ( size / 64 ) )[:size]
+
+    def old_cipher():
+        key = '0D0607070C01080506090904060D030F03060E010E02070B'
+        binary_key = ''.join( [ chr( int( key[index:index + 2], 16 ) ) for index in xrange( 0, len( key ), 2 ) ] )
+        return AES.new( binary_key, AES.MODE_CBC, '\0' * AES_BLOCK_SIZE )
+    def old_encrypt( data ):
+        data += AES_FILLER[0:AES_BLOCK_SIZE - len( data ) % AES_BLOCK_SIZE]
+        return old_cipher().encrypt( data )
+    def old_decrypt( data ):
+        data = old_cipher().decrypt( data )
+        zero_index = data.find( '\0' )
+        if zero_index != -1:
+            data = data[:zero_index]
+        fd_index = data.find( '\xfd' )
+        if fd_index != -1:
+            data = data[:fd_index]
+        return data
+    def stream_encrypt( data ):
+        output_file = cStringIO.StringIO()
+        aes_codec.encrypt_stream( cStringIO.StringIO( data ), output_file )
+        return output_file.getvalue()
+    def stream_decrypt( data ):
+        output_file = cStringIO.StringIO()
+        aes_codec.decrypt_stream( cStringIO.StringIO( data ), output_file )
+        return output_file.getvalue()
+
+    crypted_data = aes_codec.encrypt( xml_data )
+    for name, encrypt, decrypt in ( ( 'former', old_encrypt, old_decrypt ),
+                                    ( 'buffer', aes_codec.encrypt, aes_codec.decrypt ),
+                                    ( 'stream', stream_encrypt, stream_decrypt ) ):
+        assert encrypt( xml_data ) == crypted_data
+        assert decrypt( crypted_data ) == xml_data
+        timings = []
+        for function, data in ( ( encrypt, xml_data ), ( decrypt, crypted_data ) ):
+            start_time = time.time()
+            for index in xrange( iterations ): #@UnusedVariable
+                function( data )
+            timings.append( size * iterations / ( 1024.0 * 1024.0 ) / max( time.time() - start_time, 1e-6 ) )
+        print '%(name)s: encrypt %(encrypt).1f MB/s, decrypt %(decrypt).1f MB/s' % {
+            'name': name, 'encrypt': timings[0], 'decrypt': timings[1] }
+
+def convert_png_file( task ):
+    """Converts a single .png.binltl file to .png if to_png is True, or the
+       other way around. task is a tuple (to_png, input_path, output_path,
+       level, threads), see png2pngbinltl().
+       Returns a tuple (input_path, error) where error is None on success.
+       Run in the worker processes, so errors are returned instead of being raised.
+    """
+    to_png, input_path, output_path, level, threads = task
+    try:
+        if to_png:
+            pngbinltl2png( input_path, output_path, level, threads )
+        else:
+            png2pngbinltl( input_path, output_path, level, threads )
+        return input_path, None
+    except ( IOError, OSError, ValueError, zlib.error, png.Error ), e:
+        return input_path, unicode( e )
+
+def convert_png_dir( input_dir, to_png, jobs = 1, level = PNG_COMPRESSION_LEVEL, threads = None ):
+    """Converts all .png.binltl files found in the directory and its
+       subdirectories to .png if to_png is True, or all .png files to
+       .png.binltl otherwise. Converted files are written next to their source.
+       jobs: number of processes used to convert the files.
+       level, threads: compression level and threads used for each file. When
+                       several processes are used, each file is compressed
+                       on a single thread by default.
+       Returns a tuple (converted_count, errors) where errors is a list of
+       tuple (input_path, error message).
+    """
+    if threads is None and jobs > 1:
+        threads = 1
+    tasks = []
+    for dir_path, dir_names, file_names in os.walk( input_dir ): #@UnusedVariable
+        for name in file_names:
+            input_path = os.path.join( dir_path, name )
+            if to_png and name.endswith( '.png.binltl' ):
+                tasks.append( ( to_png, input_path, input_path[:-len( '.binltl' )], level, threads ) )
+            elif not to_png and name.endswith( '.png' ):
+                tasks.append( ( to_png, input_path, input_path + '.binltl', level, threads ) )
+    if jobs > 1 and len( tasks ) > 1:
+        import multiprocessing #@UnresolvedImport
+        pool = multiprocessing.Pool( jobs )
+        try:
+            results = pool.map( convert_png_file, tasks, chunksize = 1 )
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = map( convert_png_file, tasks )
+    errors = [ ( input_path, error ) for input_path, error in results if error is not None ]
+    return len( results ) - len( errors ), errors
+
 def main():
     parser = optparse.OptionParser( """
 %prog --decrypt source-file [output-path][output-filename]
 %prog --encrypt source-file [output-path][output-filename]
+%prog --to-png [--jobs N] [--level L] [--threads T] source-file-or-dir [output-filename]
+%prog --to-binltl [--jobs N] [--level L] [--threads T] source-file-or-dir [output-filename]
 
 You must always supply the full path to the "source" file.
 For the "output" you may supply...
@@ -202,7 +632,40 @@ Path Only  (filename from source-file, extension converted to .xml or .bin)
                        help = 'Decrypt the input path into the output path' )
     parser.add_option( '-e', '--encrypt', dest = 'encrypt', action = "store_true", default = False,
                        help = 'Encrypt the input path into the output path' )
+    parser.add_option( '--to-png', dest = 'to_png', action = "store_true", default = False,
+                       help = 'Convert the .png.binltl input file, or all the ones in the input directory, to .png' )
+    parser.add_option( '--to-binltl', dest = 'to_binltl', action = "store_true", default = False,
+                       help = 'Convert the .png input file, or all the ones in the input directory, to .png.binltl' )
+    parser.add_option( '-j', '--jobs', dest = 'jobs', type = 'int', default = 1,
+                       help = 'Number of processes used to convert a directory' )
+    parser.add_option( '-l', '--level', dest = 'level', type = 'int', default = PNG_COMPRESSION_LEVEL,
+                       help = 'zlib compression level of the converted files (1-9), lower is faster but larger' )
+    parser.add_option( '--threads', dest = 'threads', type = 'int', default = None,
+                       help = 'Number of threads compressing each converted file (default: one per processor, '
+                              'or one when converting a directory with several jobs)' )
+    parser.add_option( '--benchmark', dest = 'benchmark', action = "store_true", default = False,
+                       help = 'Measures the encryption/decryption and png conversion throughput' )
     ( options, args ) = parser.parse_args()
+    if not 0 <= options.level <= 9:
+        parser.error( 'The compression level must be between 0 and 9' )
+    if options.threads is not None and options.threads < 1:
+        parser.error( 'The number of threads must be at least 1' )
+    if options.benchmark:
+        benchmark_xor()
+        if ON_PLATFORM != PLATFORM_MAC:
+            benchmark_aes()
+        benchmark_png_conversion()
+        return True
+    if ( options.to_png or options.to_binltl ) and len( args ) >= 1 and os.path.isdir( args[0] ):
+        if options.jobs < 1:
+            parser.error( 'The number of jobs must be at least 1' )
+        start_time = time.time()
+        converted_count, errors = convert_png_dir( args[0], options.to_png, options.jobs,
+                                                   options.level, options.threads )
+        for input_path, error in errors:
+            print 'Error: failed to convert "%s": %s' % ( input_path, error )
+        print '%d files converted in %.2fs' % ( converted_count, time.time() - start_time )
+        return not errors
     if len( args ) == 2:
         if args[0] == args[1]:
             parser.error( 'Input path must be different from output path' )
@@ -221,10 +684,100 @@ Path Only  (filename from source-file, extension converted to .xml or .bin)
         if args[1][len( args[1] ) - 4:] != '.bin':
             args[1] = os.path.join( args[1], os.path.splitext( os.path.split( args[0] )[1] )[0] + ".bin" )
         return encrypt_file( args[0], args[1] )
+    elif options.to_png:
+        if len( args ) == 1:
+            if not args[0].endswith( '.png.binltl' ):
+                parser.error( 'You must specify the output path' )
+            args.append( args[0][:-len( '.binltl' )] )
+        pngbinltl2png( args[0], args[1], options.level, options.threads )
+        return True
+    elif options.to_binltl:
+        if len( args ) == 1:
+            args.append( args[0] + '.binltl' )
+        png2pngbinltl( args[0], args[1], options.level, options.threads )
+        return True
     else:
-        parser.error( 'You must specify either --decrypt or --encrypt' )
+        parser.error( 'You must specify either --decrypt, --encrypt, --to-png or --to-binltl' )
 
 if __name__ == '__main__':
+    if sys.argv[1:] == ['test']:
+        import unittest #@UnresolvedImport
+        import random #@UnresolvedImport
+
+        class XORTest( unittest.TestCase ):
+            # original implementation by SoulTaker, used as reference
+            def reference_decrypt( self, input ):
+                output = ''
+                size = len( input )
+                a = ( ( ( size & 1 ) << 6 ) | ( ( size & 2 ) << 3 ) | ( size & 4 ) ) ^ 0xab
+                for c in input:
+                    output += chr( a ^ ord( c ) )
+                    a = ( ( a & 0x7f ) << 1 | ( a & 0x80 ) >> 7 ) ^ ord( c )
+                return output
+
+            def reference_encrypt( self, input ):
+                output = ''
+                size = len( input )
+                a = ( ( ( size & 1 ) << 6 ) | ( ( size & 2 ) << 3 ) | ( size & 4 ) ) ^ 0xab
+                for c in input:
+                    output += chr( a ^ ord( c ) )
+                    a = ( ( a & 0x7f ) << 1 | ( a & 0x80 ) >> 7 ) ^ ord( output[-1] )
+                return output
+
+            def test_round_trip( self ):
+                generator = random.Random( 1234 )
+                for size in range( 0, 20 ) + [ generator.randint( 20, 5000 ) for index in xrange( 50 ) ]:
+                    data = ''.join( [ chr( generator.randint( 0, 255 ) ) for index in xrange( size ) ] )
+                    crypted_data = XORencrypt( data )
+                    self.assertEqual( self.reference_encrypt( data ), crypted_data )
+                    self.assertEqual( self.reference_decrypt( data ), XORdecrypt( data ) )
+                    self.assertEqual( data, XORdecrypt( crypted_data ) )
+
+        class OutputFileTest( unittest.TestCase ):
+            def setUp( self ):
+                import tempfile #@UnresolvedImport
+                self.temp_dir = tempfile.mkdtemp()
+                self.path = os.path.join( self.temp_dir, 'level.scene.bin' )
+
+            def tearDown( self ):
+                import shutil #@UnresolvedImport
+                shutil.rmtree( self.temp_dir )
+
+            def test_encrypt_writer( self ):
+                if ON_PLATFORM == PLATFORM_MAC:
+                    return
+                generator = random.Random( 1234 )
+                codec = AESCodec( chunk_size = 64 )
+                for size in range( 0, 40 ) + [ 1000, 4096 ]:
+                    data = ''.join( [ chr( generator.randint( 0, 255 ) ) for index in xrange( size ) ] )
+                    output_file = cStringIO.StringIO()
+                    writer = codec.encrypt_writer( output_file )
+                    start = 0
+                    while start < size:
+                        end = start + generator.randint( 0, 100 )
+                        writer.write( data[start:end] )
+                        start = end
+                    self.assertEqual( size, writer.close() )
+                    self.assertEqual( codec.encrypt( data ), output_file.getvalue() )
+
+            def test_open_output_file( self ):
+                with open_output_file( self.path, encrypt = True ) as output_file:
+                    output_file.write( '<scene>' )
+                    output_file.write( '</scene>' )
+                self.assertEqual( '<scene></scene>', decrypt_file_data( self.path ) )
+                try:
+                    with open_output_file( self.path, encrypt = True ) as output_file:
+                        output_file.write( '<scene>' )
+                        raise ValueError( 'failed' )
+                except ValueError:
+                    pass
+                self.assertEqual( '<scene></scene>', decrypt_file_data( self.path ) )
+                self.assertEqual( [ 'level.scene.bin' ], os.listdir( self.temp_dir ) )
+                with open_output_file( self.path ) as output_file:
+                    output_file.write( '<scene />' )
+                self.assertEqual( '<scene />', file( self.path, 'rb' ).read() )
+
+        unittest.main( argv = sys.argv[:1] )
     succeed = main()
     if not succeed:
         print 'Failed'
@@ -0,0 +1,473 @@
+"""Benchmarks of the loading, saving and checking of the level trees.
+
+Usage: worldbenchmark.py [xml_path...]
+The XML files must be level scenes. If none is specified, a scene with the
+initial attribute values is generated.
+"""
+import os.path
+import sys
+import time
+import xml.etree.ElementTree
+
+import louie
+import metaworld
+import metaworldui
+import metawog
+import treesnapshot
+
+def make_sample_root_element( tree_meta, element_count ):
+    """Returns a root element for tree_meta with element_count children of
+       each kind in turn, each with one child of each of its own kinds. All
+       the elements have their initial attribute values.
+       Used to benchmark the loading of large trees.
+    """
+    def make_element( element_meta, depth ):
+        attributes = dict( [ ( attribute_meta.name, attribute_meta.init )
+                             for attribute_meta in element_meta.attributes
+                             if attribute_meta.init is not None ] )
+        children = []
+        if depth > 0:
+            children = [ make_element( child_meta, depth - 1 )
+                         for child_meta in element_meta.immediate_child_elements() ]
+        return metaworld.Element( element_meta, attributes, children )
+    root_meta = tree_meta.root_element_meta
+    child_metas = root_meta.immediate_child_elements()
+    root = make_element( root_meta, 0 )
+    for index in xrange( element_count ):
+        root.append( make_element( child_metas[index % len( child_metas )], 1 ) )
+    return root
+
+def benchmark_xml_loading( tree_meta, paths = (), element_count = 20000, iterations = 3 ):
+    """Compares the time spent loading trees with the single pass loader and
+       with the former parse then convert loader.
+       paths: XML files of the kind of tree described by tree_meta. If none is
+              specified, a tree with element_count children of the root of
+              each kind, with their initial attribute values, is generated.
+    """
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    datas = []
+    for path in paths:
+        datas.append( ( os.path.basename( path ), file( path, 'rb' ).read() ) )
+    if not datas:
+        root = make_sample_root_element( tree_meta, element_count )
+        datas.append( ( 'generated %s' % tree_meta.name, root.to_xml() ) )
+    previous_fast_xml_loading = metaworld.FAST_XML_LOADING
+    try:
+        for name, xml_data in datas:
+            elapsed = {}
+            xml_outputs = {}
+            for fast_xml_loading in ( False, True ):
+                metaworld.FAST_XML_LOADING = fast_xml_loading
+                start_time = time.time()
+                for iteration in xrange( iterations ): #@UnusedVariable
+                    tree = universe.make_unattached_tree_from_xml( tree_meta, xml_data )
+                elapsed[fast_xml_loading] = ( time.time() - start_time ) / iterations
+                xml_outputs[fast_xml_loading] = tree.to_xml()
+            assert xml_outputs[False] == xml_outputs[True]
+            print '%(name)s (%(size).1f KB, %(count)d elements): former %(former).3fs, single pass %(fast).3fs (x%(ratio).1f)' % {
+                'name': name, 'size': len( xml_data ) / 1024.0,
+                'count': len( list( tree.root.getiterator() ) ),
+                'former': elapsed[False], 'fast': elapsed[True],
+                'ratio': elapsed[False] / max( elapsed[True], 1e-6 ) }
+    finally:
+        metaworld.FAST_XML_LOADING = previous_fast_xml_loading
+
+def benchmark_yaml_loading( tree_meta, paths = (), element_count = 20000, iterations = 3 ):
+    """Compares the time spent loading and saving trees in the YAML format
+       with the XML format.
+       paths: XML files of the kind of tree described by tree_meta, converted
+              to YAML. If none is specified, a tree is generated as for
+              benchmark_xml_loading().
+    """
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    trees = []
+    for path in paths:
+        xml_data = file( path, 'rb' ).read()
+        trees.append( ( os.path.basename( path ), universe.make_unattached_tree_from_xml( tree_meta, xml_data ) ) )
+    if not trees:
+        root = make_sample_root_element( tree_meta, element_count )
+        trees.append( ( 'generated %s' % tree_meta.name, metaworld.Tree( universe, tree_meta, root_element = root ) ) )
+    def timed( function, *args ):
+        start_time = time.time()
+        for iteration in xrange( iterations ): #@UnusedVariable
+            result = function( *args )
+        return result, ( time.time() - start_time ) / iterations
+    for name, tree in trees:
+        xml_data, xml_save = timed( tree.to_xml )
+        yaml_data, yaml_save = timed( tree.to_yaml )
+        xml_tree, xml_load = timed( universe.make_unattached_tree_from_xml, tree_meta, xml_data )
+        yaml_tree, yaml_load = timed( universe.make_unattached_tree_from_yaml, tree_meta, yaml_data )
+        assert xml_tree.to_yaml() == yaml_data
+        assert yaml_tree.to_yaml() == yaml_data
+        print '%(name)s (%(count)d elements): load XML %(xml_load).3fs, YAML %(yaml_load).3fs (x%(load_ratio).1f), ' \
+              'save XML %(xml_save).3fs, YAML %(yaml_save).3fs (x%(save_ratio).1f)' % {
+            'name': name, 'count': len( list( tree.root.getiterator() ) ),
+            'xml_load': xml_load, 'yaml_load': yaml_load,
+            'load_ratio': yaml_load / max( xml_load, 1e-6 ),
+            'xml_save': xml_save, 'yaml_save': yaml_save,
+            'save_ratio': yaml_save / max( xml_save, 1e-6 ) }
+
+def benchmark_xml_saving( tree_meta, paths = (), element_count = 20000 ):
+    """Measures the time and peak memory used to save a tree as an
+       encrypted .bin file and as a plain XML file, with the former
+       xml.etree based serialization and with the streaming XmlWriter.
+       Each save is run in its own process to measure its peak memory (not
+       available on Windows).
+       paths: XML files of the kind of tree described by tree_meta. If none is
+              specified, a tree is generated as for benchmark_xml_loading().
+    """
+    import tempfile
+    import shutil
+    import multiprocessing #@UnresolvedImport
+    temp_dir = tempfile.mkdtemp()
+    try:
+        for path in list( paths ) or [ None ]:
+            for encrypt in ( True, False ):
+                for mode in ( 'former', 'streaming' ):
+                    queue = multiprocessing.Queue()
+                    process = multiprocessing.Process( target = _benchmark_xml_saving_process,
+                        args = ( queue, mode, tree_meta, path, element_count, encrypt,
+                                 os.path.join( temp_dir, 'output' ) ) )
+                    process.start()
+                    name, elapsed, peak_memory = queue.get()
+                    process.join()
+                    name = '%s %s %s' % ( name, encrypt and '.bin' or '.xml', mode )
+                    if peak_memory is not None:
+                        print '%(name)s: %(time).2fs, peak memory %(memory).1f MB' % {
+                            'name': name, 'time': elapsed, 'memory': peak_memory }
+                    else:
+                        print '%(name)s: %(time).2fs' % { 'name': name, 'time': elapsed }
+    finally:
+        shutil.rmtree( temp_dir )
+
+def _benchmark_xml_saving_process( queue, mode, tree_meta, path, element_count, encrypt, output_path ):
+    """Saves a tree for benchmark_xml_saving() and puts the tuple
+       (tree name, elapsed time, peak memory increase in MB) in the queue."""
+    import wogfile #@UnresolvedImport
+    try:
+        import resource #@UnresolvedImport
+        def peak_memory():
+            # ru_maxrss is in KB on Linux but in bytes on Mac
+            return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / ( sys.platform == 'darwin' and 1024.0 or 1.0 ) / 1024.0
+    except ImportError:
+        peak_memory = lambda: None
+
+    def former_xml_element( element ):
+        attributes_by_name = {}
+        for attribute in element.meta.attributes:
+            attribute.to_xml( element, attributes_by_name )
+        xml_element = xml.etree.ElementTree.Element( element.meta.tag, attributes_by_name )
+        if element.text is not None:
+            xml_element.text = element.text
+        for child in element:
+            xml_element.append( former_xml_element( child ) )
+        return xml_element
+
+    def former_save( tree ):
+        data = xml.etree.ElementTree.tostring( former_xml_element( tree.root ), 'utf-8' )
+        data = '<!-- header -->\n' + data.replace( '><', '>\n<' )
+        if encrypt:
+            wogfile.encrypt_file_data( output_path, data )
+        else:
+            file( output_path, 'wb' ).write( data )
+
+    def streaming_save( tree ):
+        with wogfile.open_output_file( output_path, encrypt ) as output_file:
+            output_file.write( '<!-- header -->\n' )
+            tree.write_xml( output_file, pretty = True )
+
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    if path is not None:
+        name = os.path.basename( path )
+        tree = universe.make_unattached_tree_from_xml( tree_meta, file( path, 'rb' ).read() )
+    else:
+        name = 'generated %s (%d elements)' % ( tree_meta.name, element_count )
+        tree = metaworld.Tree( universe, tree_meta, root_element = make_sample_root_element( tree_meta, element_count ) )
+    initial_memory = peak_memory()
+    start_time = time.time()
+    { 'former': former_save, 'streaming': streaming_save }[mode]( tree )
+    elapsed = time.time() - start_time
+    if initial_memory is not None:
+        queue.put( ( name, elapsed, peak_memory() - initial_memory ) )
+    else:
+        queue.put( ( name, elapsed, None ) )
+
+def benchmark_issue_tracking( element_count = 10000 ):
+    """Measures the time slices used to check the issues of a level with
+       element_count scene elements when it is opened, then after an
+       attribute is modified and an element removed. Compares with the
+       former full recursive check of the tree, done in a single refresh.
+    """
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    game_world = universe.make_world( metawog.WORLD_GLOBAL, 'game' )
+    world = game_world.make_world( metawog.WORLD_LEVEL, 'level' )
+    tracker = metaworldui.ElementIssueTracker( world )
+    scene_root = make_sample_root_element( metawog.TREE_LEVEL_SCENE, element_count )
+    element_count = len( list( scene_root.getiterator() ) )
+
+    def refresh( name ):
+        slice_count, check_time, checked_count = tracker.slice_count, tracker.check_time, tracker.checked_count
+        validated_count = tracker.validated_count
+        tracker.max_slice_time = 0.0
+        while True in [ pending for receiver, pending in louie.send_minimal( metaworldui.RefreshElementIssues ) ]: #@UnusedVariable
+            pass
+        print '%(name)s: %(checked)d checks, %(validated)d validations in %(slices)d slices, ' \
+              '%(time).3fs, longest slice %(max).1fms' % {
+            'name': name, 'checked': tracker.checked_count - checked_count,
+            'validated': tracker.validated_count - validated_count,
+            'slices': tracker.slice_count - slice_count, 'time': tracker.check_time - check_time,
+            'max': tracker.max_slice_time * 1000.0 }
+
+    for tree_meta in world.meta.trees:
+        if tree_meta is metawog.TREE_LEVEL_SCENE:
+            world.make_tree( tree_meta, scene_root )
+        else:
+            world.make_tree( tree_meta, make_sample_root_element( tree_meta, 0 ) )
+    refresh( 'open (%d elements)' % element_count )
+    scene_root[element_count / 2].set( scene_root[element_count / 2].meta.attributes[0].name, '' )
+    refresh( 'attribute modified' )
+    scene_root.remove( scene_root[0] )
+    refresh( 'element removed' )
+
+    # former check: every attribute of every element validated in one refresh
+    tracker._attribute_issues.clear()
+    start_time = time.time()
+    tracker._check_element( scene_root, set() )
+    print 'former full check: %.3fs' % ( time.time() - start_time )
+
+def benchmark_attribute_validation( world_metas, tree_meta, paths = (), element_count = 20000, iterations = 3 ):
+    """Measures the number of attributes validated per second over whole
+       trees, with the compiled validators alone (first validation of each
+       value) and with the cache of validated values.
+       world_metas: the hierarchy of worlds, from the root world down to the
+                    world of tree_meta, so that references can be resolved.
+       paths: XML files of the kind of tree described by tree_meta. If none is
+              specified, a tree is generated as for benchmark_xml_loading().
+    """
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    datas = []
+    for path in paths:
+        datas.append( ( os.path.basename( path ), file( path, 'rb' ).read() ) )
+    if not datas:
+        datas.append( ( 'generated %s' % tree_meta.name,
+                        make_sample_root_element( tree_meta, element_count ).to_xml() ) )
+    for name, xml_data in datas:
+        world = universe
+        for world_meta in world_metas:
+            world = world.make_world( world_meta, name )
+        for other_tree_meta in world.meta.trees:
+            if other_tree_meta is tree_meta:
+                world.make_tree_from_xml( tree_meta, xml_data )
+            else:
+                world.make_tree( other_tree_meta, make_sample_root_element( other_tree_meta, 0 ) )
+        elements = [ element for tree in world.trees for element in tree.root.getiterator() ]
+        attribute_count = sum( [ len( element.meta.attributes_order ) for element in elements ] )
+
+        start_time = time.time()
+        for iteration in xrange( iterations ): #@UnusedVariable
+            for element in elements:
+                for attribute_meta in element.meta.attributes_order:
+                    attribute_meta.get_validator()( attribute_meta.get( element ), world )
+        compiled = ( time.time() - start_time ) / iterations
+        start_time = time.time()
+        for iteration in xrange( iterations ): #@UnusedVariable
+            for element in elements:
+                element.get_attribute_issues( world )
+        cached = ( time.time() - start_time ) / iterations
+        print '%(name)s (%(count)d attributes): compiled %(compiled).0f attributes/s, ' \
+              'cached %(cached).0f attributes/s' % {
+            'name': name, 'count': attribute_count,
+            'compiled': attribute_count / max( compiled, 1e-6 ),
+            'cached': attribute_count / max( cached, 1e-6 ) }
+
+def benchmark_native_values( tree_meta, paths = (), element_count = 20000, iterations = 5 ):
+    """Compares the number of Element.get_native() calls per second with and
+       without the cache of converted values, reading each attribute of each
+       element once per iteration as the level view does on each refresh.
+       paths: XML files of the kind of tree described by tree_meta. If none is
+              specified, a tree is generated as for benchmark_xml_loading().
+    """
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    datas = []
+    for path in paths:
+        datas.append( ( os.path.basename( path ), file( path, 'rb' ).read() ) )
+    if not datas:
+        datas.append( ( 'generated %s' % tree_meta.name,
+                        make_sample_root_element( tree_meta, element_count ).to_xml() ) )
+    previous_cache_native_values = metaworld.CACHE_NATIVE_VALUES
+    try:
+        for name, xml_data in datas:
+            elapsed = {}
+            natives = {}
+            for cache_native_values in ( False, True ):
+                metaworld.CACHE_NATIVE_VALUES = cache_native_values
+                tree = universe.make_unattached_tree_from_xml( tree_meta, xml_data )
+                elements = list( tree.root.getiterator() )
+                call_count = 0
+                start_time = time.time()
+                for iteration in xrange( iterations ): #@UnusedVariable
+                    values = []
+                    for element in elements:
+                        for attribute_meta in element.meta.attributes_order:
+                            values.append( element.get_native( attribute_meta.name ) )
+                    call_count += len( values )
+                elapsed[cache_native_values] = time.time() - start_time
+                natives[cache_native_values] = values
+            assert natives[False] == natives[True]
+            print '%(name)s (%(count)d elements): former %(former).0f calls/s, ' \
+                  'cached %(cached).0f calls/s (x%(ratio).1f)' % {
+                'name': name, 'count': len( elements ),
+                'former': call_count / max( elapsed[False], 1e-6 ),
+                'cached': call_count / max( elapsed[True], 1e-6 ),
+                'ratio': elapsed[False] / max( elapsed[True], 1e-6 ) }
+    finally:
+        metaworld.CACHE_NATIVE_VALUES = previous_cache_native_values
+
+def benchmark_element_memory( tree_meta, paths = (), element_count = 100000 ):
+    """Measures the memory used by the elements of trees loaded from XML.
+       Each tree is loaded in its own process to measure the increase of its
+       peak memory (not available on Windows), and the size of the element
+       objects, their attributes dict and children list is summed.
+       paths: XML files of the kind of tree described by tree_meta. If none is
+              specified, a tree of about element_count elements is generated
+              as for benchmark_xml_loading().
+    """
+    import multiprocessing #@UnresolvedImport
+    import tempfile #@UnresolvedImport
+    temporary_path = None
+    if not paths:
+        handle, temporary_path = tempfile.mkstemp( '.xml' )
+        os.close( handle )
+        # generated in its own process so that the processes measuring the
+        # memory do not inherit the peak memory used to generate it
+        process = multiprocessing.Process( target = _write_sample_tree_process,
+                                           args = ( tree_meta, element_count, temporary_path ) )
+        process.start()
+        process.join()
+        paths = [ temporary_path ]
+    try:
+        for path in paths:
+            queue = multiprocessing.Queue()
+            process = multiprocessing.Process( target = _benchmark_element_memory_process,
+                                               args = ( queue, tree_meta, path ) )
+            process.start()
+            count, object_size, peak_memory = queue.get()
+            process.join()
+            name = path == temporary_path and 'generated %s' % tree_meta.name or os.path.basename( path )
+            print '%(name)s (%(count)d elements): %(object)d bytes per element object, ' \
+                  'peak memory %(peak)s' % {
+                'name': name, 'count': count, 'object': object_size / count,
+                'peak': peak_memory is not None and '+%.1fMB (%d bytes per element)' % (
+                    peak_memory, peak_memory * 1024 * 1024 / count ) or 'unknown' }
+    finally:
+        if temporary_path is not None:
+            os.remove( temporary_path )
+
+def _write_sample_tree_process( tree_meta, element_count, path ):
+    """Writes a tree of about element_count elements generated by
+       make_sample_root_element() into the XML file path."""
+    # make_sample_root_element() adds a child to about half the children
+    root = make_sample_root_element( tree_meta, element_count * 2 / 3 )
+    output_file = file( path, 'wb' )
+    try:
+        root.write_xml( output_file )
+    finally:
+        output_file.close()
+
+def _benchmark_element_memory_process( queue, tree_meta, path ):
+    """Loads a tree for benchmark_element_memory() and puts the tuple
+       (element count, size of the element objects, peak memory increase in
+       MB) in the queue."""
+    try:
+        import resource #@UnresolvedImport
+        def peak_memory():
+            # ru_maxrss is in KB on Linux but in bytes on Mac
+            return resource.getrusage( resource.RUSAGE_SELF ).ru_maxrss / ( sys.platform == 'darwin' and 1024.0 or 1.0 ) / 1024.0
+    except ImportError:
+        peak_memory = lambda: None
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    xml_data = file( path, 'rb' ).read()
+    initial_memory = peak_memory()
+    tree = universe.make_unattached_tree_from_xml( tree_meta, xml_data )
+    del xml_data
+    loaded_memory = peak_memory()
+    count = 0
+    object_size = 0
+    for element in tree.root.getiterator():
+        count += 1
+        object_size += sys.getsizeof( element ) + sys.getsizeof( element.attrib ) + sys.getsizeof( element._children )
+        if hasattr( element, '__dict__' ):
+            object_size += sys.getsizeof( element.__dict__ )
+    if initial_memory is not None:
+        queue.put( ( count, object_size, loaded_memory - initial_memory ) )
+    else:
+        queue.put( ( count, object_size, None ) )
+
+def benchmark_snapshot_loading( level_dirs = (), element_count = 10000, iterations = 3 ):
+    """Compares the time spent loading the trees of the levels from their
+       sources (cold) and from their snapshot.
+       level_dirs: level directories, containing the name.level, name.scene
+                   and name.resrc files. If none is specified, a generated
+                   scene with element_count elements is used.
+    """
+    import tempfile #@UnresolvedImport
+    import shutil #@UnresolvedImport
+    universe = metaworld.Universe()
+    universe._warning = lambda message, **kwargs: None
+    temp_dir = tempfile.mkdtemp()
+    try:
+        levels = []
+        for level_dir in level_dirs:
+            name = os.path.basename( os.path.normpath( level_dir ) )
+            levels.append( ( name, [ ( metawog.TREE_LEVEL_RESOURCE, os.path.join( level_dir, name + '.resrc' ) ),
+                                     ( metawog.TREE_LEVEL_GAME, os.path.join( level_dir, name + '.level' ) ),
+                                     ( metawog.TREE_LEVEL_SCENE, os.path.join( level_dir, name + '.scene' ) ) ] ) )
+        if not levels:
+            root = make_sample_root_element( metawog.TREE_LEVEL_SCENE, element_count )
+            for extension, data in ( ( '.xml', root.to_xml() ), ( '.yaml', root.to_yaml() ) ):
+                path = os.path.join( temp_dir, 'generated' + extension )
+                with open( path, 'wb' ) as output_file:
+                    output_file.write( data )
+                levels.append( ( 'generated scene %s' % extension,
+                                 [ ( metawog.TREE_LEVEL_SCENE, path ) ] ) )
+        cache = treesnapshot.TreeSnapshotCache( temp_dir )
+        for name, sources in levels:
+            tree_metas = [ tree_meta for tree_meta, path in sources ] #@UnusedVariable
+            paths = [ path for tree_meta, path in sources ] #@UnusedVariable
+            start_time = time.time()
+            for iteration in xrange( iterations ): #@UnusedVariable
+                trees = [ treesnapshot.load_tree_source( universe, tree_meta, path ) for tree_meta, path in sources ]
+            cold_time = ( time.time() - start_time ) / iterations
+            cache.store( name, trees, paths )
+            start_time = time.time()
+            for iteration in xrange( iterations ): #@UnusedVariable
+                snapshot_trees = cache.load( universe, name, tree_metas, paths )
+            snapshot_time = ( time.time() - start_time ) / iterations
+            assert [ tree.to_xml() for tree in trees ] == [ tree.to_xml() for tree in snapshot_trees ]
+            element_total = sum( [ len( list( tree.root.getiterator() ) ) for tree in trees ] )
+            print '%(name)s (%(count)d elements): cold %(cold).3fs, snapshot %(snapshot).3fs (x%(ratio).1f)' % {
+                'name': name, 'count': element_total, 'cold': cold_time, 'snapshot': snapshot_time,
+                'ratio': cold_time / max( snapshot_time, 1e-6 ) }
+    finally:
+        shutil.rmtree( temp_dir )
+
+if __name__ == '__main__':
+    paths = sys.argv[1:]
+    # first the benchmarks measuring the peak memory of child processes:
+    # they would inherit the peak memory of the other benchmarks
+    benchmark_element_memory( metawog.TREE_LEVEL_SCENE, paths )
+    benchmark_xml_saving( metawog.TREE_LEVEL_SCENE, paths )
+    benchmark_xml_loading( metawog.TREE_LEVEL_SCENE, paths )
+    benchmark_yaml_loading( metawog.TREE_LEVEL_SCENE, paths )
+    benchmark_attribute_validation( ( metawog.WORLD_GLOBAL, metawog.WORLD_LEVEL ),
+                                    metawog.TREE_LEVEL_SCENE, paths )
+    benchmark_native_values( metawog.TREE_LEVEL_SCENE, paths )
+    benchmark_snapshot_loading()
+    benchmark_issue_tracking()